@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import random
+from functools import partial
+
+from pybullet_planning.pybullet_tools.pr2_utils import get_other_arm, arm_conf, REST_LEFT_ARM, DRAKE_PR2_URDF, \
+    set_arm_conf, get_group_joints, get_base_pose, get_database_file, REACHABILITY_FILENAME, ARM_NAMES
+from pybullet_planning.pybullet_tools.utils import connect, disconnect, load_pybullet, HideOutput, multiply, \
+    set_joint_positions, get_joint_limits, wait_if_gui
+from pybullet_planning.pybullet_tools.ikfast.pr2.ik import pr2_inverse_kinematics, is_ik_compiled
+from pybullet_planning.pybullet_tools.voxels import build_reachability_map
+
+# Gripper positions in the base_footprint frame that the PR2 arms can possibly reach
+PR2_REACHABILITY_LIMITS = ((-0.6, -1.4, -0.2), (1.4, 1.4, 2.0))
+
+
+def create_pr2_reachability_test(arm, sample_torso=True):
+    # Runs once per worker process
+    connect(use_gui=False)
+    with HideOutput():
+        robot = load_pybullet(DRAKE_PR2_URDF)
+    other_arm = get_other_arm(arm)
+    set_arm_conf(robot, other_arm, arm_conf(other_arm, REST_LEFT_ARM))
+    [torso_joint] = get_group_joints(robot, 'torso')
+    torso_limits = get_joint_limits(robot, torso_joint)
+    print('IKFast:', is_ik_compiled())
+
+    def test(base_from_gripper):
+        if sample_torso:
+            set_joint_positions(robot, [torso_joint], [random.uniform(*torso_limits)])
+        gripper_pose = multiply(get_base_pose(robot), base_from_gripper)
+        return pr2_inverse_kinematics(robot, arm, gripper_pose) is not None
+    return test
+
+#######################################################
+
+def main():
+    parser = argparse.ArgumentParser()  # Automatically includes help
+    parser.add_argument('-arm', required=True, choices=ARM_NAMES)
+    parser.add_argument('-resolution', type=float, default=0.1, help='voxel side length (m)')
+    parser.add_argument('-orientations', type=int, default=32, help='number of approach direction bins')
+    parser.add_argument('-samples', type=int, default=2, help='samples per voxel and orientation bin')
+    parser.add_argument('-workers', type=int, default=None, help='number of processes (defaults to all CPUs)')
+    parser.add_argument('-viewer', action='store_true', help='enable viewer.')
+    args = parser.parse_args()
+
+    lower, upper = PR2_REACHABILITY_LIMITS
+    reachability_map = build_reachability_map(
+        partial(create_pr2_reachability_test, args.arm), lower, upper,
+        resolution=args.resolution, num_orientations=args.orientations, axis=(1, 0, 0),
+        num_samples=args.samples, num_workers=args.workers)
+    path = reachability_map.save(get_database_file(REACHABILITY_FILENAME.format(args.arm)))
+    print(reachability_map)
+    print('Saved', path)
+
+    if args.viewer:
+        connect(use_gui=True)
+        reachability_map.draw()
+        wait_if_gui()
+        disconnect()
+
+if __name__ == '__main__':
+    main()
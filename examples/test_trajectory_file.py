@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import os
+import numpy as np
+
+from pybullet_planning.pybullet_tools.pr2_primitives import create_trajectory, write_commands, read_commands
+from pybullet_planning.pybullet_tools.pr2_utils import DRAKE_PR2_URDF, get_arm_joints, TOP_HOLDING_LEFT_ARM
+from pybullet_planning.pybullet_tools.utils import HideOutput, connect, disconnect, load_model, TEMP_DIR, \
+    ensure_dir, safe_remove
+
+
+def test_repeated_confs(pr2, arm='left'):
+    # Consecutive equal configurations have zero duration and must not produce NaN or infinite velocities
+    arm_joints = get_arm_joints(pr2, arm)
+    conf = np.array(TOP_HOLDING_LEFT_ARM)
+    path = [conf, conf, conf + 0.1, conf + 0.1, conf + 0.1, conf + 0.2, conf + 0.2]
+    trajectory = create_trajectory(pr2, arm_joints, path)
+
+    filename = os.path.join(TEMP_DIR, 'repeated_confs.traj')
+    ensure_dir(filename)
+    write_commands(filename, [trajectory])
+    [command] = read_commands(filename)
+    record = command.record
+    print('Times:', np.round(record.times, 3))
+    assert np.all(np.diff(record.times) > 0)
+    assert np.all(np.isfinite(record.velocities))
+    assert np.allclose(record.positions[-1], path[-1])
+    del command, record # Releases the memory map
+    safe_remove(filename)
+
+
+def main():
+    connect(use_gui=False)
+    with HideOutput():
+        pr2 = load_model(DRAKE_PR2_URDF, fixed_base=True)
+    test_repeated_confs(pr2)
+    print('Success!')
+    disconnect()
+
+
+if __name__ == '__main__':
+    main()
@@ -29,7 +29,7 @@ from motion_planners.utils import default_selector, irange
 #from motion_planners.tkinter.samplers import get_cost_fn
 from motion_planners.lazy_prm import ROADMAPS
 
-from pybullet_planning.pybullet_tools.retime import sample_curve
+from pybullet_planning.pybullet_tools.retime import sample_curve, CurveLookup
 
 BASE_LINK_NAME = 'base_link'
 BASE_JOINTS = ['x', 'y', 'theta']
@@ -345,10 +345,12 @@ def follow_curve(robot, joints, curve, goal_t=None, time_step=None, max_velociti
     if time_step is None:
         time_step = 10*get_time_step()
     #distance_fn = get_distance_fn(robot, joints, weights=None, norm=2)
-    distance_fn = get_duration_fn(robot, joints, velocities=max_velocities, norm=INF) # get_distance
+    #distance_fn = get_duration_fn(robot, joints, velocities=max_velocities, norm=INF) # get_distance
+    #closest_dist, closest_t = find_closest(positions, curve, t_range=(curve.x[0], goal_t), max_time=1e-1,
+    #                                       max_iterations=INF, distance_fn=distance_fn, verbose=True)
+    lookup = CurveLookup(curve, weights=1. / np.array(max_velocities))
     positions = np.array(get_joint_positions(robot, joints))
-    closest_dist, closest_t = find_closest(positions, curve, t_range=(curve.x[0], goal_t), max_time=1e-1,
-                                           max_iterations=INF, distance_fn=distance_fn, verbose=True)
+    closest_dist, closest_t = lookup.closest_time(positions, t_range=(curve.x[0], goal_t))
     print('Closest dist: {:.3f} | Closest time: {:.3f}'.format(closest_dist, closest_t))
     target_t = closest_t
     # TODO: condition based on closest_dist
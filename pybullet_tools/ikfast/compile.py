@@ -46,3 +46,24 @@ def compile_ikfast(module_name, cpp_filename, remove_build=False):
         print('\nikfast module {} imported failed'.format(module_name))
         raise e
     return True
+
+
+def build_ikfast(module_name, cpp_filename, build_dir, include_dirs=None):
+    # Builds the extension into build_dir without touching the current working directory
+    # The vendored ikfast.h files include "python2.7/Python.h", which is redirected to the running interpreter
+    shim_dir = os.path.join(build_dir, 'include')
+    shim_path = os.path.join(shim_dir, 'python2.7', 'Python.h')
+    if not os.path.exists(shim_path):
+        os.makedirs(os.path.dirname(shim_path))
+        with open(shim_path, 'w') as f:
+            f.write('#include <Python.h>\n')
+    include_dirs = [shim_dir, os.path.dirname(os.path.abspath(cpp_filename))] + list(include_dirs or [])
+    ikfast_module = Extension(module_name, sources=[os.path.abspath(cpp_filename)], include_dirs=include_dirs)
+    setup(name=module_name,
+          version='1.0',
+          description="ikfast module {}".format(module_name),
+          ext_modules=[ikfast_module],
+          script_args=['--quiet', 'build_ext', '--build-lib', build_dir,
+                       '--build-temp', os.path.join(build_dir, 'build')])
+    shutil.rmtree(os.path.join(build_dir, 'build'), ignore_errors=True)
+    return build_dir
@@ -1,6 +1,9 @@
 from __future__ import print_function
 
+import hashlib
 import importlib
+import shutil
+import tempfile
 import time
 import numpy as np
 import sys
@@ -11,31 +14,125 @@ sys.path.append(PARENT_DIR)
 
 from itertools import islice, chain
 
-from .utils import compute_inverse_kinematics, compute_forward_kinematics
+from .utils import compute_inverse_kinematics, compute_forward_kinematics, compute_batch_inverse_kinematics, \
+    tforms_from_poses, split_solutions, get_free_sampler
 from ..utils import get_link_pose, link_from_name, multiply, invert, parent_joint_from_link, parent_link_from_joint, \
-    prune_fixed_joints, joints_from_names, INF, get_difference_fn, \
+    prune_fixed_joints, joints_from_names, INF, get_batch_difference_fn, get_nearest_fn, get_batch_limits_fn, \
     get_joint_positions, get_min_limits, get_max_limits, interval_generator, elapsed_time, randomize, violates_limits, \
-    get_length, get_relative_pose, set_joint_positions, get_pose_distance, ConfSaver, \
+    get_length, get_relative_pose, set_joint_positions, get_pose_distance, ConfSaver, get_custom_limits, \
+    tform_from_pose, HideOutput, \
     sub_inverse_kinematics, set_configuration, wait_for_user, multiple_sub_inverse_kinematics, get_ordered_ancestors
 
 SETUP_FILENAME = 'setup.py'
+IKFAST_DIR = os.path.dirname(os.path.abspath(__file__))
+IKFAST_CACHE_DIR = os.environ.get('IKFAST_CACHE_DIR', os.path.join(
+    os.path.expanduser('~'), '.cache', 'pybullet_planning', 'ikfast'))
+# Set COMPILE_IKFAST=1 to compile missing modules on demand (otherwise only when called with build=True)
+COMPILE_IKFAST = os.environ.get('COMPILE_IKFAST', '0') != '0'
+
+# Source files that do not follow the <module_name>.cpp convention
+IKFAST_SOURCES = {
+    'pr2.ikLeft': 'pr2/left_arm_ik.cpp',
+    'pr2.ikRight': 'pr2/right_arm_ik.cpp',
+}
+
+IKFAST_MODULES = {} # module_name -> module or None (failed imports are also cached)
+IKFAST_BUILDS = set() # module_names that have already been compiled (or failed to compile)
 
 
 def get_module_name(ikfast_info):
     return 'ikfast.{}'.format(ikfast_info.module_name)
 
 
-def import_ikfast(ikfast_info):
+def get_ikfast_source(module_name):
+    relative_path = IKFAST_SOURCES.get(module_name, '{}.cpp'.format(module_name.replace('.', '/')))
+    return os.path.join(IKFAST_DIR, *relative_path.split('/'))
+
+
+def get_ikfast_cache_path(module_name):
+    # Keyed by the solver source, the shared header, and the interpreter ABI
+    cpp_path = get_ikfast_source(module_name)
+    hasher = hashlib.sha1()
+    for path in [cpp_path, os.path.join(os.path.dirname(cpp_path), 'ikfast.h')]:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                hasher.update(f.read())
+    hasher.update(sys.version.encode())
+    hasher.update(sys.platform.encode())
+    return os.path.join(IKFAST_CACHE_DIR, '{}_{}'.format(module_name, hasher.hexdigest()[:16]))
+
+
+def load_cached_ikfast(module_name):
+    from importlib.machinery import EXTENSION_SUFFIXES
+    from importlib.util import spec_from_file_location, module_from_spec
+    cache_path = get_ikfast_cache_path(module_name)
+    short_name = module_name.split('.')[-1]
+    for suffix in EXTENSION_SUFFIXES:
+        path = os.path.join(cache_path, short_name + suffix)
+        if os.path.exists(path):
+            full_name = 'ikfast.{}'.format(module_name)
+            spec = spec_from_file_location(full_name, path)
+            module = module_from_spec(spec)
+            spec.loader.exec_module(module)
+            sys.modules[full_name] = module
+            return module
+    return None
+
+
+def compile_cached_ikfast(module_name, verbose=False):
+    from .compile import build_ikfast
+    cpp_path = get_ikfast_source(module_name)
+    if not os.path.exists(cpp_path):
+        return None
+    cache_path = get_ikfast_cache_path(module_name)
+    if not os.path.exists(IKFAST_CACHE_DIR):
+        os.makedirs(IKFAST_CACHE_DIR)
+    if verbose:
+        print('Compiling IKFast module {} into {} (one-time)'.format(module_name, cache_path))
+    start_time = time.time()
+    # Builds in a private directory and then renames it so that concurrent processes never load a partial build
+    build_dir = tempfile.mkdtemp(prefix='{}_'.format(module_name), dir=IKFAST_CACHE_DIR)
+    try:
+        with HideOutput(enable=not verbose):
+            build_ikfast(module_name.split('.')[-1], cpp_path, build_dir)
+    except (SystemExit, Exception) as e: # distutils raises SystemExit on compiler errors
+        print('Failed to compile IKFast module {}: {}'.format(module_name, e))
+        shutil.rmtree(build_dir, ignore_errors=True)
+        return None
+    try:
+        os.rename(build_dir, cache_path)
+    except OSError: # Another process finished first
+        shutil.rmtree(build_dir, ignore_errors=True)
+    if verbose:
+        print('Compiled IKFast module {} in {:.3f} seconds'.format(module_name, elapsed_time(start_time)))
+    return load_cached_ikfast(module_name)
+
+
+def import_ikfast(ikfast_info, build=COMPILE_IKFAST, verbose=False):
     # https://stackoverflow.com/questions/67631/how-to-import-a-module-given-the-full-path
     #print(sys.modules['__main__'].__file__)
     #return importlib.import_module('pybullet_tools.ikfast.{}'.format(ikfast_info.module_name), package=None)
     #return importlib.import_module('{}'.format(ikfast_info.module_name), package='pybullet_tools.ikfast')
-    return importlib.import_module(get_module_name(ikfast_info), package=None)
-
-
-def is_ik_compiled(ikfast_info):
+    module_name = ikfast_info.module_name
+    if module_name not in IKFAST_MODULES:
+        try:
+            module = importlib.import_module(get_module_name(ikfast_info), package=None)
+        except ImportError:
+            module = load_cached_ikfast(module_name)
+        IKFAST_MODULES[module_name] = module
+    if (IKFAST_MODULES[module_name] is None) and build and (module_name not in IKFAST_BUILDS):
+        IKFAST_BUILDS.add(module_name)
+        IKFAST_MODULES[module_name] = compile_cached_ikfast(module_name, verbose=verbose)
+    module = IKFAST_MODULES[module_name]
+    if module is None:
+        raise ImportError('IKFast module {} is not compiled'.format(get_module_name(ikfast_info)))
+    return module
+
+
+def is_ik_compiled(ikfast_info, build=False, **kwargs):
+    # Only compiles a missing module when build=True
     try:
-        import_ikfast(ikfast_info)
+        import_ikfast(ikfast_info, build=build, **kwargs)
         return True
     except ImportError:
         return False
@@ -134,7 +231,7 @@ def ikfast_forward_kinematics(robot, ikfast_info, tool_link, conf=None, use_ikfa
 
 def ikfast_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target,
                               fixed_joints=[], max_attempts=INF, max_time=INF,
-                              norm=INF, max_distance=INF, **kwargs):
+                              norm=INF, max_distance=INF, free_sampler=None, **kwargs):
     assert (max_attempts < INF) or (max_time < INF)
     if max_distance is None:
         max_distance = INF
@@ -143,8 +240,9 @@ def ikfast_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target,
     ik_joints = get_ik_joints(robot, ikfast_info, tool_link)
     free_joints = joints_from_names(robot, ikfast_info.free_joints)
     base_from_ee = get_base_from_ee(robot, ikfast_info, tool_link, world_from_target)
-    difference_fn = get_difference_fn(robot, ik_joints)
-    current_conf = get_joint_positions(robot, ik_joints)
+    difference_fn = get_batch_difference_fn(robot, ik_joints)
+    limits_fn = get_batch_limits_fn(robot, ik_joints)
+    current_conf = np.array(get_joint_positions(robot, ik_joints))
     current_positions = get_joint_positions(robot, free_joints)
 
     # TODO: handle circular joints
@@ -152,20 +250,27 @@ def ikfast_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target,
     free_deltas = np.array([0. if joint in fixed_joints else max_distance for joint in free_joints])
     lower_limits = np.maximum(get_min_limits(robot, free_joints), current_positions - free_deltas)
     upper_limits = np.minimum(get_max_limits(robot, free_joints), current_positions + free_deltas)
-    generator = chain([current_positions], # TODO: sample from a truncated Gaussian nearby
-                      interval_generator(lower_limits, upper_limits))
+    if free_sampler is None:
+        free_sampler = get_free_sampler(ikfast_info)
+    generator = [current_positions]
+    if not np.equal(lower_limits, upper_limits).all():
+        generator = chain(generator, free_sampler.generator(base_from_ee, lower_limits, upper_limits))
     if max_attempts < INF:
         generator = islice(generator, max_attempts)
     start_time = time.time()
     for free_positions in generator:
         if max_time < elapsed_time(start_time):
             break
-        for conf in randomize(compute_inverse_kinematics(ikfast.get_ik, base_from_ee, free_positions)):
-            #solution(robot, ik_joints, conf, tool_link, world_from_target)
-            difference = difference_fn(current_conf, conf)
-            if not violates_limits(robot, ik_joints, conf) and (get_length(difference, norm=norm) <= max_distance):
-                #set_joint_positions(robot, ik_joints, conf)
-                yield conf
+        confs = np.reshape(compute_inverse_kinematics(ikfast.get_ik, base_from_ee, free_positions),
+                           (-1, len(ik_joints)))
+        #solution(robot, ik_joints, conf, tool_link, world_from_target)
+        distances = np.linalg.norm(difference_fn(current_conf, confs), ord=norm, axis=-1)
+        valid = ~limits_fn(confs) & (distances <= max_distance)
+        if np.any(valid):
+            free_sampler.record(base_from_ee, free_positions)
+        for index in randomize(np.flatnonzero(valid)):
+            #set_joint_positions(robot, ik_joints, conf)
+            yield confs[index].tolist()
 
 
 def closest_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target,
@@ -178,15 +283,82 @@ def closest_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target,
         generator = islice(generator, max_candidates)
     solutions = list(generator)
     # TODO: relative to joint limits
-    difference_fn = get_difference_fn(robot, ik_joints) # get_distance_fn
-    solutions = sorted(solutions, key=lambda q: get_length(difference_fn(q, current_conf), norm=norm))
+    nearest_fn = get_nearest_fn(robot, ik_joints, norm=norm)
+    order, distances = nearest_fn(current_conf, solutions, k=len(solutions))
+    solutions = [solutions[i] for i in order]
     if verbose:
-        min_distance = min([INF] + [get_length(difference_fn(q, current_conf), norm=norm) for q in solutions])
+        min_distance = min([INF] + list(distances))
         print('Identified {} IK solutions with minimum distance of {:.3f} in {:.3f} seconds'.format(
             len(solutions), min_distance, elapsed_time(start_time)))
     return iter(solutions)
 
 
+def ikfast_batch_inverse_kinematics(robot, ikfast_info, tool_link, world_from_targets,
+                                    free_positions=None, custom_limits={}):
+    """
+    Solves IK for many target poses and free joint samples in a single tight loop
+    :param world_from_targets: a sequence of target tool poses
+    :param free_positions: an array of shape (num_samples, num_free_joints) (defaults to the current values)
+    :return: an array of solutions within the joint limits and the target index of each solution
+    """
+    ikfast = import_ikfast(ikfast_info)
+    ik_joints = get_ik_joints(robot, ikfast_info, tool_link)
+    free_joints = joints_from_names(robot, ikfast_info.free_joints)
+    if free_positions is None:
+        free_positions = [get_joint_positions(robot, free_joints)] if free_joints else []
+    world_from_base = get_link_pose(robot, link_from_name(robot, ikfast_info.base_link))
+    tool_from_ee = get_relative_pose(robot, link_from_name(robot, ikfast_info.ee_link), tool_link)
+    base_from_ees = np.matmul(np.matmul(tform_from_pose(invert(world_from_base)), tforms_from_poses(world_from_targets)),
+                              tform_from_pose(tool_from_ee))
+    solutions, indices = compute_batch_inverse_kinematics(ikfast.get_ik, base_from_ees, free_positions,
+                                                          num_joints=len(ik_joints))
+    lower_limits, upper_limits = map(np.array, get_custom_limits(robot, ik_joints, custom_limits))
+    valid = np.all((lower_limits <= solutions) & (solutions <= upper_limits), axis=1)
+    return solutions[valid], indices[valid]
+
+
+
+def ikfast_cartesian_path(robot, ikfast_info, tool_link, waypoint_poses, fixed_joints=[], max_joint_step=np.pi/8,
+                          max_attempts=10, custom_limits={}, verbose=False):
+    """
+    Solves IK along a sequence of nearby tool poses, warm-starting each waypoint from the previous solution
+    All waypoints are first solved in one batch using the current free joint values, and waypoints without a
+    continuous solution are then resolved by sampling free joint values near the previous solution
+    :param max_joint_step: the maximum per-joint change between consecutive waypoints
+    :return: a list of configurations for the IK joints or None if the path is discontinuous
+    """
+    start_time = time.time()
+    ik_joints = get_ik_joints(robot, ikfast_info, tool_link)
+    difference_fn = get_batch_difference_fn(robot, ik_joints)
+    waypoint_poses = list(waypoint_poses)
+    solutions, indices = ikfast_batch_inverse_kinematics(robot, ikfast_info, tool_link, waypoint_poses,
+                                                         custom_limits=custom_limits)
+    candidates = split_solutions(solutions, indices, len(waypoint_poses))
+    path = []
+    conf = np.array(get_joint_positions(robot, ik_joints))
+    with ConfSaver(robot, joints=ik_joints):
+        for i, world_from_target in enumerate(waypoint_poses):
+            steps = np.max(np.abs(difference_fn(candidates[i], conf)), axis=-1) if len(candidates[i]) else [INF]
+            if np.min(steps) <= max_joint_step:
+                conf = conf + difference_fn(candidates[i][np.argmin(steps)], conf)
+            else:
+                set_joint_positions(robot, ik_joints, conf)
+                generator = ikfast_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target,
+                                                      fixed_joints=fixed_joints, max_attempts=max_attempts,
+                                                      norm=INF, max_distance=max_joint_step)
+                nearby_confs = np.reshape(list(generator), (-1, len(ik_joints)))
+                if len(nearby_confs) == 0:
+                    if verbose:
+                        print('Discontinuity at waypoint {}/{} after {:.3f} seconds'.format(
+                            i, len(waypoint_poses), elapsed_time(start_time)))
+                    return None
+                distances = np.max(np.abs(difference_fn(nearby_confs, conf)), axis=-1)
+                conf = conf + difference_fn(nearby_confs[np.argmin(distances)], conf)
+            path.append(conf.tolist())
+    if verbose:
+        print('Solved {} waypoints in {:.3f} seconds'.format(len(path), elapsed_time(start_time)))
+    return path
+
 ##################################################
 
 
@@ -207,6 +379,6 @@ def pybullet_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target
 
 def either_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target, fixed_joints=[],
                               use_pybullet=False, **kwargs):
-    if not use_pybullet and is_ik_compiled(ikfast_info):
+    if not use_pybullet and is_ik_compiled(ikfast_info, build=COMPILE_IKFAST):
         return closest_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target, fixed_joints=fixed_joints, **kwargs)
     return pybullet_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target, fixed_joints=[])
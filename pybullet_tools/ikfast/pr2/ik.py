@@ -1,12 +1,13 @@
-import random
 
 from ..utils import get_ik_limits, compute_forward_kinematics, compute_inverse_kinematics, select_solution, \
-    USE_ALL, USE_CURRENT
+    get_free_sampler, USE_ALL, USE_CURRENT
 from ...pr2_utils import PR2_TOOL_FRAMES, get_torso_arm_joints, get_gripper_link, get_arm_joints, side_from_arm
 from ...utils import multiply, get_link_pose, link_from_name, get_joint_positions, \
     joint_from_name, invert, get_custom_limits, all_between, sub_inverse_kinematics, set_joint_positions, \
-    get_joint_positions, pairwise_collision
+    get_joint_positions, pairwise_collision, plan_cartesian_motion, get_movable_joints, PI
 from ...ikfast.utils import IKFastInfo
+from ...ikfast.ikfast import import_ikfast, is_ik_compiled as is_ikfast_compiled, get_ik_joints, \
+    ikfast_cartesian_path, COMPILE_IKFAST
 #from ...ikfast.ikfast import closest_inverse_kinematics # TODO: use these functions instead
 
 # TODO: deprecate
@@ -42,32 +43,23 @@ def get_if_info(arm):
 #####################################
 
 def get_tool_pose(robot, arm):
-    from .ikLeft import leftFK
-    from .ikRight import rightFK
-    arm_fk = {'left': leftFK, 'right': rightFK}
+    fk_fn = import_ikfast(PR2_INFOS[arm]).get_fk
     # TODO: compute static transform from base_footprint -> base_link
     ik_joints = get_torso_arm_joints(robot, arm)
     conf = get_joint_positions(robot, ik_joints)
     assert len(conf) == 8
-    base_from_tool = compute_forward_kinematics(arm_fk[arm], conf)
+    base_from_tool = compute_forward_kinematics(fk_fn, conf)
     #quat = quat if quat.real >= 0 else -quat  # solves q and -q being same rotation
     world_from_base = get_link_pose(robot, link_from_name(robot, BASE_FRAME))
     return multiply(world_from_base, base_from_tool)
 
 #####################################
 
-def is_ik_compiled():
-    try:
-        from .ikLeft import leftIK
-        from .ikRight import rightIK
-        return True
-    except ImportError:
-        return False
+def is_ik_compiled(build=False):
+    return all(is_ikfast_compiled(info, build=build) for info in PR2_INFOS.values())
 
 def get_ik_generator(robot, arm, ik_pose, torso_limits=USE_ALL, upper_limits=USE_ALL, custom_limits={}):
-    from .ikLeft import leftIK
-    from .ikRight import rightIK
-    arm_ik = {'left': leftIK, 'right': rightIK}
+    ik_fn = import_ikfast(PR2_INFOS[arm]).get_ik
     world_from_base = get_link_pose(robot, link_from_name(robot, BASE_FRAME))
     base_from_ik = multiply(invert(world_from_base), ik_pose)
     sampled_joints = [joint_from_name(robot, name) for name in [TORSO_JOINT, UPPER_JOINT[arm]]]
@@ -75,10 +67,14 @@ def get_ik_generator(robot, arm, ik_pose, torso_limits=USE_ALL, upper_limits=USE
     arm_joints = get_torso_arm_joints(robot, arm)
 
     min_limits, max_limits = get_custom_limits(robot, arm_joints, custom_limits)
+    free_sampler = get_free_sampler(PR2_INFOS[arm])
+    free_generator = free_sampler.generator(base_from_ik, *zip(*sampled_limits))
     while True:
-        sampled_values = [random.uniform(*limits) for limits in sampled_limits]
-        confs = compute_inverse_kinematics(arm_ik[arm], base_from_ik, sampled_values)
+        sampled_values = list(next(free_generator))
+        confs = compute_inverse_kinematics(ik_fn, base_from_ik, sampled_values)
         solutions = [q for q in confs if all_between(min_limits, q, max_limits)]
+        if solutions:
+            free_sampler.record(base_from_ik, sampled_values)
         # TODO: return just the closest solution
         #print(len(confs), len(solutions))
         yield solutions
@@ -105,20 +101,51 @@ def sample_tool_ik(robot, arm, tool_pose, nearby_conf=USE_ALL, max_attempts=25,
             break
     return None
 
-def pr2_inverse_kinematics(robot, arm, gripper_pose, obstacles=[], custom_limits={}, use_pybullet=False, **kwargs):
+def pr2_inverse_kinematics(robot, arm, gripper_pose, obstacles=[], custom_limits={}, use_pybullet=False,
+                           ik_cache=None, **kwargs):
     arm_link = get_gripper_link(robot, arm)
     arm_joints = get_arm_joints(robot, arm)
-    if not use_pybullet and is_ik_compiled():
+    if not use_pybullet and is_ik_compiled(build=COMPILE_IKFAST):
         ik_joints = get_torso_arm_joints(robot, arm)
-        torso_arm_conf = sample_tool_ik(robot, arm, gripper_pose, custom_limits=custom_limits,
-                                        torso_limits=USE_CURRENT, **kwargs)
-        if torso_arm_conf is None:
-            return None
-        set_joint_positions(robot, ik_joints, torso_arm_conf)
+        def ik_fn():
+            torso_arm_conf = sample_tool_ik(robot, arm, gripper_pose, custom_limits=custom_limits,
+                                            torso_limits=USE_CURRENT, **kwargs)
+            if torso_arm_conf is not None:
+                set_joint_positions(robot, ik_joints, torso_arm_conf)
+            return torso_arm_conf
     else:
-        arm_conf = sub_inverse_kinematics(robot, arm_joints[0], arm_link, gripper_pose, custom_limits=custom_limits)
-        if arm_conf is None:
-            return None
+        ik_fn = lambda: sub_inverse_kinematics(robot, arm_joints[0], arm_link, gripper_pose,
+                                               custom_limits=custom_limits)
+    if ik_cache is None:
+        conf = ik_fn()
+    else:
+        test_fn = lambda q: not any(pairwise_collision(robot, b) for b in obstacles)
+        # Only the iterative pybullet solver benefits from being seeded with a nearby cached solution
+        conf = ik_cache.solve(robot, arm_joints, arm_link, gripper_pose, ik_fn, warm_start=use_pybullet,
+                              test_fn=test_fn, group=arm,
+                              base_link=link_from_name(robot, BASE_FRAME),
+                              free_joints=[joint_from_name(robot, TORSO_JOINT)])
+    if conf is None:
+        return None
     if any(pairwise_collision(robot, b) for b in obstacles):
         return None
     return get_joint_positions(robot, arm_joints)
+
+def pr2_cartesian_path(robot, arm, gripper_poses, custom_limits={}, use_pybullet=False, max_joint_step=PI/8,
+                       **kwargs):
+    # Arm configurations that move the gripper through gripper_poses while holding the torso fixed
+    arm_link = get_gripper_link(robot, arm)
+    arm_joints = get_arm_joints(robot, arm)
+    if not use_pybullet and is_ik_compiled(build=COMPILE_IKFAST):
+        ik_joints = get_ik_joints(robot, PR2_INFOS[arm], arm_link)
+        path = ikfast_cartesian_path(robot, PR2_INFOS[arm], arm_link, gripper_poses,
+                                     fixed_joints=[joint_from_name(robot, TORSO_JOINT)],
+                                     max_joint_step=max_joint_step, custom_limits=custom_limits, **kwargs)
+    else:
+        ik_joints = get_movable_joints(robot)
+        path = plan_cartesian_motion(robot, arm_joints[0], arm_link, gripper_poses, custom_limits=custom_limits,
+                                     max_joint_step=max_joint_step)
+    if path is None:
+        return None
+    indices = [ik_joints.index(joint) for joint in arm_joints]
+    return [tuple(conf[index] for index in indices) for conf in path]
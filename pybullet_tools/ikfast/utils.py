@@ -3,7 +3,7 @@ from collections import namedtuple
 import numpy as np
 
 from ..utils import matrix_from_quat, point_from_pose, quat_from_pose, quat_from_matrix, \
-    get_joint_limits, get_joint_position, get_joint_positions, get_distance
+    get_joint_limits, get_joint_position, get_joint_positions
 
 # TODO: lookup robot & tool in dictionary and use if exists
 
@@ -32,6 +32,48 @@ def compute_inverse_kinematics(ik_fn, pose, sampled=[]):
     return solutions
 
 
+def tforms_from_poses(poses):
+    # Vectorized tform_from_pose for a sequence of poses
+    points = np.array([point for point, _ in poses], dtype=float).reshape(-1, 3)
+    x, y, z, w = np.array([quat for _, quat in poses], dtype=float).reshape(-1, 4).T
+    tforms = np.zeros((len(points), 4, 4))
+    tforms[:, 0, :3] = np.stack([1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)], axis=-1)
+    tforms[:, 1, :3] = np.stack([2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)], axis=-1)
+    tforms[:, 2, :3] = np.stack([2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)], axis=-1)
+    tforms[:, :3, 3] = points
+    tforms[:, 3, 3] = 1.
+    return tforms
+
+
+def compute_batch_inverse_kinematics(ik_fn, tforms, sampled=[], num_joints=None):
+    """
+    Calls ik_fn for every combination of target transform and free joint sample
+    :param tforms: an array of shape (num_poses, 4, 4) of base_from_ee transforms
+    :param sampled: an array of shape (num_samples, num_free_joints) of free joint values
+    :return: an array of solutions of shape (num_solutions, num_joints) and the tform index of each solution
+    """
+    # Convert once to the nested lists expected by the IKFast bindings
+    rotations = np.array(tforms)[:, :3, :3].tolist()
+    positions = np.array(tforms)[:, :3, 3].tolist()
+    sampled = [list(map(float, free)) for free in sampled]
+    solutions, indices = [], []
+    for index, (rot, pos) in enumerate(zip(rotations, positions)):
+        for free in sampled or [None]:
+            confs = ik_fn(rot, pos) if free is None else ik_fn(rot, pos, free)
+            if confs:
+                solutions.extend(confs)
+                indices.extend(len(confs)*[index])
+    if num_joints is None:
+        num_joints = len(solutions[0]) if solutions else 0
+    return np.array(solutions, dtype=float).reshape(-1, num_joints), np.array(indices, dtype=int)
+
+
+def split_solutions(solutions, indices, num_poses):
+    # Converts the flat batch representation into a ragged list with one array per target pose
+    boundaries = np.searchsorted(indices, np.arange(1, num_poses))
+    return np.split(solutions, boundaries)
+
+
 def get_ik_limits(robot, joint, limits=USE_ALL):
     if limits is USE_ALL:
         return get_joint_limits(robot, joint)
@@ -41,8 +83,8 @@ def get_ik_limits(robot, joint, limits=USE_ALL):
     return limits
 
 
-def select_solution(body, joints, solutions, nearby_conf=USE_ALL, **kwargs):
-    if not solutions:
+def select_solution(body, joints, solutions, nearby_conf=USE_ALL, norm=2):
+    if len(solutions) == 0:
         return None
     if nearby_conf is USE_ALL:
         return random.choice(solutions)
@@ -50,4 +92,96 @@ def select_solution(body, joints, solutions, nearby_conf=USE_ALL, **kwargs):
         nearby_conf = get_joint_positions(body, joints)
     # TODO: sort by distance before collision checking
     # TODO: search over neighborhood of sampled joints when nearby_conf != None
-    return min(solutions, key=lambda conf: get_distance(nearby_conf, conf, **kwargs))
+    distances = np.linalg.norm(np.subtract(solutions, nearby_conf), ord=norm, axis=-1)
+    return solutions[np.argmin(distances)]
+
+##################################################
+
+HALTON_PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29]
+
+
+def halton_points(indices, d):
+    # Radical inverses of the given indices in the first d prime bases
+    indices = np.array(indices, dtype=int)
+    points = np.zeros((len(indices), d))
+    for k, base in enumerate(HALTON_PRIMES[:d]):
+        remaining = indices.copy()
+        fraction = 1. / base
+        while np.any(remaining > 0):
+            points[:, k] += fraction * (remaining % base)
+            remaining //= base
+            fraction /= base
+    return points
+
+
+class FreeJointSampler(object):
+    # Proposes IKFast free joint values, first near the values that solved nearby targets and then
+    # from a randomly shifted Halton sequence over the free joint limits
+
+    def __init__(self, num_free, max_history=1000, num_neighbors=5, radius=0.25, angle_weight=0.1,
+                 scale=0.05, reuse_fraction=0.5):
+        self.num_free = num_free
+        self.max_history = max_history
+        self.num_neighbors = num_neighbors
+        self.radius = radius # Maximum target distance (meters, with angle_weight meters per radian)
+        self.angle_weight = angle_weight
+        self.scale = scale # Standard deviation as a fraction of the free joint ranges
+        self.reuse_fraction = reuse_fraction
+        self.points = np.zeros((max_history, 3))
+        self.quats = np.zeros((max_history, 4))
+        self.values = np.zeros((max_history, num_free))
+        self.num_recorded = 0
+        self.halton_index = 1
+    def __len__(self):
+        return min(self.num_recorded, self.max_history)
+
+    def record(self, base_from_target, free_positions):
+        # Overwrites the oldest entries once max_history is reached
+        index = self.num_recorded % self.max_history
+        point, quat = base_from_target
+        self.points[index] = point
+        self.quats[index] = quat
+        self.values[index] = free_positions
+        self.num_recorded += 1
+    def get_neighbors(self, base_from_target):
+        # Indices of the recorded targets within radius sorted by distance
+        num = len(self)
+        if num == 0:
+            return []
+        point, quat = base_from_target
+        angles = 2*np.arccos(np.clip(np.abs(self.quats[:num].dot(quat)), 0., 1.))
+        distances = np.linalg.norm(self.points[:num] - point, axis=-1) + self.angle_weight*angles
+        order = np.argsort(distances, kind='stable')[:self.num_neighbors]
+        return [i for i in order if distances[i] <= self.radius]
+
+    def sample_halton(self, lower, upper, offset):
+        [weights] = halton_points([self.halton_index], self.num_free)
+        self.halton_index += 1
+        return lower + ((weights + offset) % 1.)*(upper - lower)
+    def generator(self, base_from_target, lower, upper):
+        lower, upper = np.array(lower, dtype=float), np.array(upper, dtype=float)
+        offset = np.random.uniform(size=self.num_free)
+        neighbors = self.get_neighbors(base_from_target)
+        # The recorded values themselves, then truncated Gaussians around them
+        for index in neighbors:
+            yield np.clip(self.values[index], lower, upper)
+        std = self.scale*(upper - lower)
+        while True:
+            if neighbors and (random.random() < self.reuse_fraction):
+                mean = self.values[random.choice(neighbors)]
+                yield np.clip(np.random.normal(mean, std), lower, upper)
+            else:
+                yield self.sample_halton(lower, upper, offset)
+    def __repr__(self):
+        return '{}(num_free={}, recorded={})'.format(self.__class__.__name__, self.num_free, len(self))
+
+
+FREE_SAMPLERS = {}
+
+
+def get_free_sampler(ikfast_info, **kwargs):
+    # Shared across calls so that successful free joint values are reused for later targets
+    key = ikfast_info.module_name
+    if key not in FREE_SAMPLERS:
+        FREE_SAMPLERS[key] = FreeJointSampler(len(ikfast_info.free_joints), **kwargs)
+    return FREE_SAMPLERS[key]
@@ -0,0 +1,203 @@
+import numpy as np
+
+from .utils import BASE_LINK, CIRCULAR_LIMITS, get_link_ancestors, get_link_parent, get_link_pose, \
+    get_joint_info, get_joint_type, is_movable, is_circular, get_custom_limits, get_joint_positions, \
+    set_joint_positions, prune_fixed_joints, ConfSaver, tform_from_pose, invert, multiply, get_nearest_fn, wrap_angle
+
+import pybullet as p
+
+# Vectorized forward kinematics and damped least-squares inverse kinematics
+# TODO: spherical and planar joints
+
+def skew(vector):
+    x, y, z = vector
+    return np.array([[0., -z, y],
+                     [z, 0., -x],
+                     [-y, x, 0.]])
+
+
+def rotations_from_axis_angles(axis, angles):
+    # Rodrigues' formula for a single unit axis and a batch of angles
+    angles = np.array(angles)[..., None, None]
+    K = skew(axis)
+    return np.eye(3) + np.sin(angles)*K + (1 - np.cos(angles))*K.dot(K)
+
+
+def rotation_errors(target_rotations, rotations):
+    # Axis-angle vectors that rotate rotations onto target_rotations (expressed in the base frame)
+    error_rotations = np.matmul(target_rotations, np.swapaxes(rotations, -1, -2))
+    vectors = 0.5*np.stack([error_rotations[..., 2, 1] - error_rotations[..., 1, 2],
+                            error_rotations[..., 0, 2] - error_rotations[..., 2, 0],
+                            error_rotations[..., 1, 0] - error_rotations[..., 0, 1]], axis=-1)
+    sines = np.linalg.norm(vectors, axis=-1)
+    cosines = 0.5*(np.trace(error_rotations, axis1=-2, axis2=-1) - 1)
+    angles = np.arctan2(sines, cosines)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scales = np.where(sines > 1e-9, angles / sines, 1.)
+    return scales[..., None]*vectors
+
+
+class KinematicChain(object):
+    # Serial chain from the parent link of first_joint to tool_link evaluated in NumPy for batches of configurations
+
+    def __init__(self, body, tool_link, first_joint=None, custom_limits={}):
+        self.body = body
+        self.tool_link = tool_link
+        links = get_link_ancestors(body, tool_link)[1:] + [tool_link]
+        if first_joint is not None:
+            links = links[links.index(first_joint):]
+        self.base_link = BASE_LINK if not links else get_link_parent(body, links[0])
+        self.links = links
+        self.joints = prune_fixed_joints(body, links)
+        self.lower_limits, self.upper_limits = map(np.array, get_custom_limits(body, self.joints, custom_limits))
+        self.circular = np.array([is_circular(body, joint) for joint in self.joints], dtype=bool)
+        self.wrapped = self.circular & np.isinf(self.lower_limits) & np.isinf(self.upper_limits)
+
+        # Link transforms relative to their parent at the zero configuration
+        self.local_tforms = []
+        self.joint_types = []
+        self.axes = []
+        with ConfSaver(body, joints=self.joints):
+            set_joint_positions(body, self.joints, np.zeros(len(self.joints)))
+            for link in links:
+                parent_pose = get_link_pose(body, get_link_parent(body, link))
+                local_pose = multiply(invert(parent_pose), get_link_pose(body, link))
+                self.local_tforms.append(tform_from_pose(local_pose))
+                self.joint_types.append(get_joint_type(body, link))
+                axis = np.array(get_joint_info(body, link).jointAxis, dtype=float)
+                self.axes.append(axis / np.linalg.norm(axis) if is_movable(body, link) else axis)
+    @property
+    def dofs(self):
+        return len(self.joints)
+    def get_base_pose(self):
+        return get_link_pose(self.body, self.base_link)
+    def get_conf(self):
+        return np.array(get_joint_positions(self.body, self.joints))
+
+    def compute_frames(self, confs):
+        # Returns the base_from_link transforms of shape (num_confs, num_links, 4, 4)
+        confs = np.array(confs, dtype=float).reshape(-1, self.dofs)
+        tforms = np.tile(np.eye(4), (len(confs), 1, 1))
+        frames = []
+        index = 0
+        for local_tform, joint_type, axis in zip(self.local_tforms, self.joint_types, self.axes):
+            tforms = np.matmul(tforms, local_tform)
+            if joint_type != p.JOINT_FIXED:
+                motion = np.tile(np.eye(4), (len(confs), 1, 1))
+                if joint_type == p.JOINT_PRISMATIC:
+                    motion[:, :3, 3] = confs[:, index, None]*axis
+                else:
+                    motion[:, :3, :3] = rotations_from_axis_angles(axis, confs[:, index])
+                tforms = np.matmul(tforms, motion)
+                index += 1
+            frames.append(tforms)
+        return np.stack(frames, axis=1)
+    def forward_kinematics(self, confs):
+        # Returns the base_from_tool transforms of shape (num_confs, 4, 4)
+        return self.compute_frames(confs)[:, -1]
+    def compute_jacobians(self, confs):
+        # Geometric Jacobians (linear; angular) in the base frame of shape (num_confs, 6, dofs)
+        frames = self.compute_frames(confs)
+        tool_points = frames[:, -1, :3, 3]
+        jacobians = np.zeros((len(frames), 6, self.dofs))
+        index = 0
+        for i, (joint_type, axis) in enumerate(zip(self.joint_types, self.axes)):
+            if joint_type == p.JOINT_FIXED:
+                continue
+            world_axes = frames[:, i, :3, :3].dot(axis)
+            if joint_type == p.JOINT_PRISMATIC:
+                jacobians[:, :3, index] = world_axes
+            else:
+                jacobians[:, :3, index] = np.cross(world_axes, tool_points - frames[:, i, :3, 3])
+                jacobians[:, 3:, index] = world_axes
+            index += 1
+        return frames[:, -1], jacobians
+
+    def sample_confs(self, num_samples):
+        lower_limits = np.where(self.wrapped, CIRCULAR_LIMITS[0], self.lower_limits)
+        upper_limits = np.where(self.wrapped, CIRCULAR_LIMITS[1], self.upper_limits)
+        return np.random.uniform(lower_limits, upper_limits, size=(num_samples, self.dofs))
+    def clip_confs(self, confs, wrap=True):
+        # Clips the bounded joints to their limits and wraps the unbounded circular joints
+        confs = np.clip(confs, self.lower_limits, self.upper_limits)
+        if wrap:
+            confs[..., self.wrapped] = wrap_angle(confs[..., self.wrapped])
+        return confs
+    def compute_errors(self, target_tform, tforms):
+        position_errors = target_tform[:3, 3] - tforms[:, :3, 3]
+        orientation_errors = rotation_errors(target_tform[:3, :3], tforms[:, :3, :3])
+        return np.concatenate([position_errors, orientation_errors], axis=-1)
+
+    def solve(self, base_from_target, seed_confs, max_iterations=100, pos_tolerance=1e-4, ori_tolerance=1e-3,
+              damping=1e-2, min_damping=1e-6, max_step=0.5, rest_conf=None, null_space_gain=0.1):
+        """
+        Levenberg-Marquardt damped least-squares IK run simultaneously from many seeds
+        :param base_from_target: the target tool pose in the frame of base_link
+        :param seed_confs: an array of shape (num_seeds, dofs)
+        :param rest_conf: the configuration that the null-space bias attracts towards (defaults to the limit centers)
+        :return: an array of the converged configurations
+        """
+        target_tform = tform_from_pose(base_from_target)
+        confs = self.clip_confs(np.array(seed_confs, dtype=float).reshape(-1, self.dofs))
+        if rest_conf is None:
+            with np.errstate(invalid='ignore'):
+                rest_conf = np.where(self.circular, 0., (self.lower_limits + self.upper_limits) / 2.)
+        dampings = damping*np.ones(len(confs))
+        identity = np.eye(self.dofs)
+
+        tforms, jacobians = self.compute_jacobians(confs)
+        errors = self.compute_errors(target_tform, tforms)
+        costs = np.sum(errors**2, axis=-1)
+        for iteration in range(max_iterations):
+            converged = (np.linalg.norm(errors[:, :3], axis=-1) <= pos_tolerance) & \
+                        (np.linalg.norm(errors[:, 3:], axis=-1) <= ori_tolerance)
+            if np.all(converged):
+                break
+            jacobians_t = np.swapaxes(jacobians, -1, -2)
+            systems = np.matmul(jacobians, jacobians_t) + (dampings**2)[:, None, None]*np.eye(6)
+            pseudo_inverses = np.matmul(jacobians_t, np.linalg.inv(systems))
+            steps = np.matmul(pseudo_inverses, errors[..., None])[..., 0]
+            null_projections = identity - np.matmul(pseudo_inverses, jacobians)
+            steps += null_space_gain*np.matmul(null_projections, (rest_conf - confs)[..., None])[..., 0]
+            scales = np.minimum(1., max_step / np.maximum(np.max(np.abs(steps), axis=-1), 1e-12))
+            steps *= scales[:, None]
+            steps[converged] = 0.
+
+            # Iterates are wrapped only upon returning so that the null-space bias towards rest_conf is continuous
+            new_confs = self.clip_confs(confs + steps, wrap=False)
+            new_tforms, new_jacobians = self.compute_jacobians(new_confs)
+            new_errors = self.compute_errors(target_tform, new_tforms)
+            new_costs = np.sum(new_errors**2, axis=-1)
+            improved = (new_costs < costs) & ~converged
+            confs[improved] = new_confs[improved]
+            jacobians[improved] = new_jacobians[improved]
+            errors[improved] = new_errors[improved]
+            costs[improved] = new_costs[improved]
+            dampings = np.where(improved, np.maximum(dampings / 2., min_damping), 4*dampings)
+        converged = (np.linalg.norm(errors[:, :3], axis=-1) <= pos_tolerance) & \
+                    (np.linalg.norm(errors[:, 3:], axis=-1) <= ori_tolerance)
+        return self.clip_confs(confs[converged])
+    def __repr__(self):
+        return '{}(body={}, base_link={}, tool_link={}, dofs={})'.format(
+            self.__class__.__name__, self.body, self.base_link, self.tool_link, self.dofs)
+
+
+def jacobian_inverse_kinematics(body, tool_link, world_from_target, first_joint=None, chain=None,
+                                num_seeds=32, custom_limits={}, **kwargs):
+    """
+    Solves IK from the current configuration and num_seeds random seeds and assigns the closest solution
+    :return: the solution for the chain joints that is closest to the current configuration or None
+    """
+    if chain is None:
+        chain = KinematicChain(body, tool_link, first_joint=first_joint, custom_limits=custom_limits)
+    base_from_target = multiply(invert(chain.get_base_pose()), world_from_target)
+    current_conf = chain.get_conf()
+    seed_confs = np.vstack([current_conf, chain.sample_confs(num_seeds)])
+    solutions = chain.solve(base_from_target, seed_confs, **kwargs)
+    if len(solutions) == 0:
+        return None
+    nearest_fn = get_nearest_fn(body, chain.joints)
+    [index], _ = nearest_fn(current_conf, solutions)
+    conf = solutions[index]
+    set_joint_positions(body, chain.joints, conf)
+    return conf
@@ -8,7 +8,8 @@ from .utils import get_pose, set_pose, get_movable_joints, \
     enable_gravity, get_refine_fn, wait_for_duration, link_from_name, get_body_name, sample_placement, \
     end_effector_from_body, approach_from_grasp, plan_joint_motion, GraspInfo, Pose, INF, Point, \
     inverse_kinematics, pairwise_collision, remove_fixed_constraint, Attachment, get_sample_fn, \
-    step_simulation, refine_path, plan_direct_joint_motion, get_joint_positions, dump_world, wait_if_gui, flatten
+    step_simulation, refine_path, plan_direct_joint_motion, get_joint_positions, dump_world, wait_if_gui, flatten, \
+    IKCache
 
 # TODO: deprecate
 
@@ -227,17 +228,28 @@ def get_stable_gen(fixed=[]):
     return gen
 
 
-def get_ik_fn(robot, fixed=[], teleport=False, num_attempts=10):
+def get_ik_fn(robot, fixed=[], teleport=False, num_attempts=10, cache=False):
     movable_joints = get_movable_joints(robot)
     sample_fn = get_sample_fn(robot, movable_joints)
+    ik_cache = IKCache() if cache else None
+
+    def ik_fn(link, target_pose, obstacles, warm_start=False):
+        if ik_cache is None:
+            return inverse_kinematics(robot, link, target_pose)
+        test_fn = lambda q: not any(pairwise_collision(robot, b) for b in obstacles)
+        return ik_cache.solve(robot, movable_joints, link, target_pose,
+                              lambda: inverse_kinematics(robot, link, target_pose),
+                              warm_start=warm_start, test_fn=test_fn)
+
     def fn(body, pose, grasp):
         obstacles = [body] + fixed
         gripper_pose = end_effector_from_body(pose.pose, grasp.grasp_pose)
         approach_pose = approach_from_grasp(grasp.approach_pose, gripper_pose)
-        for _ in range(num_attempts):
+        for attempt in range(num_attempts):
             set_joint_positions(robot, movable_joints, sample_fn()) # Random seed
             # TODO: multiple attempts?
-            q_approach = inverse_kinematics(robot, grasp.link, approach_pose)
+            warm_start = (attempt == 0) and (ik_cache is not None) and (len(ik_cache) != 0)
+            q_approach = ik_fn(grasp.link, approach_pose, obstacles, warm_start=warm_start)
             if (q_approach is None) or any(pairwise_collision(robot, b) for b in obstacles):
                 continue
             conf = BodyConf(robot, q_approach)
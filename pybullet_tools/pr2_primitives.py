@@ -8,13 +8,16 @@ from itertools import islice, count
 
 import numpy as np
 
-from .ikfast.pr2.ik import is_ik_compiled, pr2_inverse_kinematics
+from .ikfast.pr2.ik import is_ik_compiled, pr2_inverse_kinematics, pr2_cartesian_path
+from .ikfast.ikfast import COMPILE_IKFAST
 from .ikfast.utils import USE_CURRENT, USE_ALL
 from .pr2_problems import get_fixed_bodies
 from .pr2_utils import TOP_HOLDING_LEFT_ARM, SIDE_HOLDING_LEFT_ARM, GET_GRASPS, get_gripper_joints, \
     get_carry_conf, get_top_grasps, get_side_grasps, open_arm, arm_conf, get_gripper_link, get_arm_joints, \
     learned_pose_generator, PR2_TOOL_FRAMES, get_x_presses, PR2_GROUPS, joints_from_names, \
-    is_drake_pr2, get_group_joints, get_group_conf, compute_grasp_width, PR2_GRIPPER_ROOTS
+    is_drake_pr2, get_group_joints, get_group_conf, compute_grasp_width, PR2_GRIPPER_ROOTS, is_gripper_reachable
+from .retime import retime_multi_trajectory, instantaneous_retime_path, create_trajectory_record, \
+    write_trajectories, read_trajectories
 from .utils import invert, multiply, get_name, set_pose, get_link_pose, is_placement, \
     pairwise_collision, set_joint_positions, get_joint_positions, sample_placement, get_pose, waypoints_from_path, \
     unit_quat, plan_base_motion, plan_joint_motion, base_values_from_pose, pose_from_base_values, \
@@ -24,7 +27,8 @@ from .utils import invert, multiply, get_name, set_pose, get_link_pose, is_place
     add_segments, get_max_limit, link_from_name, BodySaver, get_aabb, Attachment, interpolate_poses, \
     plan_direct_joint_motion, has_gui, create_attachment, wait_for_duration, get_extend_fn, set_renderer, \
     get_custom_limits, all_between, get_unit_vector, wait_if_gui, \
-    set_base_values, euler_from_quat, INF, elapsed_time, get_moving_links, flatten_links, get_relative_pose
+    set_base_values, euler_from_quat, INF, elapsed_time, get_moving_links, flatten_links, get_relative_pose, IKCache, \
+    get_collision_fn, safe_zip
 
 BASE_EXTENT = 3.5 # 2.5
 BASE_LIMITS = (-BASE_EXTENT*np.ones(2), BASE_EXTENT*np.ones(2))
@@ -190,6 +194,71 @@ class Trajectory(Command):
 def create_trajectory(robot, joints, path):
     return Trajectory(Conf(robot, joints, q) for q in path)
 
+def synchronize_trajectories(trajectories, **kwargs):
+    """
+    Retimes trajectories of different bodies or joint groups (such as both arms and the torso) to execute concurrently
+    :return: a list of trajectories that all have the same length and their shared time_from_starts
+    """
+    groups = []
+    paths = []
+    for trajectory in trajectories:
+        conf = trajectory.path[0]
+        assert isinstance(conf, Conf) # TODO: base poses
+        groups.append((conf.body, conf.joints))
+        paths.append([conf.values for conf in trajectory.path])
+    group_paths, time_from_starts = retime_multi_trajectory(groups, paths, **kwargs)
+    return [create_trajectory(body, joints, path) for (body, joints), path in safe_zip(groups, group_paths)], \
+           time_from_starts
+
+class RecordedTrajectory(Command):
+    # Replays a TrajectoryRecord, such as a memory-mapped one from read_trajectories
+    def __init__(self, record):
+        self.record = record
+    @property
+    def body(self):
+        return self.record.body
+    @property
+    def joints(self):
+        return self.record.joints
+    def apply(self, state, sample=1):
+        for positions in self.record.positions[::sample]:
+            set_joint_positions(self.body, self.joints, positions)
+            yield
+    def control(self, dt=0, **kwargs):
+        for positions in self.record.positions:
+            for _ in joint_controller_hold(self.body, self.joints, positions):
+                step_simulation()
+                time.sleep(dt)
+    def iterate(self):
+        for positions in self.record.positions:
+            yield Conf(self.body, self.joints, positions)
+    def __repr__(self):
+        return 'r({},{})'.format(len(self.joints), len(self.record.times))
+
+def record_trajectory(trajectory, **kwargs):
+    conf = trajectory.path[0]
+    assert isinstance(conf, Conf) # TODO: base poses
+    path = [conf.values for conf in trajectory.path]
+    time_from_starts = instantaneous_retime_path(conf.body, conf.joints, path, **kwargs)
+    return create_trajectory_record(conf.body, conf.joints, path, time_from_starts)
+
+def write_commands(filename, commands, **kwargs):
+    """
+    Writes the trajectories within commands to a binary file that read_commands memory-maps
+    Other commands, such as gripper commands and attachments, are not recorded
+    """
+    records = []
+    for command in commands:
+        for subcommand in (command.commands if isinstance(command, Commands) else [command]):
+            if isinstance(subcommand, Trajectory):
+                records.append(record_trajectory(subcommand, **kwargs))
+            elif isinstance(subcommand, RecordedTrajectory):
+                records.append(subcommand.record)
+    return write_trajectories(filename, records)
+
+def read_commands(filename, **kwargs):
+    return [RecordedTrajectory(record) for record in read_trajectories(filename, **kwargs)]
+
 ##################################################
 
 class GripperCommand(Command):
@@ -434,10 +503,12 @@ def get_ir_sampler(problem, custom_limits={}, max_attempts=25, collisions=True,
 
 ##################################################
 
-def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False):
+def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False, cache=False, reachability=False,
+              cartesian=False):
     robot = problem.robot
     obstacles = problem.fixed if collisions else []
-    if is_ik_compiled():
+    ik_cache = IKCache() if cache else None
+    if is_ik_compiled(build=COMPILE_IKFAST):
         print('Using ikfast for inverse kinematics')
     else:
         print('Using pybullet for inverse kinematics')
@@ -454,9 +525,13 @@ def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False):
         #sample_fn = get_sample_fn(robot, arm_joints)
         pose.assign()
         base_conf.assign()
+        if reachability and not all(is_gripper_reachable(robot, arm, target_pose)
+                                    for target_pose in [gripper_pose, approach_pose]):
+            return None
         open_arm(robot, arm)
         set_joint_positions(robot, arm_joints, default_conf) # default_conf | sample_fn()
-        grasp_conf = pr2_inverse_kinematics(robot, arm, gripper_pose, custom_limits=custom_limits) #, upper_limits=USE_CURRENT)
+        grasp_conf = pr2_inverse_kinematics(robot, arm, gripper_pose, custom_limits=custom_limits,
+                                            ik_cache=ik_cache) #, upper_limits=USE_CURRENT)
                                             #nearby_conf=USE_CURRENT) # upper_limits=USE_CURRENT,
         if (grasp_conf is None) or any(pairwise_collision(robot, b) for b in obstacles): # [obj]
             #print('Grasp IK failure', grasp_conf)
@@ -466,7 +541,16 @@ def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False):
             return None
         #approach_conf = pr2_inverse_kinematics(robot, arm, approach_pose, custom_limits=custom_limits,
         #                                       upper_limits=USE_CURRENT, nearby_conf=USE_CURRENT)
-        approach_conf = sub_inverse_kinematics(robot, arm_joints[0], arm_link, approach_pose, custom_limits=custom_limits)
+        if cartesian:
+            # Straight-line retreat from the grasp, warm-starting each waypoint from the previous one
+            retreat_path = pr2_cartesian_path(robot, arm, interpolate_poses(gripper_pose, approach_pose),
+                                              custom_limits=custom_limits)
+            approach_conf = None if retreat_path is None else retreat_path[-1]
+            if approach_conf is not None:
+                set_joint_positions(robot, arm_joints, approach_conf)
+        else:
+            approach_conf = sub_inverse_kinematics(robot, arm_joints[0], arm_link, approach_pose,
+                                                   custom_limits=custom_limits)
         if (approach_conf is None) or any(pairwise_collision(robot, b) for b in obstacles + [obj]):
             #print('Approach IK failure', approach_conf)
             #wait_if_gui()
@@ -478,9 +562,18 @@ def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False):
             path = [default_conf, approach_conf, grasp_conf]
         else:
             resolutions = 0.05**np.ones(len(arm_joints))
-            grasp_path = plan_direct_joint_motion(robot, arm_joints, grasp_conf, attachments=attachments.values(),
-                                                  obstacles=approach_obstacles, self_collisions=SELF_COLLISIONS,
-                                                  custom_limits=custom_limits, resolutions=resolutions/2.)
+            if cartesian:
+                grasp_path = retreat_path[::-1]
+                collision_fn = get_collision_fn(robot, arm_joints, obstacles=approach_obstacles,
+                                                attachments=attachments.values(), self_collisions=SELF_COLLISIONS,
+                                                custom_limits=custom_limits)
+                if any(collision_fn(q) for q in grasp_path):
+                    grasp_path = None
+            else:
+                grasp_path = plan_direct_joint_motion(robot, arm_joints, grasp_conf,
+                                                      attachments=attachments.values(),
+                                                      obstacles=approach_obstacles, self_collisions=SELF_COLLISIONS,
+                                                      custom_limits=custom_limits, resolutions=resolutions/2.)
             if grasp_path is None:
                 print('Grasp path failure')
                 return None
@@ -500,10 +593,10 @@ def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False):
 
 ##################################################
 
-def get_ik_ir_gen(problem, max_attempts=25, learned=True, teleport=False, **kwargs):
+def get_ik_ir_gen(problem, max_attempts=25, learned=True, teleport=False, reachability=False, **kwargs):
     # TODO: compose using general fn
     ir_sampler = get_ir_sampler(problem, learned=learned, max_attempts=1, **kwargs)
-    ik_fn = get_ik_fn(problem, teleport=teleport, **kwargs)
+    ik_fn = get_ik_fn(problem, teleport=teleport, reachability=reachability, **kwargs)
     def gen(*inputs):
         b, a, p, g = inputs
         ir_generator = ir_sampler(*inputs)
@@ -533,7 +626,7 @@ def get_ik_ir_gen(problem, max_attempts=25, learned=True, teleport=False, **kwar
 
 ##################################################
 
-def get_motion_gen(problem, custom_limits={}, collisions=True, teleport=False):
+def get_motion_gen(problem, custom_limits={}, collisions=True, teleport=False, grid=False):
     # TODO: include fluents
     robot = problem.robot
     saver = BodySaver(robot)
@@ -557,7 +650,7 @@ def get_motion_gen(problem, custom_limits={}, collisions=True, teleport=False):
             path = [Conf(robot, bq2.joints, q) for q in raw_path]
         else:
             goal_conf = base_values_from_pose(bq2.value)
-            raw_path = plan_base_motion(robot, goal_conf, BASE_LIMITS, obstacles=obstacles)
+            raw_path = plan_base_motion(robot, goal_conf, BASE_LIMITS, obstacles=obstacles, grid=grid)
             if raw_path is None:
                 print('Failed motion plan!')
                 return None
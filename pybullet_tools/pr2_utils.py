@@ -487,6 +487,33 @@ def learned_pose_generator(robot, gripper_pose, arm, grasp_type):
 
 #####################################
 
+# Reachability maps
+
+REACHABILITY_FILENAME = '{}_reachability.npz'
+REACHABILITY_CACHE = {}
+
+def load_reachability_map(arm):
+    # Maps are created with create_reachability_map.py and stored in the base_footprint frame
+    from .voxels import ReachabilityMap
+    if arm not in REACHABILITY_CACHE:
+        path = get_database_file(REACHABILITY_FILENAME.format(arm))
+        if os.path.exists(path):
+            REACHABILITY_CACHE[arm] = ReachabilityMap.load(path)
+        else:
+            print('Reachability map {} does not exist'.format(path))
+            REACHABILITY_CACHE[arm] = None
+    return REACHABILITY_CACHE[arm]
+
+
+def is_gripper_reachable(robot, arm, gripper_pose, min_rate=0.):
+    reachability_map = load_reachability_map(arm)
+    if reachability_map is None:
+        return True
+    base_from_gripper = multiply(invert(get_base_pose(robot)), gripper_pose)
+    return reachability_map.is_reachable(base_from_gripper, min_rate=min_rate)
+
+#####################################
+
 # Camera
 
 # TODO: this is only for high_def_optical_frame
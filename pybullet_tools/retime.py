@@ -1,13 +1,22 @@
+import json
 import math
+import struct
 import numpy as np
 
+from collections import namedtuple
+
 from pybullet_planning.pybullet_tools.utils import safe_zip, clip, INF, \
-    waypoints_from_path, adjust_path, get_difference, get_pairs, get_max_velocities, get_duration_fn, wait_if_gui
+    waypoints_from_path, adjust_path, get_difference, get_pairs, get_max_velocities, get_duration_fn, wait_if_gui, \
+    get_batch_duration_fn, get_dynamical_limits, get_max_accelerations, get_time_step, control_joints, step_simulation
+from pybullet_planning.pybullet_tools.kinematics import KinematicChain
 
 #ARM_SPEED = 0.15*np.pi # radians / sec
 ARM_SPEED = 0.2 # percent
 DEFAULT_SPEED_FRACTION = 0.3
 
+TRAJECTORY_MAGIC = b'PBTRAJ01'
+TRAJECTORY_ALIGNMENT = 64 # bytes
+
 ################################################################################
 
 def ensure_increasing(path, time_from_starts):
@@ -39,11 +48,10 @@ def decompose_into_paths(joints, path):
 
 ################################################################################
 
-# TODO: retain based on the end effector velocity
-
 def instantaneous_retime_path(robot, joints, path, speed=ARM_SPEED, **kwargs):
-    duration_fn = get_duration_fn(robot, joints, **kwargs) # get_distance_fn
-    mid_durations = [duration_fn(*pair) for pair in get_pairs(path)]
+    duration_fn = get_batch_duration_fn(robot, joints, **kwargs) # get_duration_fn
+    path = np.array(path, dtype=float)
+    mid_durations = list(duration_fn(path[:-1], path[1:]))
     durations = [0.] + mid_durations
     time_from_starts = np.cumsum(durations) / speed
     return time_from_starts
@@ -109,6 +117,31 @@ def compute_position(ramp_time, max_duration, acceleration, t):
     return 0.5 * acceleration * math.pow(t1, 2) + velocity * t2 + \
            velocity * t3 - 0.5 * acceleration * math.pow(t3, 2)
 
+def compute_ramp_durations(distances, accelerations, durations):
+    # Vectorized compute_ramp_duration that broadcasts over segments and joints
+    distances, accelerations, durations = np.broadcast_arrays(
+        np.abs(distances), np.array(accelerations, dtype=float), np.array(durations, dtype=float))
+    finite = np.isfinite(accelerations)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        discriminants = np.maximum(0, np.power(durations * accelerations, 2) - 4 * distances * accelerations)
+        velocities = 0.5 * (durations * accelerations - np.sqrt(discriminants))
+        ramp_times = velocities / accelerations
+    # Infinite accelerations have instantaneous ramps
+    return np.where(finite, ramp_times, 0.)
+
+def compute_positions(distances, ramp_times, max_durations, accelerations, t):
+    # Vectorized compute_position that broadcasts over segments, joints and sample times
+    finite = np.isfinite(accelerations)
+    accelerations = np.where(finite, accelerations, 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        velocities = np.where(finite, accelerations * ramp_times, np.divide(distances, max_durations))
+    max_times = max_durations - 2 * ramp_times
+    t1 = np.clip(t, 0, ramp_times)
+    t2 = np.clip(t - ramp_times, 0, max_times)
+    t3 = np.clip(t - ramp_times - max_times, 0, ramp_times)
+    return 0.5 * accelerations * np.power(t1, 2) + velocities * t2 + \
+           velocities * t3 - 0.5 * accelerations * np.power(t3, 2)
+
 def add_ramp_waypoints(differences, accelerations, q1, duration, sample_step, waypoints, time_from_starts):
     dim = len(q1)
     distances = np.abs(differences)
@@ -146,54 +179,557 @@ def compute_min_duration(distance, max_velocity, acceleration):
         total_time = 2 * half_time
     return total_time
 
+def compute_min_durations(distances, max_velocities, accelerations):
+    # Vectorized compute_min_duration that broadcasts over segments and joints
+    distances, max_velocities, accelerations = np.broadcast_arrays(
+        np.abs(distances), np.array(max_velocities, dtype=float), np.array(accelerations, dtype=float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        max_ramp_durations = max_velocities / accelerations
+        ramp_distances = np.where(np.isinf(accelerations), 0.,
+                                  0.5 * accelerations * np.power(max_ramp_durations, 2))
+        remaining_distances = distances - 2 * ramp_distances
+        cruise_times = 2 * max_ramp_durations + remaining_distances / max_velocities
+        triangle_times = 2 * np.sqrt(distances / accelerations)
+    total_times = np.where(0 <= remaining_distances, cruise_times, triangle_times)
+    return np.where(distances == 0, 0., total_times)
+
+def sample_segments(path, durations, sample_step, sample_fn):
+    """
+    Samples every segment of a path that stops at each waypoint
+    :param sample_fn: a function from segment indices and times since the start of their segments to configurations
+    :return: the waypoints with the samples in between and their times
+    """
+    segment_starts = np.cumsum(np.append(0., durations))
+    # Matches the length and values of np.arange(sample_step, duration, sample_step) for each segment
+    with np.errstate(invalid='ignore'):
+        num_samples = np.ceil((durations - sample_step) / sample_step)
+    num_samples = np.maximum(np.nan_to_num(num_samples), 0).astype(int)
+    segments = np.repeat(np.arange(len(durations)), num_samples)
+    sample_indices = np.arange(len(segments)) - np.repeat(np.cumsum(num_samples) - num_samples, num_samples)
+    sample_times = sample_step + sample_indices * sample_step
+    positions = sample_fn(segments, sample_times)
+    sample_time_from_starts = segment_starts[segments] + sample_times
+
+    waypoints = list(path[:1])
+    time_from_starts = [0.]
+    boundaries = np.cumsum(num_samples)[:-1]
+    for q2, segment_positions, segment_times, end_time in zip(
+            path[1:], np.split(positions, boundaries), np.split(sample_time_from_starts, boundaries),
+            segment_starts[1:].tolist()):
+        waypoints.extend(segment_positions.tolist())
+        time_from_starts.extend(segment_times.tolist())
+        waypoints.append(q2)
+        time_from_starts.append(end_time)
+    return waypoints, time_from_starts
+
 def ramp_retime_path(path, max_velocities, acceleration_fraction=INF, sample_step=None):
     """
     :param path:
-    :param max_velocities:
+    :param max_velocities: the joint velocity limits or the per-segment limits (num_segments x num_joints)
     :param acceleration_fraction: fraction of velocity_fraction*max_velocity per second
     :param sample_step:
     :return:
     """
     assert np.all(max_velocities)
-    accelerations = max_velocities * acceleration_fraction
-    dim = len(max_velocities)
     #difference_fn = get_difference_fn(robot, joints)
     # TODO: more fine grain when moving longer distances
 
     # Assuming instant changes in accelerations
-    waypoints = [path[0]]
-    time_from_starts = [0.]
-    for q1, q2 in get_pairs(path):
-        differences = get_difference(q1, q2) # assumes not circular anymore
-        #differences = difference_fn(q1, q2)
-        distances = np.abs(differences)
-        duration = max([compute_min_duration(distances[idx], max_velocities[idx], accelerations[idx])
-                        for idx in range(dim)] + [0.])
-        time_from_start = time_from_starts[-1]
-        if sample_step is not None:
-            waypoints, time_from_starts = add_ramp_waypoints(differences, accelerations, q1, duration, sample_step,
-                                                             waypoints, time_from_starts)
-        waypoints.append(q2)
-        time_from_starts.append(time_from_start + duration)
-    return waypoints, time_from_starts
+    if len(path) <= 1:
+        return list(path[:1]), [0.]
+    path_array = np.array(path, dtype=float)
+    differences = path_array[1:] - path_array[:-1] # assumes not circular anymore
+    distances = np.abs(differences)
+    accelerations = np.broadcast_to(max_velocities * acceleration_fraction, distances.shape)
+    durations = np.max(compute_min_durations(distances, max_velocities, accelerations), axis=-1, initial=0.)
+    # np.cumsum accumulates sequentially, matching repeatedly adding each duration
+    segment_starts = np.cumsum(np.append(0., durations))
+    if sample_step is None:
+        return list(path), segment_starts.tolist()
+
+    ramp_durations = compute_ramp_durations(distances, accelerations, durations[:, None])
+    def sample_fn(segments, sample_times):
+        sample_distances = compute_positions(distances[segments], ramp_durations[segments],
+                                             durations[segments, None], accelerations[segments],
+                                             sample_times[:, None])
+        return path_array[segments] + np.sign(differences)[segments] * sample_distances
+    return sample_segments(path, durations, sample_step, sample_fn)
+
+################################################################################
+
+# Jerk-limited seven-segment S-curve profiles
+# The acceleration phase ramps the acceleration up to the peak acceleration, holds it, and ramps it back down
+# The deceleration phase is symmetric, and the profile cruises at the peak velocity in between
+
+def compute_scurve_profiles(distances, max_velocities, max_accelerations, max_jerks):
+    """
+    Minimum-time rest-to-rest S-curve profiles in closed form that broadcast over their inputs
+    :return: the jerk phase durations, acceleration phase durations, peak velocities and total durations
+    """
+    distances, max_velocities, max_accelerations, max_jerks = np.broadcast_arrays(
+        np.abs(distances), np.array(max_velocities, dtype=float), np.array(max_accelerations, dtype=float),
+        np.array(max_jerks, dtype=float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Peak velocity of a profile without a cruise phase that does (or does not) reach max_accelerations
+        reduced_accelerations = np.square(max_accelerations) / max_jerks
+        saturated_velocities = max_accelerations*(np.sqrt(np.square(max_accelerations / max_jerks) +
+                                                          4*distances / max_accelerations) -
+                                                  max_accelerations / max_jerks) / 2.
+        unsaturated_velocities = np.power(distances*np.sqrt(max_jerks) / 2., 2. / 3)
+        peak_velocities = np.where(reduced_accelerations <= saturated_velocities,
+                                   saturated_velocities, unsaturated_velocities)
+        peak_velocities = np.minimum(max_velocities, np.nan_to_num(peak_velocities, nan=INF))
+
+        peak_accelerations = np.minimum(max_accelerations, np.sqrt(peak_velocities*max_jerks))
+        jerk_times = np.where(np.isinf(max_jerks), 0., peak_accelerations / max_jerks)
+        acceleration_times = jerk_times + peak_velocities / peak_accelerations
+        durations = 2*acceleration_times + (distances - peak_velocities*acceleration_times) / peak_velocities
+    moving = (0 < distances)
+    return np.where(moving, jerk_times, 0.), np.where(moving, acceleration_times, 0.), \
+           np.where(moving, peak_velocities, 0.), np.where(moving, np.maximum(durations, 0.), 0.)
+
+def compute_scurve_positions(distances, jerk_times, acceleration_times, peak_velocities, durations, t):
+    # Positions at times t of the profiles from compute_scurve_profiles that broadcast over their inputs
+    t = np.clip(t, 0., durations)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        peak_accelerations = np.where(jerk_times < acceleration_times,
+                                      peak_velocities / (acceleration_times - jerk_times), 0.)
+        def acceleration_positions(times):
+            ramp_times = times - jerk_times
+            return np.where(times < jerk_times, peak_accelerations*np.power(times, 3) / (6*jerk_times),
+                   np.where(times <= acceleration_times - jerk_times,
+                            peak_accelerations*(np.square(jerk_times) / 6. + jerk_times*ramp_times / 2. +
+                                                np.square(ramp_times) / 2.),
+                            peak_velocities*(times - acceleration_times / 2.) +
+                            peak_accelerations*np.power(acceleration_times - times, 3) / (6*jerk_times)))
+        positions = np.where(t <= acceleration_times, acceleration_positions(t),
+                    np.where(t <= durations - acceleration_times,
+                             peak_velocities*(t - acceleration_times / 2.),
+                             distances - acceleration_positions(durations - t)))
+    return np.where(0 < distances, positions, 0.)
+
+def scurve_retime_path(path, max_velocities, max_accelerations, max_jerks, sample_step=None):
+    """
+    Jerk-limited counterpart of ramp_retime_path that stops at each waypoint
+    All joints follow the same normalized S-curve along each segment, so the path remains piecewise linear
+    :param path:
+    :param max_velocities: the joint velocity limits or the per-segment limits (num_segments x num_joints)
+    :param max_accelerations:
+    :param max_jerks:
+    :param sample_step:
+    :return:
+    """
+    if len(path) <= 1:
+        return list(path[:1]), [0.]
+    path_array = np.array(path, dtype=float)
+    differences = path_array[1:] - path_array[:-1]
+    distances = np.abs(differences)
+    # Limits on the normalized segment progress from 0 to 1
+    with np.errstate(divide='ignore'):
+        progress_limits = [np.min(np.divide(limits, distances), axis=-1, initial=INF)
+                           for limits in [max_velocities, max_accelerations, max_jerks]]
+    lengths = np.any(distances != 0, axis=-1).astype(float)
+    profiles = compute_scurve_profiles(lengths, *progress_limits)
+    durations = profiles[-1]
+    segment_starts = np.cumsum(np.append(0., durations))
+    if sample_step is None:
+        return list(path), segment_starts.tolist()
+
+    def sample_fn(segments, sample_times):
+        progresses = compute_scurve_positions(lengths[segments], *[profile[segments] for profile in profiles],
+                                              t=sample_times)
+        return path_array[segments] + progresses[:, None]*differences[segments]
+    return sample_segments(path, durations, sample_step, sample_fn)
+
+################################################################################
+
+# Time-optimal path parameterization via reachability analysis (TOPP-RA)
+# https://arxiv.org/abs/1707.07239
+# Path variables: x = sdot^2 and u = sddot where x_{i+1} = x_i + 2*(s_{i+1} - s_i)*u_i
+# TODO: torque limits
+
+def compute_chord_deviations(spline, knots, path, num_samples=16):
+    # Maximum per-joint distance between the spline and the straight segment between each pair of knots
+    fractions = np.linspace(0., 1., num=num_samples + 2, endpoint=True)[1:-1]
+    samples = spline(knots[:-1, None] + fractions*np.diff(knots)[:, None])
+    starts, differences = path[:-1, None, :], np.diff(path, axis=0)[:, None, :]
+    projections = np.clip(np.sum((samples - starts)*differences, axis=-1) / np.sum(np.square(differences), axis=-1),
+                          0., 1.)
+    residuals = samples - (starts + projections[..., None]*differences)
+    return np.max(np.abs(residuals), axis=(-2, -1))
+
+def spline_from_path(path, max_deviation=INF, max_iterations=10):
+    """
+    Twice-differentiable geometric path parameterized by the cumulative joint-space distance
+    Knots are inserted at the midpoints of the segments of path until the spline deviates at most max_deviation
+    from them, so the spline remains close to the piecewise-linear path that was collision checked
+    :return: the spline or None if max_deviation is not achieved within max_iterations
+    """
+    from scipy.interpolate import CubicSpline
+    path = np.array(path, dtype=float)
+    distances = np.linalg.norm(path[1:] - path[:-1], axis=-1)
+    path = path[np.concatenate([[0], 1 + np.nonzero(distances)[0]])]
+    for iteration in range(max_iterations + 1):
+        knots = np.append(0., np.cumsum(np.linalg.norm(np.diff(path, axis=0), axis=-1)))
+        bc_type = 'natural' if len(knots) <= 3 else 'not-a-knot'
+        spline = CubicSpline(knots, path, bc_type=bc_type)
+        if max_deviation == INF:
+            return spline
+        exceeded = max_deviation < compute_chord_deviations(spline, knots, path)
+        if not np.any(exceeded):
+            return spline
+        indices = np.nonzero(exceeded)[0]
+        path = np.insert(path, indices + 1, (path[indices] + path[indices + 1]) / 2., axis=0)
+    return None
+
+def compute_velocity_bounds(tangents, max_velocities):
+    # Rewrites |q'(s)*sdot| <= max_velocities at each gridpoint as x <= bounds
+    with np.errstate(divide='ignore'):
+        return np.min(np.square(np.divide(max_velocities, np.abs(tangents))), axis=-1)
+
+def compute_acceleration_constraints(tangents, curvatures, max_accelerations, tolerance=1e-9):
+    """
+    Rewrites |tangents*u + curvatures*x| <= max_accelerations at each stage as
+    -offsets + slopes*x <= u <= offsets + slopes*x for each constraint and x <= upper_bounds
+    """
+    max_accelerations = np.broadcast_to(max_accelerations, tangents.shape)
+    moving = tolerance < np.abs(tangents)
+    safe_tangents = np.where(moving, tangents, 1.)
+    offsets = np.where(moving, max_accelerations / np.abs(safe_tangents), INF)
+    slopes = np.where(moving, -curvatures / safe_tangents, 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Constraints that do not depend on u only bound x
+        stationary_bounds = np.where(moving, INF, max_accelerations / np.abs(curvatures))
+        # Each pair of lower and upper bounds on u must be simultaneously satisfiable
+        gaps = slopes[..., :, None] - slopes[..., None, :]
+        pair_bounds = np.where(0 < gaps, (offsets[..., :, None] + offsets[..., None, :]) / gaps, INF)
+    upper_bounds = np.minimum(np.min(stationary_bounds, axis=-1), np.min(pair_bounds, axis=(-2, -1)))
+    return offsets, slopes, upper_bounds
+
+def compute_controllable_sets(steps, offsets, slopes, upper_bounds, tolerance=1e-9):
+    """
+    Backward pass that computes the interval of x at each gridpoint from which coming to rest at the end is feasible
+    :return: a (num_gridpoints x 2) array of intervals or None if the path is infeasible
+    """
+    controllable_sets = np.zeros([len(upper_bounds), 2])
+    for i in reversed(range(len(steps))):
+        min_next, max_next = controllable_sets[i+1]
+        scale = 1. / (2*steps[i])
+        # Intersects the acceleration bounds with the transition bounds
+        # scale*(min_next - x) <= u <= scale*(max_next - x)
+        transition_slopes = scale + slopes[i]
+        if np.any((transition_slopes == 0) & (offsets[i] < scale*min_next)):
+            return None
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lower_limits = (scale*min_next - offsets[i]) / transition_slopes
+            upper_limits = (scale*max_next + offsets[i]) / transition_slopes
+        lower = np.max(lower_limits, where=(0 < transition_slopes), initial=0.)
+        upper = min(np.min(upper_limits, where=(0 < transition_slopes), initial=upper_bounds[i]),
+                    np.min(lower_limits, where=(transition_slopes < 0), initial=INF))
+        if upper < lower - tolerance:
+            return None
+        controllable_sets[i] = [lower, max(lower, upper)]
+    if 0 < controllable_sets[0, 0]:
+        return None
+    return controllable_sets
+
+def compute_optimal_parameterization(steps, offsets, slopes, controllable_sets):
+    # Forward pass that greedily applies the maximum acceleration that remains controllable
+    squared_velocities = np.zeros(len(controllable_sets)) # Starts at rest
+    for i in range(len(steps)):
+        x = squared_velocities[i]
+        min_next, max_next = controllable_sets[i+1]
+        acceleration = min(np.min(offsets[i] + slopes[i]*x), (max_next - x) / (2*steps[i]))
+        squared_velocities[i+1] = clip(x + 2*steps[i]*acceleration, min_next, max_next)
+    return squared_velocities
+
+def compute_stage_violations(spline, gridpoints, path_velocities, max_velocities, max_accelerations,
+                             velocity_bound_fn=None, num_samples=10):
+    """
+    Evaluates the constraints at num_samples times within each stage, where each stage has a constant path acceleration
+    :return: the configurations at the samples and the factor per stage by which time must be scaled to satisfy them
+    """
+    steps = np.diff(gridpoints)
+    path_accelerations = np.diff(np.square(path_velocities)) / (2*steps)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        durations = 2*steps / (path_velocities[:-1] + path_velocities[1:])
+    fractions = np.linspace(0., 1., num=num_samples, endpoint=False)
+    dt = fractions*durations[:, None]
+    sdot = path_velocities[:-1, None] + path_accelerations[:, None]*dt
+    s = np.clip(gridpoints[:-1, None] + path_velocities[:-1, None]*dt + 0.5*path_accelerations[:, None]*np.square(dt),
+                gridpoints[:-1, None], gridpoints[1:, None]).flatten()
+    sdot, sddot = sdot.flatten(), np.repeat(path_accelerations, num_samples)
+    confs, tangents, curvatures = spline(s), spline(s, 1), spline(s, 2)
+    velocities = tangents*sdot[:, None]
+    accelerations = curvatures*np.square(sdot)[:, None] + tangents*sddot[:, None]
+    # Scaling time by a factor scales velocities by its inverse and accelerations by its inverse squared
+    scales = np.maximum(np.max(np.abs(velocities) / max_velocities, axis=-1),
+                        np.sqrt(np.max(np.abs(accelerations) / max_accelerations, axis=-1)))
+    if velocity_bound_fn is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = np.nan_to_num(np.square(sdot) / velocity_bound_fn(confs, tangents))
+        scales = np.maximum(scales, np.sqrt(ratios))
+    return confs, np.maximum(1., np.max(scales.reshape(-1, num_samples), axis=-1))
+
+def topp_retime_path(path, max_velocities, max_accelerations, num_gridpoints=100, num_subdivisions=8,
+                     sample_step=None, velocity_bound_fn=None, max_deviation=1e-2, collision_fn=None,
+                     max_iterations=5, tolerance=1e-3):
+    """
+    Time-optimal retiming that does not stop at intermediate waypoints
+    Falls back to ramps that stop at each waypoint when they are faster or when the spline is not valid
+    :param path: a list of configurations that are interpolated by a cubic spline
+    :param max_velocities: the joint velocity limits
+    :param max_accelerations: the joint acceleration limits
+    :param num_gridpoints: the minimum number of gridpoints in addition to the waypoints
+    :param num_subdivisions: the number of gridpoints per interval between the spline knots
+    :param sample_step: the time between samples or None to return the gridpoints
+    :param velocity_bound_fn: an optional function from the gridpoint configurations and tangents q'(s)
+        to additional upper bounds on sdot^2, such as the one from get_tool_velocity_bound_fn
+    :param max_deviation: the maximum per-joint deviation of the spline from the segments of path
+    :param collision_fn: an optional function that checks the spline between the waypoints
+    :param max_iterations: the maximum number of times the velocity bounds are tightened
+    :return: the sampled configurations and their times
+    """
+    if len(path) <= 1:
+        return list(path), [0.]*len(path)
+    if not np.any(np.not_equal(path[1:], path[:-1])):
+        return list(path[:1]), [0.]
+
+    # Synchronized ramps that stop at each waypoint and remain on the segments of path
+    ramp_velocities = max_velocities if velocity_bound_fn is None else \
+        limit_segment_velocities(path, max_velocities, velocity_bound_fn)
+    def ramp_retime_fn():
+        return scurve_retime_path(path, ramp_velocities, max_accelerations, INF, sample_step=sample_step)
+    _, ramp_times = scurve_retime_path(path, ramp_velocities, max_accelerations, INF)
+
+    spline = spline_from_path(path, max_deviation=max_deviation)
+    if spline is None:
+        return ramp_retime_fn()
+    # The refined knots cluster at the corners of path, where the curvature is highest
+    knot_gridpoints = (spline.x[:-1, None] + np.linspace(0., 1., num=num_subdivisions, endpoint=False) *
+                       np.diff(spline.x)[:, None]).flatten()
+    gridpoints = np.union1d(np.append(knot_gridpoints, spline.x[-1]),
+                            np.linspace(0., spline.x[-1], num=num_gridpoints, endpoint=True))
+    steps = np.diff(gridpoints)
+    tangents, curvatures = spline(gridpoints, 1), spline(gridpoints, 2)
+    # Enforces the acceleration limits at both ends of each stage (the interpolation discretization)
+    # using q''(s_{i+1}) = q'(s_{i+1})*u_i + q''(s_{i+1})*(x_i + 2*(s_{i+1} - s_i)*u_i)
+    offsets, slopes, acceleration_bounds = compute_acceleration_constraints(
+        np.hstack([tangents[:-1], tangents[1:] + 2*steps[:, None]*curvatures[1:]]),
+        np.hstack([curvatures[:-1], curvatures[1:]]), np.tile(max_accelerations, 2))
+    upper_bounds = compute_velocity_bounds(tangents, max_velocities)
+    if velocity_bound_fn is not None:
+        upper_bounds = np.minimum(upper_bounds, velocity_bound_fn(spline(gridpoints), tangents))
+    upper_bounds[:-1] = np.minimum(upper_bounds[:-1], acceleration_bounds)
+    # The constraints are only enforced at the gridpoints, so the velocity bounds of the stages that violate them
+    # in between are tightened, and time is finally uniformly scaled to satisfy any remaining violations
+    for iteration in range(max_iterations):
+        controllable_sets = compute_controllable_sets(steps, offsets, slopes, upper_bounds)
+        if controllable_sets is None:
+            return ramp_retime_fn()
+        path_velocities = np.sqrt(compute_optimal_parameterization(steps, offsets, slopes, controllable_sets))
+        with np.errstate(divide='ignore'):
+            durations = 2*steps / (path_velocities[:-1] + path_velocities[1:])
+        if not np.all(np.isfinite(durations)):
+            return ramp_retime_fn()
+        confs, scales = compute_stage_violations(spline, gridpoints, path_velocities, max_velocities,
+                                                 max_accelerations, velocity_bound_fn=velocity_bound_fn)
+        if np.all(scales <= 1. + tolerance):
+            break
+        violated = (1. + tolerance < scales)
+        upper_bounds[:-1] = np.minimum(upper_bounds[:-1],
+                                       np.where(violated, np.square(path_velocities[:-1] / scales), INF))
+        upper_bounds[1:] = np.minimum(upper_bounds[1:],
+                                      np.where(violated, np.square(path_velocities[1:] / scales), INF))
+    scale = np.max(scales)
+    path_velocities /= scale
+    time_from_starts = np.append(0., np.cumsum(scale*durations))
+    if ramp_times[-1] <= time_from_starts[-1]:
+        return ramp_retime_fn()
+    if (collision_fn is not None) and any(map(collision_fn, confs)):
+        return ramp_retime_fn()
+    if sample_step is None:
+        return spline(gridpoints).tolist(), time_from_starts.tolist()
+
+    # Each interval has a constant path acceleration
+    times = np.append(np.arange(0., time_from_starts[-1], step=sample_step), [time_from_starts[-1]])
+    indices = np.clip(np.searchsorted(time_from_starts, times, side='right') - 1, 0, len(steps) - 1)
+    path_accelerations = np.diff(np.square(path_velocities)) / (2*steps)
+    dt = times - time_from_starts[indices]
+    s = gridpoints[indices] + path_velocities[indices]*dt + 0.5*path_accelerations[indices]*np.square(dt)
+    return spline(np.clip(s, 0., gridpoints[-1])).tolist(), times.tolist()
+
+################################################################################
+
+# End-effector speed limits
+# Along a path q(s), the tool twist is J(q(s))*q'(s)*sdot, so bounding the tool speeds bounds sdot
+
+def get_tool_jacobian_fn(robot, joints, tool_link):
+    """
+    Batched geometric Jacobians of tool_link with respect to joints using a KinematicChain
+    Chain joints that are not in joints remain at their current positions
+    :return: a function from an array of configurations (... x num_joints) to Jacobians (... x 6 x num_joints)
+    """
+    chain = KinematicChain(robot, tool_link)
+    chain_indices = [index for index, joint in enumerate(chain.joints) if joint in joints]
+    path_indices = [joints.index(chain.joints[index]) for index in chain_indices]
+    current_conf = chain.get_conf()
+    def jacobian_fn(confs):
+        confs = np.array(confs, dtype=float)
+        flat_confs = confs.reshape(-1, len(joints))
+        chain_confs = np.tile(current_conf, (len(flat_confs), 1))
+        chain_confs[:, chain_indices] = flat_confs[:, path_indices]
+        _, chain_jacobians = chain.compute_jacobians(chain_confs)
+        jacobians = np.zeros((len(flat_confs), 6, len(joints)))
+        jacobians[..., path_indices] = chain_jacobians[..., chain_indices]
+        return jacobians.reshape(confs.shape[:-1] + (6, len(joints)))
+    return jacobian_fn
+
+def compute_tool_rates(jacobian_fn, confs, tangents):
+    # Linear and angular tool speeds per unit sdot at configurations confs moving along tangents
+    twists = np.matmul(jacobian_fn(confs), np.array(tangents, dtype=float)[..., None])[..., 0]
+    return np.linalg.norm(twists[..., :3], axis=-1), np.linalg.norm(twists[..., 3:], axis=-1)
+
+def get_tool_velocity_bound_fn(jacobian_fn, max_linear_speed=INF, max_angular_speed=INF):
+    # Tool speed limits as upper bounds on sdot^2 for topp_retime_path
+    def velocity_bound_fn(confs, tangents):
+        linear_rates, angular_rates = compute_tool_rates(jacobian_fn, confs, tangents)
+        with np.errstate(divide='ignore'):
+            return np.minimum(np.square(np.divide(max_linear_speed, linear_rates)),
+                              np.square(np.divide(max_angular_speed, angular_rates)))
+    return velocity_bound_fn
+
+def limit_segment_velocities(path, max_velocities, velocity_bound_fn, num_steps=10):
+    """
+    Reduces the joint velocity limits on each straight segment of path so that sdot^2 satisfies velocity_bound_fn
+    at num_steps + 1 evenly spaced configurations per segment, where s is the progress through the segment from 0 to 1
+    The limits are exact for profiles where all joints share a normalized profile,
+    such as scurve_retime_path and ramp_retime_path without an acceleration limit
+    :return: the per-segment joint velocity limits (num_segments x num_joints)
+    """
+    path = np.array(path, dtype=float)
+    differences = path[1:] - path[:-1]
+    fractions = np.linspace(0., 1., num=num_steps + 1, endpoint=True)
+    confs = path[:-1, None, :] + fractions[:, None]*differences[:, None, :]
+    tangents = np.broadcast_to(differences[:, None, :], confs.shape)
+    velocity_bounds = velocity_bound_fn(confs, tangents)
+    # Maximum rate of progress through each segment from 0 to 1
+    progress_velocities = np.sqrt(np.min(velocity_bounds, axis=-1, initial=INF))
+    distances = np.abs(differences)
+    return np.minimum(max_velocities, np.where(distances == 0, INF, progress_velocities[:, None]*distances))
+
+def limit_tool_speeds(jacobian_fn, path, max_velocities, max_linear_speed=INF, max_angular_speed=INF, **kwargs):
+    # Reduces the joint velocity limits on each segment of path to satisfy the tool speed limits
+    velocity_bound_fn = get_tool_velocity_bound_fn(jacobian_fn, max_linear_speed, max_angular_speed)
+    return limit_segment_velocities(path, max_velocities, velocity_bound_fn, **kwargs)
+
+################################################################################
 
 def retime_trajectory(robot, joints, path, only_waypoints=False,
-                      velocity_fraction=DEFAULT_SPEED_FRACTION, **kwargs):
+                      velocity_fraction=DEFAULT_SPEED_FRACTION, time_optimal=False, jerk_limited=False,
+                      max_accelerations=None, max_jerks=None, duration_to_max=1.,
+                      tool_link=None, max_linear_speed=INF, max_angular_speed=INF, **kwargs):
     """
     :param robot:
     :param joints:
     :param path:
     :param velocity_fraction: fraction of max_velocity
+    :param time_optimal: whether to use TOPP-RA instead of ramps that stop at each waypoint
+        (its spline can be collision checked by passing collision_fn to topp_retime_path)
+    :param jerk_limited: whether to use S-curves that stop at each waypoint instead of ramps
+    :param max_accelerations: the TOPP-RA and S-curve acceleration limits (defaults to max_velocity / duration_to_max)
+    :param max_jerks: the S-curve jerk limits (defaults to max_acceleration / duration_to_max)
+    :param tool_link: the link whose linear (m/s) and angular (rad/s) speeds are limited
+    :param max_linear_speed: the maximum linear speed of tool_link
+    :param max_angular_speed: the maximum angular speed of tool_link
     :return:
     """
     path = adjust_path(robot, joints, path)
     if only_waypoints:
         path = waypoints_from_path(path)
     max_velocities = velocity_fraction * np.array(get_max_velocities(robot, joints))
+    if time_optimal or jerk_limited:
+        max_velocities, max_accelerations = get_dynamical_limits(
+            robot, joints, max_velocities, max_accelerations, duration_to_max)
+    if (tool_link is not None) and ((max_linear_speed < INF) or (max_angular_speed < INF)):
+        jacobian_fn = get_tool_jacobian_fn(robot, joints, tool_link)
+        if time_optimal:
+            kwargs['velocity_bound_fn'] = get_tool_velocity_bound_fn(
+                jacobian_fn, max_linear_speed, max_angular_speed)
+        elif len(path) >= 2:
+            max_velocities = limit_tool_speeds(jacobian_fn, path, max_velocities,
+                                               max_linear_speed, max_angular_speed)
+    if time_optimal:
+        return topp_retime_path(path, max_velocities, max_accelerations, **kwargs)
+    if jerk_limited:
+        if max_jerks is None:
+            max_jerks = get_max_accelerations(robot, joints, max_accelerations, duration_to_max)
+        return scurve_retime_path(path, max_velocities, max_accelerations, max_jerks, **kwargs)
     return ramp_retime_path(path, max_velocities, **kwargs)
 
 ################################################################################
 
+# Multi-body synchronization
+
+def synchronize_paths(paths):
+    """
+    Resamples paths that are executed concurrently at their shared normalized arc-length progress values
+    :param paths: a list of paths that can have different lengths and dimensions
+    :return: a list of (num_waypoints x dim) arrays that all have the same number of waypoints
+    """
+    paths = [np.array(path, dtype=float).reshape(len(path), -1) for path in paths]
+    assert all(len(path) != 0 for path in paths)
+    progresses = []
+    for path in paths:
+        distances = np.append(0., np.cumsum(np.linalg.norm(np.diff(path, axis=0), axis=-1)))
+        progresses.append(distances / distances[-1] if distances[-1] != 0 else np.zeros(len(path)))
+    # Rounding merges nearly identical progress values that would produce degenerate segments
+    shared_progresses = np.unique(np.round(np.concatenate(progresses + [[0., 1.]]), decimals=9))
+    synchronized_paths = []
+    for path, progress in safe_zip(paths, progresses):
+        if len(path) == 1 or progress[-1] == 0:
+            synchronized_paths.append(np.tile(path[0], (len(shared_progresses), 1)))
+        else:
+            synchronized_paths.append(np.stack([np.interp(shared_progresses, progress, values)
+                                                for values in path.T], axis=-1))
+    return synchronized_paths
+
+def retime_multi_trajectory(groups, paths, velocity_fraction=DEFAULT_SPEED_FRACTION, time_optimal=False,
+                            duration_to_max=1., collision_fns=None, **kwargs):
+    """
+    Retimes the paths of several bodies or joint groups with one time parameterization so they execute concurrently
+    :param groups: a list of (body, joints) pairs, such as the base, torso and arms of a robot or several robots
+    :param paths: a list of paths, one per group
+    :param velocity_fraction: fraction of max_velocity
+    :param time_optimal: whether to use TOPP-RA instead of ramps that stop at each waypoint
+    :param collision_fns: an optional list of collision functions, one per group, that check the TOPP-RA spline
+    :return: a list of paths, one per group, and their shared time_from_starts
+    """
+    assert len(groups) == len(paths)
+    paths = [adjust_path(body, joints, path) for (body, joints), path in safe_zip(groups, paths)]
+    combined_path = np.hstack(synchronize_paths(paths))
+    # Each segment is as long as the slowest joint of any group requires
+    max_velocities = [velocity_fraction * np.array(get_max_velocities(body, joints)) for body, joints in groups]
+    indices = np.cumsum([len(joints) for _, joints in groups])[:-1]
+    if time_optimal:
+        max_accelerations = [get_dynamical_limits(body, joints, velocities, duration_to_max=duration_to_max)[1]
+                             for (body, joints), velocities in safe_zip(groups, max_velocities)]
+        if collision_fns is not None:
+            assert len(collision_fns) == len(groups)
+            def collision_fn(q):
+                return any(group_collision_fn(group_q) for group_collision_fn, group_q
+                           in safe_zip(collision_fns, np.split(q, indices)))
+            kwargs['collision_fn'] = collision_fn
+        combined_path, time_from_starts = topp_retime_path(
+            combined_path, np.concatenate(max_velocities), np.concatenate(max_accelerations), **kwargs)
+    else:
+        combined_path, time_from_starts = ramp_retime_path(
+            list(combined_path), np.concatenate(max_velocities), **kwargs)
+    group_paths = np.split(np.array(combined_path, dtype=float), indices, axis=-1)
+    return [list(map(tuple, path)) for path in group_paths], time_from_starts
+
+################################################################################
+
 def approximate_spline(time_from_starts, path, k=3, approx=INF):
     from scipy.interpolate import make_interp_spline, make_lsq_spline
     x = time_from_starts
@@ -249,10 +785,263 @@ def interpolate_path(robot, joints, path, velocity_fraction=DEFAULT_SPEED_FRACTI
     return positions
 
 
+def iterate_curve_times(positions_curve, time_step=1e-2, chunk_size=100):
+    # Chunks of np.append(np.arange(start_time, end_time, step=time_step), [end_time]) without allocating all of them
+    start_time = positions_curve.x[0]
+    end_time = positions_curve.x[-1]
+    num_steps = max(int(math.ceil((end_time - start_time) / time_step)), 0)
+    delta = (start_time + time_step) - start_time
+    for index in range(0, num_steps, chunk_size):
+        yield start_time + delta*np.arange(index, min(index + chunk_size, num_steps))
+    yield np.array([end_time])
+
 def sample_curve(positions_curve, time_step=1e-2):
+    for times in iterate_curve_times(positions_curve, time_step=time_step):
+        for t, q in zip(times, positions_curve(times)):
+            yield t, q
+
+def get_velocity_curve(positions_curve, time_step=1e-3):
+    if hasattr(positions_curve, 'derivative'):
+        return positions_curve.derivative()
+    # interp1d does not support derivatives
     start_time = positions_curve.x[0]
     end_time = positions_curve.x[-1]
-    times = np.append(np.arange(start_time, end_time, step=time_step), [end_time])
-    for t in times:
-        q = positions_curve(t)
-        yield t, q
+    def velocity_curve(times):
+        before_times = np.maximum(times - time_step / 2., start_time)
+        after_times = np.minimum(times + time_step / 2., end_time)
+        differences = positions_curve(after_times) - positions_curve(before_times)
+        return differences / (after_times - before_times)[..., None]
+    return velocity_curve
+
+def stream_curve(positions_curve, time_step=1e-2, chunk_size=100):
+    """
+    Evaluates a retimed curve at a fixed control rate in bounded-memory chunks
+    :param positions_curve: a scipy curve such as the one returned by interpolate_path
+    :param time_step: the control period
+    :param chunk_size: the maximum number of samples per chunk
+    :return: a generator of (times, positions, velocities) arrays with chunk_size rows
+    """
+    velocities_curve = get_velocity_curve(positions_curve)
+    for times in iterate_curve_times(positions_curve, time_step=time_step, chunk_size=chunk_size):
+        yield times, positions_curve(times), velocities_curve(times)
+
+def control_curve(body, joints, positions_curve, time_step=None, chunk_size=100, **kwargs):
+    """
+    Tracks a retimed curve by setting the position and velocity targets of control_joints every simulation step
+    :return: a generator that yields the time after each simulation step
+    """
+    if time_step is None:
+        time_step = get_time_step()
+    for times, positions, velocities in stream_curve(positions_curve, time_step=time_step, chunk_size=chunk_size):
+        for t, q, qd in zip(times, positions, velocities):
+            control_joints(body, joints, positions=q, velocities=qd, **kwargs)
+            step_simulation()
+            yield t
+
+
+class CurveLookup(object):
+    # Dense time, position, and arc length tables of a curve that answer queries by binary search in O(log n)
+    # rather than by re-evaluating the curve (or randomly sampling it as in find_closest)
+
+    def __init__(self, positions_curve, time_step=1e-3, weights=None, chunk_size=1000):
+        self.curve = positions_curve
+        self.times = np.concatenate(list(iterate_curve_times(
+            positions_curve, time_step=time_step, chunk_size=chunk_size)))
+        self.positions = np.array(positions_curve(self.times), dtype=float).reshape(len(self.times), -1)
+        if weights is None:
+            weights = np.ones(self.positions.shape[1])
+        self.weights = np.array(weights, dtype=float)
+        lengths = np.linalg.norm(self.weights*np.diff(self.positions, axis=0), axis=-1)
+        self.distances = np.concatenate([[0.], np.cumsum(lengths)])
+        self.kd_tree = None
+    @property
+    def x(self):
+        # Same interface as the scipy curves, so a lookup can be passed to sample_curve and stream_curve
+        return self.times
+    @property
+    def start_time(self):
+        return self.times[0]
+    @property
+    def end_time(self):
+        return self.times[-1]
+    @property
+    def length(self):
+        return self.distances[-1]
+
+    def get_segments(self, times):
+        # Index i of the table segment [times[i], times[i+1]] that contains each time
+        indices = np.searchsorted(self.times, times, side='right') - 1
+        return np.clip(indices, 0, max(len(self.times) - 2, 0))
+    def interpolate(self, indices, values, steps, queries):
+        if len(self.times) == 1:
+            return values[indices]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fractions = np.clip((queries - steps[indices]) / (steps[indices + 1] - steps[indices]), 0., 1.)
+        fractions = np.nan_to_num(fractions)
+        fractions = fractions.reshape(fractions.shape + (1,)*(values.ndim - 1))
+        return (1 - fractions)*values[indices] + fractions*values[indices + 1]
+    def __call__(self, times):
+        # Piecewise-linear resampling of the table
+        times = np.clip(times, self.start_time, self.end_time)
+        return self.interpolate(self.get_segments(times), self.positions, self.times, times)
+    def distance_at_time(self, times):
+        times = np.clip(times, self.start_time, self.end_time)
+        return self.interpolate(self.get_segments(times), self.distances, self.times, times)
+    def time_at_distance(self, distances):
+        # The first time that the curve has travelled each distance
+        distances = np.clip(distances, 0., self.length)
+        indices = np.searchsorted(self.distances, distances, side='left') - 1
+        indices = np.clip(indices, 0, max(len(self.times) - 2, 0))
+        return self.interpolate(indices, self.times, self.distances, distances)
+    def resample(self, step_size):
+        # Times and positions spaced step_size apart in arc length
+        distances = np.append(np.arange(0., self.length, step=step_size), [self.length])
+        times = self.time_at_distance(distances)
+        return times, self(times)
+
+    def project(self, position, indices):
+        # Closest points on the table segments starting at indices
+        position = np.array(position, dtype=float)
+        starts = self.positions[indices]
+        if len(self.times) == 1:
+            return self.weighted_distances(position, starts), self.times[indices]
+        differences = self.weights*(self.positions[indices + 1] - starts)
+        offsets = self.weights*(position - starts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fractions = np.sum(offsets*differences, axis=-1) / np.sum(differences*differences, axis=-1)
+        fractions = np.clip(np.nan_to_num(fractions), 0., 1.)
+        distances = np.linalg.norm(offsets - fractions[:, None]*differences, axis=-1)
+        times = (1 - fractions)*self.times[indices] + fractions*self.times[indices + 1]
+        return distances, times
+    def weighted_distances(self, position, positions):
+        return np.linalg.norm(self.weights*(positions - position), axis=-1)
+    def closest_time(self, position, t_range=None):
+        """
+        Finds the closest point on the curve to position
+        :param t_range: an optional window (start_time, end_time) to search, such as around the previous closest time
+        :return: the closest distance and its time, like find_closest
+        """
+        last_segment = max(len(self.times) - 2, 0)
+        if t_range is None:
+            # Nearest table sample using a k-d tree and then its two adjacent segments
+            # The result is exact up to the table resolution
+            if self.kd_tree is None:
+                from scipy.spatial import cKDTree
+                self.kd_tree = cKDTree(self.weights*self.positions)
+            _, index = self.kd_tree.query(self.weights*np.array(position, dtype=float))
+            indices = np.unique(np.clip([index - 1, index], 0, last_segment))
+        else:
+            start_time, end_time = np.clip(t_range, self.start_time, self.end_time)
+            indices = np.arange(self.get_segments(start_time), self.get_segments(end_time) + 1)
+        distances, times = self.project(position, indices)
+        if t_range is not None:
+            times = np.clip(times, start_time, end_time)
+            distances = self.weighted_distances(position, self(times))
+        index = np.argmin(distances)
+        return distances[index], times[index]
+
+################################################################################
+
+# Binary trajectory files
+# Layout: magic, header size (uint64), JSON header, then the columns
+# times (float64), joints (int32), positions (float64) and velocities (float64) each aligned to TRAJECTORY_ALIGNMENT
+# Records are stored contiguously within each column, so a record is a slice of each memory-mapped column
+
+TrajectoryRecord = namedtuple('TrajectoryRecord', ['body', 'joints', 'times', 'positions', 'velocities'])
+
+def create_trajectory_record(body, joints, positions, times, velocities=None):
+    times = np.array(times, dtype=float)
+    positions = np.array(positions, dtype=float).reshape(len(times), len(joints))
+    assert np.all(np.diff(times) >= 0)
+    # Zero-duration samples, such as repeated configurations, are removed (keeping the last of each repeated time)
+    # because finite differences over them are undefined
+    indices = np.nonzero(np.append(np.diff(times) > 0, True))[0]
+    times, positions = times[indices], positions[indices]
+    if velocities is None:
+        velocities = np.gradient(positions, times, axis=0) if len(times) >= 2 else np.zeros(positions.shape)
+    else:
+        velocities = np.array(velocities, dtype=float).reshape(-1, len(joints))[indices]
+    return TrajectoryRecord(body, tuple(joints), times, positions, velocities)
+
+def align_offset(offset, alignment=TRAJECTORY_ALIGNMENT):
+    return alignment * int(math.ceil(float(offset) / alignment))
+
+def write_trajectories(filename, records):
+    """
+    Writes trajectory records into one columnar binary file that read_trajectories memory-maps
+    :param filename: the path of the file
+    :param records: a list of TrajectoryRecord
+    :return: the number of bytes written
+    """
+    columns = [
+        ('times', np.float64, [record.times for record in records]),
+        ('joints', np.int32, [np.array(record.joints) for record in records]),
+        ('positions', np.float64, [record.positions for record in records]),
+        ('velocities', np.float64, [record.velocities for record in records]),
+    ]
+    header = {
+        'records': [{'body': int(record.body), 'num_joints': len(record.joints), 'num_times': len(record.times)}
+                    for record in records],
+        'columns': {},
+    }
+    # The header size depends on the column offsets, so they are computed relative to the end of the header
+    offset = 0
+    for name, dtype, arrays in columns:
+        size = sum(np.size(array) for array in arrays)
+        header['columns'][name] = {'dtype': np.dtype(dtype).str, 'offset': offset, 'size': size}
+        offset = align_offset(offset + size*np.dtype(dtype).itemsize)
+    header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+    data_offset = align_offset(len(TRAJECTORY_MAGIC) + 8 + len(header_bytes))
+
+    with open(filename, 'wb') as f:
+        f.write(TRAJECTORY_MAGIC)
+        f.write(struct.pack('<Q', data_offset))
+        f.write(header_bytes)
+        for name, dtype, arrays in columns:
+            f.seek(data_offset + header['columns'][name]['offset'])
+            for array in arrays:
+                f.write(np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder('<')).tobytes())
+        f.truncate(data_offset + offset)
+    return data_offset + offset
+
+def read_trajectory_columns(filename, mode='r'):
+    # Returns the header and a memory-mapped array per column
+    with open(filename, 'rb') as f:
+        if f.read(len(TRAJECTORY_MAGIC)) != TRAJECTORY_MAGIC:
+            raise ValueError('{} is not a trajectory file'.format(filename))
+        data_offset, = struct.unpack('<Q', f.read(8))
+        header_bytes = f.read(data_offset - len(TRAJECTORY_MAGIC) - 8)
+    header = json.loads(header_bytes.rstrip(b'\x00').decode('utf-8'))
+    columns = {}
+    for name, info in header['columns'].items():
+        if info['size'] == 0:
+            columns[name] = np.zeros(0, dtype=info['dtype'])
+        else:
+            columns[name] = np.memmap(filename, dtype=info['dtype'], mode=mode,
+                                      offset=data_offset + info['offset'], shape=(info['size'],))
+    return header, columns
+
+def read_trajectories(filename, mode='r'):
+    """
+    Memory-maps a file written by write_trajectories without copying or unpickling
+    :param filename: the path of the file
+    :param mode: the np.memmap mode
+    :return: a list of TrajectoryRecord whose arrays are views of the memory-mapped columns
+    """
+    header, columns = read_trajectory_columns(filename, mode=mode)
+    records = []
+    time_index = joint_index = value_index = 0
+    for info in header['records']:
+        num_times, num_joints = info['num_times'], info['num_joints']
+        num_values = num_times*num_joints
+        value_slice = slice(value_index, value_index + num_values)
+        records.append(TrajectoryRecord(
+            body=info['body'],
+            joints=tuple(int(joint) for joint in columns['joints'][joint_index:joint_index + num_joints]),
+            times=columns['times'][time_index:time_index + num_times],
+            positions=columns['positions'][value_slice].reshape(num_times, num_joints),
+            velocities=columns['velocities'][value_slice].reshape(num_times, num_joints)))
+        time_index += num_times
+        joint_index += num_joints
+        value_index += num_values
+    return records
@@ -2,6 +2,8 @@ import itertools
 import math
 import os.path
 import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from queue import Queue
 
 import numpy as np
 from tracikpy import TracIKSolver
@@ -22,6 +24,20 @@ class LimitsSaver(Saver):
     def restore(self):
         self.ik_solver.set_joint_limits(*self.joint_limits)
 
+WORKER_SOLVER = None
+
+def initialize_worker(solver_kwargs):
+    # Constructs one independent TRAC-IK solver per worker process
+    global WORKER_SOLVER
+    WORKER_SOLVER = TracIKSolver(**solver_kwargs)
+
+def solve_worker(tform, seed_conf, joint_limits, bounds, deadline=INF):
+    # Each solve is bounded by the solver timeout, so skipping solves past the deadline stops the workers promptly
+    if time.time() >= deadline:
+        return None
+    WORKER_SOLVER.joint_limits = joint_limits
+    return WORKER_SOLVER.ik(tform, qinit=seed_conf, **bounds)
+
 def throttle_generator(generator, soft_failures=False, max_attempts=INF, max_failures=INF, max_cum_time=INF, max_total_time=INF):
     # from srl_stream.utils import throttle_generator
     start_time = time.time()
@@ -66,14 +82,18 @@ class IKSolver(object): # TODO: rename?
         # TODO: Distance doesn't make sense when circular limits
         urdf_info = get_model_info(body)
         self.urdf_path = os.path.abspath(urdf_info.path) # self.ik_solver._urdf_string
-        self.ik_solver = TracIKSolver(
+        self.solver_kwargs = dict(
             urdf_file=self.urdf_path,
             base_link=get_link_name(self.body, self.base_link),
             tip_link=get_link_name(self.body, self.tool_link),
             timeout=max_time, epsilon=error,
             solve_type='Speed' if speed else 'Distance', # Manipulation1 | Manipulation2
         )
+        self.ik_solver = TracIKSolver(**self.solver_kwargs)
         assert self.ik_solver.joint_names
+        self.executor = None
+        self.num_workers = None
+        self.worker_solvers = None
 
         self.circular_limits = list(get_custom_limits(
             self.body, self.joints, custom_limits=custom_limits, circular_limits=CIRCULAR_LIMITS))
@@ -232,6 +252,18 @@ class IKSolver(object): # TODO: rename?
         return self.solve(tool_pose, seed_conf=self.get_center_conf(), **kwargs)
     def solve_warm(self, tool_pose, **kwargs):
         return self.solve(tool_pose, seed_conf=self.last_solution, **kwargs)
+    def solve_path(self, tool_poses, seed_conf=True, max_joint_step=PI/8, **kwargs):
+        # Cartesian path IK where each waypoint is seeded with and bounded around the previous solution
+        conf = self.get_conf() if seed_conf is True else seed_conf
+        path = []
+        for tool_pose in tool_poses:
+            with self.saver():
+                self.set_nearby_limits(conf, bound=max_joint_step*np.ones(self.dofs))
+                conf = self.solve(tool_pose, seed_conf=conf, **kwargs)
+            if conf is None:
+                return None
+            path.append(conf)
+        return path
     def generate(self, tool_pose, seed_confs=None, joint_limits=None, **kwargs): # include_failures=True
         seed_generator = itertools.repeat(None)
         if seed_confs is not None:
@@ -302,6 +334,81 @@ class IKSolver(object): # TODO: rename?
         if not solutions:
             return None
         return solutions[0]
+
+    def start_workers(self, num_workers=4, use_processes=False):
+        # Independent TRAC-IK instances because a single solver is not thread-safe
+        if (self.executor is not None) and (self.num_workers == num_workers) and \
+                (isinstance(self.executor, ProcessPoolExecutor) == use_processes):
+            return self.executor
+        self.stop_workers()
+        if use_processes:
+            self.executor = ProcessPoolExecutor(max_workers=num_workers, initializer=initialize_worker,
+                                                initargs=(self.solver_kwargs,))
+        else:
+            # The C++ solver releases the GIL while solving
+            self.executor = ThreadPoolExecutor(max_workers=num_workers)
+            self.worker_solvers = Queue()
+            for _ in range(num_workers):
+                self.worker_solvers.put(TracIKSolver(**self.solver_kwargs))
+        self.num_workers = num_workers
+        return self.executor
+    def stop_workers(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.executor = None
+        self.num_workers = None
+        self.worker_solvers = None
+    def solve_thread(self, tform, seed_conf, joint_limits, bounds, deadline=INF):
+        if time.time() >= deadline:
+            return None
+        ik_solver = self.worker_solvers.get()
+        try:
+            ik_solver.joint_limits = joint_limits
+            return ik_solver.ik(tform, qinit=seed_conf, **bounds)
+        finally:
+            self.worker_solvers.put(ik_solver)
+    def solve_parallel(self, tool_pose, target_conf=None, num_seeds=8, num_workers=4, use_processes=False,
+                       max_time=INF, weights=None, pos_tolerance=1e-5, ori_tolerance=math.radians(5e-2),
+                       verbose=False):
+        """
+        Fans out num_seeds TRAC-IK solves to a pool of independent solvers and gathers the results
+        :param target_conf: the first seed and the reference for the distance (if not None)
+        :param max_time: maximum time to wait for the solves to return (later solves are skipped)
+        :return: the solutions (sorted by weighted L-inf distance to target_conf when not None)
+        """
+        start_time = time.time()
+        executor = self.start_workers(num_workers=num_workers, use_processes=use_processes)
+        pose = self.base_from_world(tool_pose)
+        tform = tform_from_pose(pose)
+        bounds = dict(bx=pos_tolerance, by=pos_tolerance, bz=pos_tolerance,
+                      brx=ori_tolerance, bry=ori_tolerance, brz=ori_tolerance)
+        seed_confs = [self.sample_conf() for _ in range(num_seeds)]
+        if target_conf is not None:
+            seed_confs[0] = np.array(target_conf)
+        solve_fn = solve_worker if use_processes else self.solve_thread
+        deadline = start_time + max_time
+        futures = [executor.submit(solve_fn, tform, seed_conf, self.joint_limits, bounds, deadline)
+                   for seed_conf in seed_confs]
+        done, not_done = wait(futures, timeout=None if max_time == INF else max_time)
+        for future in not_done:
+            future.cancel()
+        solutions = [future.result() for future in done if future.exception() is None]
+        solutions = [conf for conf in solutions if conf is not None]
+        self.solutions.extend((pose, conf) for conf in solutions)
+        if target_conf is not None:
+            if weights is None:
+                weights = np.ones(self.dofs)
+            distance_fn = lambda conf: np.max(np.multiply(weights, np.absolute(self.difference_fn(conf, target_conf))))
+            solutions.sort(key=distance_fn)
+        if verbose:
+            print('TRAC-IK) Seeds: {} | Completed: {} | Solutions: {} | Elapsed: {:.3f}'.format(
+                num_seeds, len(done), len(solutions), elapsed_time(start_time)))
+        return solutions
+    def solve_parallel_distance(self, tool_pose, target_conf, **kwargs):
+        solutions = self.solve_parallel(tool_pose, target_conf=target_conf, **kwargs)
+        if not solutions:
+            return None
+        return solutions[0]
     def dump(self):
         print('Body: {} | Base: {} | Tip: {}'.format(self.body, self.base_name, self.tool_name))
         print('Links:', self.link_names)
@@ -3946,6 +3946,68 @@ def get_duration_fn(body, joints, velocities=None, norm=INF):
         return np.linalg.norm(durations, ord=norm)
     return fn
 
+# Batch versions that operate on (N x dof) arrays of configurations (broadcasting against a single conf)
+
+def get_circular_mask(body, joints):
+    return np.array([is_circular(body, joint) for joint in joints], dtype=bool)
+
+def circular_differences(thetas2, thetas1):
+    # Vectorized circular_difference with the default [-PI, PI) interval
+    return np.mod(np.subtract(thetas2, thetas1) + PI, 2*PI) - PI
+
+def get_batch_difference_fn(body, joints):
+    circular_mask = get_circular_mask(body, joints)
+
+    def fn(q2, q1):
+        differences = np.subtract(q2, q1, dtype=float)
+        differences[..., circular_mask] = circular_differences(differences[..., circular_mask], 0.)
+        return differences
+    return fn
+
+def get_batch_distance_fn(body, joints, weights=None, norm=2):
+    weights = np.array(get_default_weights(body, joints, weights))
+    difference_fn = get_batch_difference_fn(body, joints)
+    def fn(q1, q2):
+        differences = difference_fn(q2, q1)
+        return np.linalg.norm(weights*differences, ord=norm, axis=-1)
+    return fn
+
+def get_batch_duration_fn(body, joints, velocities=None, norm=INF):
+    if velocities is None:
+        velocities = np.array(get_max_velocities(body, joints))
+    velocities = np.abs(velocities)
+    difference_fn = get_batch_difference_fn(body, joints)
+    def fn(q1, q2):
+        durations = np.divide(difference_fn(q2, q1), velocities)
+        return np.linalg.norm(durations, ord=norm, axis=-1)
+    return fn
+
+def get_nearest_fn(body, joints, **kwargs):
+    distance_fn = get_batch_distance_fn(body, joints, **kwargs)
+    def fn(q, confs, k=1):
+        # Returns the indices of the k nearest confs and their distances
+        if len(confs) == 0:
+            return np.array([], dtype=int), np.array([])
+        distances = distance_fn(np.array(q), np.array(confs))
+        k = min(k, len(distances))
+        indices = np.argpartition(distances, k - 1)[:k]
+        indices = indices[np.argsort(distances[indices])]
+        return indices, distances[indices]
+    return fn
+
+def get_continuity_fn(body, joints, max_steps=np.pi/8):
+    # Returns the index of the first consecutive pair of confs where a joint moves more than max_steps or None
+    max_steps = max_steps*np.ones(len(joints))
+    difference_fn = get_batch_difference_fn(body, joints)
+    def fn(confs):
+        confs = np.array(confs, dtype=float).reshape(-1, len(joints))
+        if len(confs) <= 1:
+            return None
+        violations = np.any(np.abs(difference_fn(confs[1:], confs[:-1])) > max_steps, axis=-1)
+        indices = np.flatnonzero(violations)
+        return indices[0] if len(indices) else None
+    return fn
+
 def get_wrap_fn(body, joints):
     # wrap_position | wrap_positions
     circular_joints = [is_circular(body, joint) for joint in joints]
@@ -4003,33 +4065,68 @@ def get_extend_fn(body, joints, resolutions=None, norm=2): # TODO: change to INF
 
 def remove_redundant(path, tolerance=1e-3):
     assert path
-    new_path = [path[0]]
-    for conf in path[1:]:
-        difference = np.array(new_path[-1]) - np.array(conf)
-        if not all_close(np.zeros(len(difference)), difference, atol=tolerance):
-            new_path.append(conf)
-    return new_path
+    # Keeps the first configuration and each configuration that differs from its predecessor
+    confs = np.array(path, dtype=float)
+    keep = np.concatenate([[True], np.any(np.abs(np.diff(confs, axis=0)) > tolerance, axis=-1)])
+    return [path[i] for i in np.flatnonzero(keep)]
 
-def waypoints_from_path(path, difference_fn=None, tolerance=1e-3):
+def get_waypoint_indices(path, difference_fn=None, tolerance=1e-3):
+    # Indices of the first and last configurations and of every configuration where the direction changes
     if difference_fn is None:
-        difference_fn = lambda q2, q1: np.array(q2) - np.array(q1) # get_difference
         #difference_fn = get_difference_fn(body, joints) # TODO: account for wrap around or use adjust_path
+        differences = np.diff(np.array(path, dtype=float), axis=0) # get_difference
+    else:
+        differences = np.array([difference_fn(q2, q1) for q1, q2 in get_pairs(path)], dtype=float)
+    lengths = np.linalg.norm(differences, axis=-1, keepdims=True)
+    unit_differences = np.divide(differences, lengths, out=np.zeros(differences.shape), where=(lengths != 0))
+    changes = np.any(np.abs(unit_differences[1:] - unit_differences[:-1]) > tolerance, axis=-1)
+    return [0] + list(np.nonzero(changes)[0] + 1) + [len(path) - 1]
+
+def waypoints_from_path(path, difference_fn=None, tolerance=1e-3):
     path = remove_redundant(path, tolerance=tolerance)
     if len(path) < 2:
         return path
-
-    waypoints = [path[0]]
-    last_conf = path[1]
-    last_difference = get_unit_vector(difference_fn(last_conf, waypoints[-1]))
-    for conf in path[2:]:
-        difference = get_unit_vector(difference_fn(conf, waypoints[-1]))
-        if not all_close(last_difference, difference, atol=tolerance):
-            waypoints.append(last_conf)
-            difference = get_unit_vector(difference_fn(conf, waypoints[-1]))
-        last_conf = conf
-        last_difference = difference
-    waypoints.append(last_conf)
-    return waypoints
+    return [path[i] for i in get_waypoint_indices(path, difference_fn=difference_fn, tolerance=tolerance)]
+
+def get_segment_distances(q1, q2, confs, weights=None):
+    # Weighted distances from each configuration to the closest point on the segment between q1 and q2
+    if weights is None:
+        weights = np.ones(len(q1))
+    q1, q2, confs = np.multiply(weights, q1), np.multiply(weights, q2), np.multiply(weights, confs)
+    difference = q2 - q1
+    length2 = np.dot(difference, difference)
+    if length2 == 0:
+        return np.linalg.norm(confs - q1, axis=-1)
+    fractions = np.clip(np.dot(confs - q1, difference) / length2, 0., 1.)
+    return np.linalg.norm(confs - (q1 + fractions[:, None]*difference), axis=-1)
+
+def simplify_path(path, max_deviation=1e-2, weights=None, validity_fn=None):
+    """
+    Ramer-Douglas-Peucker simplification of a path in joint space
+    :param path: a list of configurations
+    :param max_deviation: the maximum weighted distance between a removed configuration and the shortened segment
+    :param weights: the joint weights used when computing the distances
+    :param validity_fn: a function that returns whether the shortened segment between two configurations is valid
+    :return: the retained subsequence of the path
+    """
+    if len(path) <= 2:
+        return list(path)
+    confs = np.array(path, dtype=float)
+    retained = np.zeros(len(path), dtype=bool)
+    retained[[0, -1]] = True
+    stack = [(0, len(path) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        deviations = get_segment_distances(confs[start], confs[end], confs[start+1:end], weights=weights)
+        index = start + 1 + np.argmax(deviations)
+        if (deviations[index - start - 1] <= max_deviation) and \
+                ((validity_fn is None) or validity_fn(path[start], path[end])):
+            continue
+        retained[index] = True
+        stack.extend([(index, end), (start, index)])
+    return [path[i] for i in np.nonzero(retained)[0]]
 
 def adjust_path(robot, joints, path, initial_conf=None):
     if path is None:
@@ -4100,6 +4197,15 @@ def get_limits_fn(body, joints, custom_limits={}, verbose=False):
         return False
     return limits_fn
 
+def get_batch_limits_fn(body, joints, custom_limits={}):
+    lower_limits, upper_limits = map(np.array, get_custom_limits(body, joints, custom_limits))
+
+    def limits_fn(confs):
+        # Returns a boolean array that is True for each configuration that violates the limits
+        confs = np.array(confs, dtype=float)
+        return np.any((confs < lower_limits) | (upper_limits < confs), axis=-1)
+    return limits_fn
+
 def get_collision_fn(body, joints, obstacles=[], attachments=[], self_collisions=True, disabled_collisions=set(),
                      custom_limits={}, use_aabb=False, cache=False, max_distance=MAX_DISTANCE, **kwargs):
     # TODO: convert most of these to keyword arguments
@@ -4228,6 +4334,103 @@ def plan_joint_motion(body, joints, end_conf, obstacles=[], attachments=[],
 
 plan_holonomic_motion = plan_joint_motion
 
+def can_fork_world():
+    # Forked processes inherit a copy of a DIRECT physics server but not of a GUI server
+    import multiprocessing
+    return ('fork' in multiprocessing.get_all_start_methods()) and not any(CLIENTS.values())
+
+def race_processes(fns, max_time=INF, seed=None, verbose=False):
+    """
+    Runs each fn in its own forked process (with a cloned world) and returns the first non-None output
+    The race requires fork and DIRECT clients: otherwise a warning is printed and fns are run sequentially
+    :param fns: list of functions without arguments that return a picklable output or None
+    :param max_time: wall-clock timeout (seconds)
+    :param seed: base random seed (process i uses seed + i)
+    :return: the first non-None output or None
+    """
+    import multiprocessing
+    from queue import Empty
+    start_time = time.time()
+    if seed is None:
+        seed = random.randint(0, 2**31)
+    if not can_fork_world():
+        # A GUI server is not copied into forked processes, and clone_world neither preserves body ids
+        # (which fns close over) nor reliably reproduces link frames, so the race falls back to sequential
+        print('Warning: race_processes is unavailable with a GUI client or without fork, '
+              'so {} functions are run sequentially'.format(len(fns)))
+        for fn in fns:
+            if elapsed_time(start_time) >= max_time:
+                break
+            output = fn()
+            if output is not None:
+                return output
+        return None
+
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    def target(i, fn):
+        # The random number generators are otherwise identical across forked processes
+        set_random_seed(seed + i)
+        set_numpy_seed(seed + i)
+        try:
+            output = fn()
+        except Exception as e:
+            print('Process {} failed: {}'.format(i, e))
+            output = None
+        queue.put((i, output))
+
+    processes = [context.Process(target=target, args=(i, fn)) for i, fn in enumerate(fns)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    output = None
+    try:
+        for _ in range(len(processes)):
+            remaining_time = max_time - elapsed_time(start_time)
+            if remaining_time <= 0:
+                break
+            try:
+                i, output = queue.get(timeout=None if remaining_time == INF else remaining_time)
+            except Empty:
+                break
+            if verbose:
+                print('Process {} finished with {} output in {:.3f} seconds'.format(
+                    i, 'no' if output is None else 'an', elapsed_time(start_time)))
+            if output is not None:
+                break
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+        queue.close()
+    return output
+
+def plan_joint_motion_portfolio(body, joints, end_conf, num_seeds=None, algorithms=[None],
+                                max_time=INF, seed=None, verbose=False, **kwargs):
+    """
+    Races independent plan_joint_motion invocations in separate processes and returns the first solution
+    :param num_seeds: number of random seeds per algorithm (defaults to the number of CPUs)
+    :param algorithms: algorithms passed to solve(algorithm=...) where None uses birrt
+    :param max_time: wall-clock timeout (seconds) across all processes
+    :return: the first path found or None
+    """
+    if num_seeds is None:
+        num_seeds = max(1, (os.cpu_count() or 1) // len(algorithms))
+    fns = []
+    for algorithm in algorithms:
+        planner_kwargs = dict(kwargs)
+        if max_time < INF:
+            planner_kwargs.setdefault('max_time', max_time)
+        fn = lambda algorithm=algorithm, planner_kwargs=planner_kwargs: plan_joint_motion(
+            body, joints, end_conf, algorithm=algorithm, **planner_kwargs)
+        fns.extend(num_seeds*[fn])
+    path = race_processes(fns, max_time=max_time, seed=seed, verbose=verbose)
+    if path is None:
+        return path
+    return [tuple(conf) for conf in path]
+
 def plan_lazy_prm(start_conf, end_conf, sample_fn, extend_fn, collision_fn, **kwargs):
     # TODO: cost metric based on total robot movement (encouraging greater distances possibly)
     from motion_planners.lazy_prm import lazy_prm
@@ -4255,6 +4458,100 @@ def plan_lazy_prm(start_conf, end_conf, sample_fn, extend_fn, collision_fn, **kw
 
 #####################################
 
+# Anytime planning
+
+def compute_path_cost(path, distance_fn=get_distance):
+    if path is None:
+        return INF
+    return sum(distance_fn(q1, q2) for q1, q2 in get_pairs(path))
+
+def shortcut_generator(path, extend_fn, collision_fn, distance_fn=get_distance, max_iterations=INF, max_time=INF,
+                       tolerance=1e-6, rtol=1e-3):
+    # Randomized shortcutting that yields each improved path (assumes the endpoints of path are collision-free)
+    # A shortcut must save more than max(tolerance, rtol*segment_cost) so floating-point noise is never an improvement
+    start_time = time.time()
+    waypoints = list(path)
+    cumulative_costs = np.cumsum([0.] + [distance_fn(q1, q2) for q1, q2 in get_pairs(waypoints)])
+    for iteration in irange(max_iterations):
+        if (elapsed_time(start_time) >= max_time) or (len(waypoints) <= 2):
+            break
+        i, j = sorted(random.sample(range(len(waypoints)), 2))
+        if j - i <= 1:
+            continue
+        segment_cost = cumulative_costs[j] - cumulative_costs[i]
+        margin = max(tolerance, rtol*segment_cost)
+        if distance_fn(waypoints[i], waypoints[j]) >= (segment_cost - margin):
+            continue
+        segment = list(extend_fn(waypoints[i], waypoints[j]))
+        if any(collision_fn(q) for q in segment[:-1]):
+            continue
+        new_waypoints = waypoints[:i+1] + segment[:-1] + waypoints[j:]
+        new_cumulative_costs = np.cumsum([0.] + [distance_fn(q1, q2) for q1, q2 in get_pairs(new_waypoints)])
+        if new_cumulative_costs[-1] >= (cumulative_costs[-1] - margin):
+            continue
+        waypoints, cumulative_costs = new_waypoints, new_cumulative_costs
+        yield waypoints
+
+def anytime_joint_motion(body, joints, end_conf, max_time=5., obstacles=[], attachments=[],
+                         self_collisions=True, disabled_collisions=set(),
+                         weights=None, resolutions=None, norm=2, max_distance=MAX_DISTANCE,
+                         use_aabb=False, cache=True, custom_limits={}, algorithm=None, verbose=False, **kwargs):
+    """
+    Yields a first feasible path as soon as one is found and then progressively shorter paths until the deadline
+    :param max_time: wall-clock budget (seconds) covering both planning and shortcutting
+    :return: a generator of increasingly short paths
+    """
+    start_time = time.time()
+    assert len(joints) == len(end_conf)
+    assert max_time < INF
+    if (weights is None) and (resolutions is not None):
+        weights = np.reciprocal(resolutions)
+    sample_fn = get_sample_fn(body, joints, custom_limits=custom_limits)
+    distance_fn = get_distance_fn(body, joints, weights=weights, norm=norm)
+    extend_fn = get_extend_fn(body, joints, resolutions=resolutions, norm=norm)
+    collision_fn = get_collision_fn(body, joints, obstacles, attachments, self_collisions, disabled_collisions,
+                                    custom_limits=custom_limits, max_distance=max_distance,
+                                    use_aabb=use_aabb, cache=cache)
+
+    start_conf = get_joint_positions(body, joints)
+    if not check_initial_end(start_conf, end_conf, collision_fn):
+        return
+    if algorithm is None:
+        from motion_planners.rrt_connect import birrt
+        path = birrt(start_conf, end_conf, distance_fn, sample_fn, extend_fn, collision_fn,
+                     max_time=max_time, smooth=0, **kwargs)
+    else:
+        path = solve(start_conf, end_conf, distance_fn, sample_fn, extend_fn, collision_fn,
+                     algorithm=algorithm, weights=weights, max_time=max_time, **kwargs)
+    if path is None:
+        return
+    if verbose:
+        print('Initial path | Cost: {:.3f} | Waypoints: {} | Time: {:.3f}'.format(
+            compute_path_cost(path, distance_fn), len(path), elapsed_time(start_time)))
+    yield path
+
+    remaining_time = max_time - elapsed_time(start_time)
+    for path in shortcut_generator(path, extend_fn, collision_fn, distance_fn=distance_fn, max_time=remaining_time):
+        if verbose:
+            print('Shortcut path | Cost: {:.3f} | Waypoints: {} | Time: {:.3f}'.format(
+                compute_path_cost(path, distance_fn), len(path), elapsed_time(start_time)))
+        yield path
+
+def plan_anytime_joint_motion(body, joints, end_conf, callback=None, **kwargs):
+    """
+    Blocking version of anytime_joint_motion that calls callback on each intermediate path
+    :param callback: function that receives each intermediate path
+    :return: the best path found before the deadline or None
+    """
+    best_path = None
+    for path in anytime_joint_motion(body, joints, end_conf, **kwargs):
+        best_path = path
+        if callback is not None:
+            callback(path)
+    return best_path
+
+#####################################
+
 def get_closest_angle_fn(body, joints, weights=None, reversible=True, linear_tol=0., **kwargs):
     assert len(joints) == 3
     weights = get_default_weights(body, joints, weights)
@@ -4307,20 +4604,145 @@ def get_nonholonomic_extend_fn(body, joints, resolutions=None, angular_tol=0., *
         return path
     return extend_fn
 
+DUBINS_WORDS = ['LSL', 'RSR', 'LSR', 'RSL', 'RLR', 'LRL']
+STEERING_FROM_SEGMENT = {'L': +1, 'S': 0, 'R': -1}
+
+def dubins_segments(q1, q2, turning_radius):
+    """
+    Computes the normalized segment lengths of each Dubins word for a batch of configurations
+    :param q1: start configurations (x, y, theta) broadcastable against q2
+    :param q2: end configurations (x, y, theta)
+    :param turning_radius: minimum turning radius (meters)
+    :return: an array of shape (..., len(DUBINS_WORDS), 3) where infeasible words are INF
+    """
+    q1, q2 = np.array(q1, dtype=float), np.array(q2, dtype=float)
+    dx, dy = (q2[..., 0] - q1[..., 0]), (q2[..., 1] - q1[..., 1])
+    d = np.hypot(dx, dy) / turning_radius
+    phi = np.arctan2(dy, dx)
+    a = np.mod(q1[..., 2] - phi, 2*PI)
+    b = np.mod(q2[..., 2] - phi, 2*PI)
+    sa, sb, ca, cb = np.sin(a), np.sin(b), np.cos(a), np.cos(b)
+    cab = np.cos(a - b)
+    mod2pi = lambda angle: np.mod(angle, 2*PI)
+
+    with np.errstate(invalid='ignore'):
+        segments = []
+        # LSL
+        p2 = 2 + d**2 - 2*cab + 2*d*(sa - sb)
+        tmp = np.arctan2(cb - ca, d + sa - sb)
+        segments.append((mod2pi(-a + tmp), np.sqrt(p2), mod2pi(b - tmp), p2 >= 0))
+        # RSR
+        p2 = 2 + d**2 - 2*cab + 2*d*(sb - sa)
+        tmp = np.arctan2(ca - cb, d - sa + sb)
+        segments.append((mod2pi(a - tmp), np.sqrt(p2), mod2pi(-b + tmp), p2 >= 0))
+        # LSR
+        p2 = -2 + d**2 + 2*cab + 2*d*(sa + sb)
+        p = np.sqrt(p2)
+        tmp = np.arctan2(-ca - cb, d + sa + sb) - np.arctan2(-2., p)
+        segments.append((mod2pi(-a + tmp), p, mod2pi(-b + tmp), p2 >= 0))
+        # RSL
+        p2 = -2 + d**2 + 2*cab - 2*d*(sa + sb)
+        p = np.sqrt(p2)
+        tmp = np.arctan2(ca + cb, d - sa - sb) - np.arctan2(2., p)
+        segments.append((mod2pi(a - tmp), p, mod2pi(b - tmp), p2 >= 0))
+        # RLR
+        tmp = (6. - d**2 + 2*cab + 2*d*(sa - sb)) / 8.
+        p = mod2pi(2*PI - np.arccos(tmp))
+        t = mod2pi(a - np.arctan2(ca - cb, d - sa + sb) + p/2.)
+        segments.append((t, p, mod2pi(a - b - t + p), np.abs(tmp) <= 1))
+        # LRL
+        tmp = (6. - d**2 + 2*cab + 2*d*(sb - sa)) / 8.
+        p = mod2pi(2*PI - np.arccos(tmp))
+        t = mod2pi(-a - np.arctan2(ca - cb, d + sa - sb) + p/2.)
+        segments.append((t, p, mod2pi(b - a - t + p), np.abs(tmp) <= 1))
+
+    lengths = np.stack([np.stack([t, p, q], axis=-1) for t, p, q, _ in segments], axis=-2)
+    feasible = np.stack([np.broadcast_to(f, d.shape) for _, _, _, f in segments], axis=-1)
+    return np.where(feasible[..., None], lengths, INF)
+
+def dubins_distances(q1, q2, turning_radius, reversible=False):
+    """
+    Computes the length (meters) of the shortest Dubins path for a batch of configurations
+    :param reversible: also considers driving the entire path in reverse
+    :return: an array of path lengths broadcast over q1 and q2
+    """
+    distances = turning_radius*np.min(np.sum(dubins_segments(q1, q2, turning_radius), axis=-1), axis=-1)
+    if reversible:
+        distances = np.minimum(distances, dubins_distances(
+            flip_headings(q1), flip_headings(q2), turning_radius, reversible=False))
+    return distances
+
+def flip_headings(confs):
+    confs = np.array(confs, dtype=float)
+    confs[..., 2] = np.mod(confs[..., 2], 2*PI) - PI
+    return confs
+
+def sample_dubins_path(q1, segments, word, turning_radius, step_size=0.01):
+    # Analytically integrates the unicycle model along each circular or straight segment
+    steerings = np.array([STEERING_FROM_SEGMENT[segment] for segment in word])
+    lengths = turning_radius*np.array(segments)
+    boundaries = np.cumsum(np.append([0.], lengths))
+    distances = np.append(np.arange(0., boundaries[-1], step_size), [boundaries[-1]])
+    indices = np.clip(np.searchsorted(boundaries, distances, side='right') - 1, 0, len(word) - 1)
+
+    starts = [np.array(q1, dtype=float)]
+    for steering, length in zip(steerings, lengths):
+        starts.append(integrate_unicycle(starts[-1], steering, length, turning_radius))
+    starts = np.array(starts)
+    return integrate_unicycle(starts[indices].T, steerings[indices],
+                              distances - boundaries[indices], turning_radius).T
+
+def integrate_unicycle(q, steering, length, turning_radius):
+    x, y, theta = q
+    new_theta = theta + steering*length/turning_radius
+    straight = (steering == 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        radius = turning_radius*np.where(straight, 1., steering)
+        new_x = np.where(straight, x + length*np.cos(theta), x + radius*(np.sin(new_theta) - np.sin(theta)))
+        new_y = np.where(straight, y + length*np.sin(theta), y - radius*(np.cos(new_theta) - np.cos(theta)))
+    return np.array([new_x, new_y, np.mod(new_theta + PI, 2*PI) - PI])
+
+def dubins_path(q1, q2, turning_radius, reversible=False, step_size=0.01):
+    """
+    Samples the shortest Dubins path (or, if reversible, the shortest reverse Dubins path)
+    :return: a list of configurations beginning at q1 and ending at q2
+    """
+    segments = dubins_segments(q1, q2, turning_radius)
+    costs = np.sum(segments, axis=-1)
+    reverse = False
+    if reversible:
+        reverse_segments = dubins_segments(flip_headings(q1), flip_headings(q2), turning_radius)
+        reverse_costs = np.sum(reverse_segments, axis=-1)
+        if np.min(reverse_costs) < np.min(costs):
+            reverse, segments, costs = True, reverse_segments, reverse_costs
+    index = np.argmin(costs)
+    start = flip_headings(q1) if reverse else q1
+    confs = sample_dubins_path(start, segments[index], DUBINS_WORDS[index], turning_radius, step_size=step_size)
+    if reverse:
+        confs = flip_headings(confs)
+    confs[-1] = q2
+    return list(map(tuple, confs))
+
+def get_dubins_distance_fn(body, joints, turning_radius=1e-3, reversible=False, **kwargs):
+    assert len(joints) == 3
+
+    def distance_fn(q1, q2):
+        return float(dubins_distances(q1, q2, turning_radius, reversible=reversible))
+    return distance_fn
+
 def get_dubins_extend_fn(body, joints, turning_radius=1e-3, # meters
                          step_size=0.01, # meters
-                         **kwargs):
+                         reversible=False, **kwargs):
     assert len(joints) == 3
-    import dubins
-    # TODO: reversible (Reeds-Shepp curves)
+    # TODO: Reeds-Shepp curves that also contain cusps
 
     def extend_fn(q1, q2):
-        dubins_path = dubins.shortest_path(q1, q2, turning_radius) # dubins.path
-        confs, times = dubins_path.sample_many(step_size)
-        return confs
+        return dubins_path(q1, q2, turning_radius, reversible=reversible, step_size=step_size)[1:]
     return extend_fn
 
-def get_differential_extend_fn(body, joints, resolutions=None, **kwargs):
+def get_differential_extend_fn(body, joints, resolutions=None, max_heading=PI/3, turning_radius=1e-3, **kwargs):
+    # max_heading: headings that deviate more than this from q1 -> q2 (such as perpendicular or backward headings)
+    # can't be reached by a cubic spline and instead are steered with Dubins curves
     # https://github.com/AtsushiSakai/PythonRobotics/tree/master/PathPlanning/CubicSpline
     assert len(joints) == 3
     from scipy.interpolate import CubicHermiteSpline
@@ -4328,46 +4750,39 @@ def get_differential_extend_fn(body, joints, resolutions=None, **kwargs):
     resolutions = get_default_resolutions(body, joints, resolutions)
     angular_extend_fn = get_extend_fn(body, joints[2:], resolutions[2:])
     dx = resolutions[0] # TODO: need to account for the y resolution (grid?)
+    step_size = np.min(resolutions[:2])
     # TODO: curvature
     # TODO: time along the trajectory based on wheel velocity
     # TODO: turn to look at the goal and then arc
 
     def extend_fn(q1, q2):
         # TODO: return empty sequence if no path
-        swap = q1[0] > q2[0]
-        if swap:
-            q1, q2 = q2, q1
         x1, y1, theta1 = q1
         x2, y2, theta2 = q2
-        if math.isclose(x1, x2):
-            if math.isclose(y1, y2):
-                path = [np.append(q1[:2], aq) for aq in angular_extend_fn(q1[2:], q2[2:])]
-                if swap:
-                    path = path[::-1]
-                return path
-            else:
-                print(q1, q2, y1, y2)
-                raise RuntimeError()
-
-        dydx1 = math.tan(theta1) # TODO: this can't be right
-        dydx2 = math.tan(theta2)
-        #assert -PI < theta1 < PI
-        #assert -PI < theta2 < PI
+        if math.isclose(x1, x2) and math.isclose(y1, y2):
+            return [np.append(q1[:2], aq) for aq in angular_extend_fn(q1[2:], q2[2:])]
+
+        # Spline in the frame aligned with q1 -> q2 to avoid vertical segments
+        angle = math.atan2(y2 - y1, x2 - x1)
+        distance = math.hypot(x2 - x1, y2 - y1)
+        headings = [circular_difference(theta1, angle), circular_difference(theta2, angle)]
+        if max(map(abs, headings)) > max_heading:
+            return dubins_path(q1, q2, turning_radius, step_size=step_size)
+        dydx1, dydx2 = map(math.tan, headings)
         # TODO: dual-spline version that uses time
-        curve = Curve(CubicHermiteSpline(x=[x1, x2], y=[y1, y2], dydx=[dydx1, dydx2]))
+        curve = Curve(CubicHermiteSpline(x=[0., distance], y=[0., 0.], dydx=[dydx1, dydx2]))
         # print(curve.poly)
         # print(curve.poly.c.shape)
         # print(curve) # ValueError: not enough values to unpack (expected 3, got 2)
         derivative = curve.derivative()
         path = []
-        for x in curve.sample_times(dt=dx):
-            y = curve.at(x)
-            dydx = derivative.at(x)
-            theta = math.atan(dydx) # atan2
+        for s in curve.sample_times(dt=dx):
+            t = curve.at(s)
+            x = x1 + s*math.cos(angle) - t*math.sin(angle)
+            y = y1 + s*math.sin(angle) + t*math.cos(angle)
+            theta = wrap_angle(angle + math.atan(derivative.at(s))) # atan2
             q = [x, y, theta]
             path.append(q)
-        if swap:
-            path = path[::-1]
         return path
     return extend_fn
 
@@ -4400,15 +4815,23 @@ def plan_nonholonomic_motion(body, joints, end_conf, obstacles=[], attachments=[
                              self_collisions=True, disabled_collisions=set(),
                              weights=None, resolutions=None, reversible=True,
                              linear_tol=EPSILON, angular_tol=0.,
-                             max_distance=MAX_DISTANCE, use_aabb=False, cache=True, custom_limits={}, algorithm=None, **kwargs):
+                             max_distance=MAX_DISTANCE, use_aabb=False, cache=True, custom_limits={}, algorithm=None,
+                             turning_radius=None, **kwargs):
+    # turning_radius: if not None, steers using Dubins curves with this minimum turning radius (meters)
 
     assert len(joints) == len(end_conf) == 3
     sample_fn = get_sample_fn(body, joints, custom_limits=custom_limits)
-    distance_fn = get_nonholonomic_distance_fn(body, joints, weights=weights, reversible=reversible,
-                                               linear_tol=linear_tol) #, angular_tol=angular_tol)
-    extend_fn = get_nonholonomic_extend_fn(body, joints, resolutions=resolutions, reversible=reversible,
-                                           linear_tol=linear_tol, angular_tol=angular_tol)
-    #extend_fn = get_dubins_extend_fn(body, joints, resolutions=resolutions, reversible=reversible) # TODO: distance_fn
+    if turning_radius is None:
+        distance_fn = get_nonholonomic_distance_fn(body, joints, weights=weights, reversible=reversible,
+                                                   linear_tol=linear_tol) #, angular_tol=angular_tol)
+        extend_fn = get_nonholonomic_extend_fn(body, joints, resolutions=resolutions, reversible=reversible,
+                                               linear_tol=linear_tol, angular_tol=angular_tol)
+    else:
+        # TODO: the second tree of birrt is traversed backwards when not reversible
+        step_size = np.min(get_default_resolutions(body, joints, resolutions)[:2])
+        distance_fn = get_dubins_distance_fn(body, joints, turning_radius=turning_radius, reversible=reversible)
+        extend_fn = get_dubins_extend_fn(body, joints, turning_radius=turning_radius, step_size=step_size,
+                                         reversible=reversible)
     collision_fn = get_collision_fn(body, joints, obstacles, attachments,
                                     self_collisions, disabled_collisions,
                                     custom_limits=custom_limits, max_distance=max_distance,
@@ -4423,7 +4846,8 @@ def plan_nonholonomic_motion(body, joints, end_conf, obstacles=[], attachments=[
         return birrt(start_conf, end_conf, distance_fn, sample_fn, extend_fn, collision_fn, **kwargs)
     path = solve(start_conf, end_conf, distance_fn, sample_fn, extend_fn, collision_fn,
                  algorithm=algorithm, **kwargs) # weights=weights, # TODO: deliberately excluding for PRM unless circular
-    #return path
+    if turning_radius is not None:
+        return path # Already drivable
     return shortcut_circular(body, joints, path, extend_fn, collision_fn)
 
 plan_differential_motion = plan_nonholonomic_motion
@@ -4500,6 +4924,33 @@ def shortcut_path(robot, joints, path, obstacles=[], attachments=[],
                                     custom_limits=custom_limits, use_aabb=use_aabb, cache=cache, max_distance=max_distance)
     return shortcut(path, extend_fn, collision_fn, cost_fn=cost_fn, distance_fn=distance_fn, **kwargs)
 
+def compress_path(robot, joints, path, obstacles=[], attachments=[],
+                  self_collisions=True, disabled_collisions=set(),
+                  resolutions=None, max_distance=MAX_DISTANCE,
+                  use_aabb=False, cache=True, custom_limits={},
+                  tolerance=1e-3, max_deviation=1e-2, weights=None, **kwargs):
+    """
+    Reduces dense planner output to the waypoints needed to reproduce it within max_deviation before retiming
+    Shortened segments are collision checked again because they deviate from the original path
+    """
+    if path is None:
+        return None
+    path = adjust_path(robot, joints, path)
+    waypoints = waypoints_from_path(path, tolerance=tolerance)
+    if max_deviation == 0:
+        return waypoints
+    extend_fn = get_extend_fn(robot, joints, resolutions=resolutions)
+    collision_fn = get_collision_fn(robot, joints, obstacles, attachments, self_collisions, disabled_collisions,
+                                    custom_limits=custom_limits, use_aabb=use_aabb, cache=cache,
+                                    max_distance=max_distance, **kwargs)
+    circular_joints = np.array([is_circular(robot, joint) for joint in joints], dtype=bool)
+    def validity_fn(q1, q2):
+        # extend_fn would take the shorter direction around circular joints
+        if np.any(circular_joints & (PI <= np.abs(np.subtract(q2, q1)))):
+            return False
+        return not any(collision_fn(q) for q in extend_fn(q1, q2))
+    return simplify_path(waypoints, max_deviation=max_deviation, weights=weights, validity_fn=validity_fn)
+
 def smooth_path(robot, joints, path, obstacles=[], attachments=[],
                 self_collisions=True, disabled_collisions=set(),
                 resolutions=None, max_distance=MAX_DISTANCE,
@@ -4517,6 +4968,68 @@ def smooth_path(robot, joints, path, obstacles=[], attachments=[],
     curve = smooth_cubic(path, collision_fn, resolutions, max_velocities, max_accelerations, **kwargs)
     return curve
 
+def spline_smooth_path(robot, joints, path, obstacles=[], attachments=[],
+                       self_collisions=True, disabled_collisions=set(),
+                       resolutions=None, max_distance=MAX_DISTANCE,
+                       use_aabb=False, cache=True, custom_limits={},
+                       max_velocities=None, max_accelerations=None, duration_to_max=1.,
+                       max_time=1., max_iterations=INF, shortcut_fraction=0.5, seed=None):
+    """
+    In-tree alternative to smooth_path that shortcuts the path and fits a clamped cubic spline through its waypoints
+    Configurations from the shortcut path are added as knots wherever samples of the spline are in collision
+    :param max_time: wall-clock budget (seconds) covering shortcutting and spline validation
+    :param shortcut_fraction: fraction of max_time spent shortcutting
+    :param seed: the random seed used for shortcutting
+    :return: a CubicSpline of the positions over time or a piecewise-linear interp1d curve if the budget runs out
+    """
+    if path is None:
+        return None
+    from scipy.interpolate import CubicSpline, interp1d
+    from .retime import ramp_retime_path
+    start_time = time.time()
+    path = adjust_path(robot, joints, path)
+    resolutions = get_default_resolutions(robot, joints, resolutions)
+    max_velocities, max_accelerations = get_dynamical_limits(robot, joints, max_velocities, max_accelerations, duration_to_max)
+    acceleration_fraction = np.divide(max_accelerations, max_velocities)
+    distance_fn = get_distance_fn(robot, joints, weights=np.reciprocal(resolutions))
+    extend_fn = get_extend_fn(robot, joints, resolutions=resolutions)
+    collision_fn = get_collision_fn(robot, joints, obstacles, attachments, self_collisions, disabled_collisions,
+                                    custom_limits=custom_limits, use_aabb=use_aabb, cache=cache, max_distance=max_distance)
+    limits_fn = get_batch_limits_fn(robot, joints, custom_limits=custom_limits)
+
+    set_random_seed(seed)
+    for path in shortcut_generator(path, extend_fn, collision_fn, distance_fn=distance_fn,
+                                   max_iterations=max_iterations, max_time=shortcut_fraction*max_time):
+        pass
+    path = np.array(adjust_path(robot, joints, path)) # extend_fn wraps circular joints
+    if len(path) <= 1:
+        return None
+
+    indices = get_waypoint_indices(path)
+    while elapsed_time(start_time) < max_time:
+        waypoints = path[indices]
+        _, time_from_starts = ramp_retime_path(list(waypoints), max_velocities, acceleration_fraction)
+        curve = CubicSpline(time_from_starts, waypoints, bc_type='clamped', extrapolate=False)
+        colliding = []
+        for k, (t1, t2) in enumerate(get_pairs(time_from_starts)):
+            if elapsed_time(start_time) >= max_time:
+                colliding.append(k) # Unverified
+                break
+            num_steps = 2*int(np.max(np.abs(waypoints[k+1] - waypoints[k]) / resolutions)) + 2
+            confs = curve(np.linspace(t1, t2, num=num_steps, endpoint=False)[1:])
+            # Checks the joint limits of every sample at once before any collisions
+            if np.any(limits_fn(confs)) or any(collision_fn(q) for q in confs):
+                colliding.append(k)
+        if not colliding:
+            return curve
+        new_indices = {(indices[k] + indices[k+1]) // 2 for k in colliding if (indices[k+1] - indices[k]) > 1}
+        if (len(new_indices) < len(colliding)) or (elapsed_time(start_time) >= max_time):
+            break
+        indices = sorted(set(indices) | new_indices)
+    # The shortcut path itself is collision-free
+    _, time_from_starts = ramp_retime_path(list(path), max_velocities, acceleration_fraction)
+    return interp1d(time_from_starts, path, kind='linear', axis=0, assume_sorted=True)
+
 def discretize_curve(body, joints, curve, resolutions=None, **kwargs):
     if curve is None:
         return None
@@ -4547,7 +5060,14 @@ def get_base_distance_fn(weights=1*np.ones(3)):
 
 def plan_base_motion(body, end_conf, base_limits, obstacles=[], direct=False,
                      weights=1*np.ones(3), resolutions=0.05*np.ones(3),
-                     max_distance=MAX_DISTANCE, algorithm=None, **kwargs):
+                     max_distance=MAX_DISTANCE, algorithm=None, grid=False, **kwargs):
+    # grid: if True, searches a precomputed SE(2) obstacle map using GridBasePlanner,
+    # where kwargs are passed to plan_grid_base_motion (e.g. holonomic=False for differential-drive motion)
+    if grid:
+        from .voxels import plan_grid_base_motion
+        return plan_grid_base_motion(body, end_conf, base_limits, obstacles=obstacles, weights=weights,
+                                     resolution=np.min(resolutions[:2]), **kwargs)
+
     def sample_fn():
         x, y = np.random.uniform(*base_limits)
         theta = np.random.uniform(*CIRCULAR_LIMITS)
@@ -5266,27 +5786,125 @@ def get_null_space(robot, joints, custom_limits={}):
     joint_ranges = 10*np.ones(len(joints))
     return NullSpace(list(lower), list(upper), list(joint_ranges), list(rest_positions))
 
-def create_sub_robot(robot, first_joint, target_link):
-    # TODO: create a class or generator for repeated use
+def create_sub_robot(robot, first_joint, target_link, client=None):
     selected_links = get_link_subtree(robot, first_joint) # TODO: child_link_from_joint?
     selected_joints = prune_fixed_joints(robot, selected_links)
     assert(target_link in selected_links)
     sub_target_link = selected_links.index(target_link)
-    sub_robot = clone_body(robot, links=selected_links, visual=False, collision=False) # TODO: joint limits
-    assert len(selected_joints) == len(get_movable_joints(sub_robot))
+    sub_robot = clone_body(robot, links=selected_links, visual=False, collision=False, client=client) # TODO: joint limits
+    with ClientSaver(client):
+        assert len(selected_joints) == len(get_movable_joints(sub_robot))
     return sub_robot, selected_joints, sub_target_link
 
+IK_CLIENT = None
+
+def get_ik_client():
+    # Separate DIRECT client that holds the sub-robots, so they never appear in the robot's world (e.g. get_bodies)
+    global IK_CLIENT
+    if IK_CLIENT is None:
+        with HideOutput():
+            IK_CLIENT = p.connect(p.DIRECT)
+    return IK_CLIENT
+
+class SubRobotIK(object):
+    # Clone of the kinematic chain from first_joint to target_link that is reused across IK queries
+
+    def __init__(self, robot, first_joint, target_link):
+        self.robot = robot
+        self.first_joint = first_joint
+        self.target_link = target_link
+        self.robot_client = CLIENT
+        self.client = get_ik_client()
+        self.base_link = get_link_parent(robot, first_joint)
+        self.signature = self.get_signature()
+        self.sub_robot, self.selected_joints, self.sub_target_link = create_sub_robot(
+            robot, first_joint, target_link, client=self.client)
+        ancestor_joints = prune_fixed_joints(robot, get_ordered_ancestors(robot, target_link))
+        self.ancestor_joints = ancestor_joints[ancestor_joints.index(first_joint):]
+        with ClientSaver(self.client):
+            self.sub_joints = get_movable_joints(self.sub_robot)
+            self.sub_ancestor_joints = prune_fixed_joints(
+                self.sub_robot, get_ordered_ancestors(self.sub_robot, self.sub_target_link))
+            sub_pose = get_pose(self.sub_robot)
+        self.base_from_sub = multiply(invert(get_link_pose(self.robot, self.base_link)), sub_pose)
+    @property
+    def key(self):
+        return (self.robot_client, self.robot, self.first_joint, self.target_link)
+    def get_signature(self):
+        # Body ids are reused after remove_body and reset_simulation, so the chain itself is compared
+        links = get_link_subtree(self.robot, self.first_joint)
+        return (get_body_name(self.robot), tuple(get_joint_names(self.robot, links)),
+                tuple(get_local_link_pose(self.robot, link) for link in links))
+    def is_valid(self):
+        if (CLIENT != self.robot_client) or (self.client != IK_CLIENT) or (self.robot not in get_bodies()):
+            return False
+        if (self.first_joint >= get_num_joints(self.robot)) or (self.get_signature() != self.signature):
+            return False
+        with ClientSaver(self.client):
+            return self.sub_robot in get_bodies()
+    def sync(self):
+        # Moves the sub-robot to the current base pose and configuration of the robot
+        pose = multiply(get_link_pose(self.robot, self.base_link), self.base_from_sub)
+        conf = get_joint_positions(self.robot, self.selected_joints)
+        with ClientSaver(self.client):
+            set_pose(self.sub_robot, pose)
+            set_joint_positions(self.sub_robot, self.sub_joints, conf)
+    def solve(self, target_pose, **kwargs):
+        # Single IK step on the sub-robot, which remains at the returned configuration
+        with ClientSaver(self.client):
+            sub_conf = inverse_kinematics_helper(self.sub_robot, self.sub_target_link, target_pose, **kwargs)
+            if sub_conf is not None:
+                set_joint_positions(self.sub_robot, self.sub_joints, sub_conf)
+        return sub_conf
+    def get_target_pose(self):
+        with ClientSaver(self.client):
+            return get_link_pose(self.sub_robot, self.sub_target_link)
+    def remove(self):
+        if self.client != IK_CLIENT:
+            return
+        with ClientSaver(self.client):
+            if self.sub_robot in get_bodies():
+                remove_body(self.sub_robot)
+    def __repr__(self):
+        return '{}(robot={}, first_joint={}, target_link={})'.format(
+            self.__class__.__name__, self.robot, self.first_joint, self.target_link)
+
+SUB_ROBOTS = {}
+
+def get_sub_robot_ik(robot, first_joint, target_link, cache=True):
+    # Returns a synchronized SubRobotIK, which is reused across calls when cache=True
+    key = (CLIENT, robot, first_joint, target_link)
+    sub_robot_ik = SUB_ROBOTS.get(key, None) if cache else None
+    if (sub_robot_ik is None) or not sub_robot_ik.is_valid():
+        if sub_robot_ik is not None:
+            sub_robot_ik.remove()
+        sub_robot_ik = SubRobotIK(robot, first_joint, target_link)
+        if cache:
+            SUB_ROBOTS[key] = sub_robot_ik
+    sub_robot_ik.sync()
+    return sub_robot_ik
+
+def release_sub_robot_ik(sub_robot_ik):
+    if SUB_ROBOTS.get(sub_robot_ik.key, None) is not sub_robot_ik:
+        sub_robot_ik.remove()
+
+def remove_sub_robots():
+    global IK_CLIENT
+    SUB_ROBOTS.clear()
+    if IK_CLIENT is not None:
+        with HideOutput():
+            p.disconnect(physicsClientId=IK_CLIENT)
+    IK_CLIENT = None
+
 def multiple_sub_inverse_kinematics(robot, first_joint, target_link, target_pose, max_attempts=1, max_solutions=INF,
-                                    max_time=INF, custom_limits={}, first_close=True, **kwargs):
+                                    max_time=INF, custom_limits={}, first_close=True, cache=True, **kwargs):
     # TODO: gradient descent using collision_info
     start_time = time.time()
-    ancestor_joints = prune_fixed_joints(robot, get_ordered_ancestors(robot, target_link))
-    affected_joints = ancestor_joints[ancestor_joints.index(first_joint):]
-    sub_robot, selected_joints, sub_target_link = create_sub_robot(robot, first_joint, target_link)
-    #sub_joints = get_movable_joints(sub_robot)
+    sub_robot_ik = get_sub_robot_ik(robot, first_joint, target_link, cache=cache)
+    sub_robot, sub_target_link = sub_robot_ik.sub_robot, sub_robot_ik.sub_target_link
     #sub_from_real = dict(safe_zip(sub_joints, selected_joints))
-    sub_joints = prune_fixed_joints(sub_robot, get_ordered_ancestors(sub_robot, sub_target_link))
-    selected_joints = affected_joints
+    sub_joints = sub_robot_ik.sub_ancestor_joints
+    selected_joints = sub_robot_ik.ancestor_joints
     #sub_from_real = dict(safe_zip(sub_joints, selected_joints))
 
     #sample_fn = get_sample_fn(sub_robot, sub_joints, custom_limits=custom_limits) # [-PI, PI]
@@ -5296,14 +5914,16 @@ def multiple_sub_inverse_kinematics(robot, first_joint, target_link, target_pose
     for attempt in irange(max_attempts):
         if (len(solutions) >= max_solutions) or (elapsed_time(start_time) >= max_time):
             break
-        if not first_close or (attempt >= 1): # TODO: multiple seed confs
-            sub_conf = sample_fn()
-            set_joint_positions(sub_robot, sub_joints, sub_conf)
-        sub_kinematic_conf = inverse_kinematics(sub_robot, sub_target_link, target_pose,
-                                                max_time=max_time-elapsed_time(start_time), **kwargs)
+        sub_conf = sample_fn() if (not first_close or (attempt >= 1)) else None # TODO: multiple seed confs
+        with ClientSaver(sub_robot_ik.client):
+            if sub_conf is not None:
+                set_joint_positions(sub_robot, sub_joints, sub_conf)
+            sub_kinematic_conf = inverse_kinematics(sub_robot, sub_target_link, target_pose,
+                                                    max_time=max_time-elapsed_time(start_time), **kwargs)
+            if sub_kinematic_conf is not None:
+                #set_configuration(sub_robot, sub_kinematic_conf)
+                sub_kinematic_conf = get_joint_positions(sub_robot, sub_joints)
         if sub_kinematic_conf is not None:
-            #set_configuration(sub_robot, sub_kinematic_conf)
-            sub_kinematic_conf = get_joint_positions(sub_robot, sub_joints)
             set_joint_positions(robot, selected_joints, sub_kinematic_conf)
             kinematic_conf = get_configuration(robot) # TODO: test on the resulting robot state (e.g. collisions)
             #if not all_between(lower_limits, kinematic_conf, upper_limits):
@@ -5311,11 +5931,12 @@ def multiple_sub_inverse_kinematics(robot, first_joint, target_link, target_pose
     if solutions:
         set_configuration(robot, solutions[-1])
     # TODO: test for redundant configurations
-    remove_body(sub_robot)
+    release_sub_robot_ik(sub_robot_ik)
     return solutions
 
 def plan_cartesian_motion(robot, first_joint, target_link, waypoint_poses,
-                          max_iterations=200, max_time=INF, custom_limits={}, **kwargs):
+                          max_iterations=200, max_time=INF, custom_limits={}, cache=True, max_joint_step=None,
+                          **kwargs):
     # TODO: fix stationary joints
     # TODO: pass in set of movable joints and take least common ancestor
     # TODO: update with most recent bullet updates
@@ -5324,24 +5945,25 @@ def plan_cartesian_motion(robot, first_joint, target_link, waypoint_poses,
     # TODO: plan a path without needing to following intermediate waypoints
 
     lower_limits, upper_limits = get_custom_limits(robot, get_movable_joints(robot), custom_limits)
-    sub_robot, selected_joints, sub_target_link = create_sub_robot(robot, first_joint, target_link)
-    sub_joints = get_movable_joints(sub_robot)
+    sub_robot_ik = get_sub_robot_ik(robot, first_joint, target_link, cache=cache)
+    selected_joints = sub_robot_ik.selected_joints
     #null_space = get_null_space(robot, selected_joints, custom_limits=custom_limits)
     null_space = None
+    if max_joint_step is not None:
+        continuity_fn = get_continuity_fn(robot, get_movable_joints(robot), max_steps=max_joint_step)
 
     solutions = []
     for target_pose in waypoint_poses:
         start_time = time.time()
         for iteration in irange(max_iterations):
             if elapsed_time(start_time) >= max_time:
-                remove_body(sub_robot)
+                release_sub_robot_ik(sub_robot_ik)
                 return None
-            sub_kinematic_conf = inverse_kinematics_helper(sub_robot, sub_target_link, target_pose, null_space=null_space)
+            sub_kinematic_conf = sub_robot_ik.solve(target_pose, null_space=null_space)
             if sub_kinematic_conf is None:
-                remove_body(sub_robot)
+                release_sub_robot_ik(sub_robot_ik)
                 return None
-            set_joint_positions(sub_robot, sub_joints, sub_kinematic_conf)
-            if is_pose_close(get_link_pose(sub_robot, sub_target_link), target_pose, **kwargs):
+            if is_pose_close(sub_robot_ik.get_target_pose(), target_pose, **kwargs):
                 set_joint_positions(robot, selected_joints, sub_kinematic_conf)
                 kinematic_conf = get_configuration(robot)
                 if not all_between(lower_limits, kinematic_conf, upper_limits):
@@ -5350,16 +5972,21 @@ def plan_cartesian_motion(robot, first_joint, target_link, waypoint_poses,
                     #       zip(movable_joints, lower_limits, kinematic_conf, upper_limits) if not (l <= v <= u)])
                     #print("Limits violated")
                     #wait_if_gui()
-                    remove_body(sub_robot)
+                    release_sub_robot_ik(sub_robot_ik)
                     return None
                 #print("IK iterations:", iteration)
+                if (max_joint_step is not None) and solutions and \
+                        (continuity_fn([solutions[-1], kinematic_conf]) is not None):
+                    # Each waypoint is warm-started from the previous one, so a jump indicates a branch switch
+                    release_sub_robot_ik(sub_robot_ik)
+                    return None
                 solutions.append(kinematic_conf)
                 break
         else:
-            remove_body(sub_robot)
+            release_sub_robot_ik(sub_robot_ik)
             return None
     # TODO: finally:
-    remove_body(sub_robot)
+    release_sub_robot_ik(sub_robot_ik)
     return solutions
 
 def sub_inverse_kinematics(robot, first_joint, target_link, target_pose, **kwargs):
@@ -5370,6 +5997,114 @@ def sub_inverse_kinematics(robot, first_joint, target_link, target_pose, **kwarg
 
 #####################################
 
+class IKCache(object):
+    # LRU cache of IK solutions keyed by (robot, group, base frame, quantized target pose, free joint bin)
+
+    def __init__(self, max_size=10000, pos_resolution=1e-3, ori_resolution=1e-2, free_resolution=1e-2):
+        self.max_size = max_size
+        self.pos_resolution = pos_resolution
+        self.ori_resolution = ori_resolution
+        self.free_resolution = free_resolution
+        self.solutions_from_key = collections.OrderedDict()
+        self.hits = self.misses = 0
+    def __len__(self):
+        return len(self.solutions_from_key)
+
+    def quantize_pose(self, pose):
+        point, quat = pose
+        quat = np.array(quat)
+        if quat[3] < 0: # q and -q are the same rotation
+            quat = -quat
+        return tuple(np.round(np.divide(point, self.pos_resolution)).astype(int)), \
+               tuple(np.round(np.divide(quat, self.ori_resolution)).astype(int))
+    def get_key(self, robot, group, target_pose, base_link=BASE_LINK, free_joints=[]):
+        # The target is expressed in the base frame so that entries are reused as the base moves
+        base_from_target = multiply(invert(get_link_pose(robot, base_link)), target_pose)
+        free_bin = tuple(np.round(np.divide(get_joint_positions(robot, free_joints),
+                                            self.free_resolution)).astype(int))
+        return (robot, group, base_link, self.quantize_pose(base_from_target), free_bin)
+
+    def lookup(self, key):
+        if key not in self.solutions_from_key:
+            return []
+        self.solutions_from_key.move_to_end(key)
+        return self.solutions_from_key[key]
+    def add(self, key, conf, tolerance=1e-3):
+        solutions = self.lookup(key)
+        if any(all_close(conf, solution, atol=tolerance) for solution in solutions):
+            return False
+        self.solutions_from_key[key] = solutions + [tuple(conf)]
+        self.solutions_from_key.move_to_end(key)
+        while len(self.solutions_from_key) > self.max_size:
+            self.solutions_from_key.popitem(last=False)
+        return True
+    def nearest(self, key):
+        # Returns the solutions of the entry whose quantized pose is closest to that of key
+        robot, group, base_link, (point, quat), _ = key
+        candidates = [other for other in self.solutions_from_key if other[:3] == (robot, group, base_link)]
+        if not candidates:
+            return []
+        points = self.pos_resolution*np.array([other[3][0] for other in candidates])
+        quats = self.ori_resolution*np.array([other[3][1] for other in candidates])
+        pos_distances = np.linalg.norm(points - self.pos_resolution*np.array(point), axis=1)
+        ori_distances = 2*np.arccos(np.clip(np.abs(quats.dot(self.ori_resolution*np.array(quat))), 0., 1.))
+        index = np.argmin(pos_distances + ori_distances)
+        return self.lookup(candidates[index])
+
+    def retrieve(self, robot, joints, link, target_pose, group=None, base_link=BASE_LINK, free_joints=[],
+                 test_fn=lambda q: True, **kwargs):
+        # Returns a cached solution that achieves target_pose and satisfies test_fn (evaluated while assigned)
+        key = self.get_key(robot, group, target_pose, base_link=base_link, free_joints=free_joints)
+        with ConfSaver(robot, joints=joints):
+            for conf in self.lookup(key):
+                set_joint_positions(robot, joints, conf)
+                if is_pose_close(get_link_pose(robot, link), target_pose, **kwargs) and test_fn(conf):
+                    self.hits += 1
+                    return conf
+        self.misses += 1
+        return None
+    def warm_start(self, robot, joints, target_pose, group=None, base_link=BASE_LINK, free_joints=[]):
+        # Assigns the cached solution for the nearest target pose to seed an iterative solver
+        key = self.get_key(robot, group, target_pose, base_link=base_link, free_joints=free_joints)
+        solutions = self.nearest(key)
+        if not solutions:
+            return None
+        nearest_fn = get_nearest_fn(robot, joints)
+        [index], _ = nearest_fn(get_joint_positions(robot, joints), solutions)
+        conf = solutions[index]
+        set_joint_positions(robot, joints, conf)
+        return conf
+    def store(self, robot, joints, target_pose, group=None, base_link=BASE_LINK, free_joints=[]):
+        # Records the current configuration of joints as a solution for target_pose
+        key = self.get_key(robot, group, target_pose, base_link=base_link, free_joints=free_joints)
+        return self.add(key, get_joint_positions(robot, joints))
+
+    def solve(self, robot, joints, link, target_pose, ik_fn, group=None, base_link=BASE_LINK, free_joints=[],
+              warm_start=False, test_fn=lambda q: True, **kwargs):
+        """
+        Retrieves a cached solution or otherwise calls ik_fn to solve from the current state
+        :param ik_fn: function that solves for target_pose from the current state and returns None upon failure
+        :param warm_start: if True, assigns the nearest cached solution before calling ik_fn (only for iterative solvers)
+        :param test_fn: function that filters cached solutions (e.g. collision checking)
+        :return: a configuration for joints (also assigned) or None
+        """
+        frame_kwargs = dict(group=group, base_link=base_link, free_joints=free_joints)
+        conf = self.retrieve(robot, joints, link, target_pose, test_fn=test_fn, **frame_kwargs, **kwargs)
+        if conf is not None:
+            set_joint_positions(robot, joints, conf)
+            return conf
+        if warm_start:
+            self.warm_start(robot, joints, target_pose, **frame_kwargs)
+        if ik_fn() is None:
+            return None
+        self.store(robot, joints, target_pose, **frame_kwargs)
+        return get_joint_positions(robot, joints)
+    def __repr__(self):
+        return '{}(entries={}, hits={}, misses={})'.format(
+            self.__class__.__name__, len(self), self.hits, self.misses)
+
+#####################################
+
 def get_lifetime(lifetime):
     if lifetime is None:
         return 0
@@ -1,7 +1,10 @@
+import math
 import os
 import pybullet as p
 import numpy as np
+import random
 import time
+from heapq import heappush, heappop
 from itertools import product
 
 from .utils import unit_pose, safe_zip, multiply, Pose, AABB, create_box, set_pose, get_all_links, LockRenderer, \
@@ -9,7 +12,7 @@ from .utils import unit_pose, safe_zip, multiply, Pose, AABB, create_box, set_po
     unit_quat, unit_point, CLIENT, create_shape_array, set_color, get_point, clip, load_model, TEMP_DIR, NULL_ID, \
     elapsed_time, draw_point, invert, tform_point, draw_pose, get_aabb_edges, add_line, TRANSPARENT, INF, \
     get_pose, PoseSaver, get_aabb_vertices, aabb_from_points, apply_affine, OOBB, draw_oobb, get_aabb_center, \
-    MAX_RGB, apply_alpha, RED, Euler, PI, Point, flatten
+    MAX_RGB, apply_alpha, RED, Euler, PI, Point, flatten, wrap_angle, get_base_values
 
 MAX_TEXTURE_WIDTH = 418 # max square dimension
 MAX_PIXEL_VALUE = MAX_RGB
@@ -451,6 +454,664 @@ class VoxelGrid(object):
         return body
 
 
+################################################################################
+
+# 2D base planning
+
+class OccupancyGrid2D(object):
+    # Axis-aligned occupancy grid over the floor plane used for mobile base planning
+
+    def __init__(self, base_limits, resolution=0.05):
+        lower, upper = base_limits
+        self.lower = np.array(lower[:2], dtype=float)
+        self.upper = np.array(upper[:2], dtype=float)
+        self.resolution = resolution
+        shape = np.maximum(np.ceil((self.upper - self.lower) / resolution).astype(int), 1)
+        self.occupied = np.zeros(shape, dtype=bool)
+    @property
+    def shape(self):
+        return self.occupied.shape
+    def __len__(self):
+        return int(np.count_nonzero(self.occupied))
+
+    def cell_from_point(self, point):
+        return tuple(np.floor((np.array(point[:2]) - self.lower) / self.resolution).astype(int))
+    def point_from_cell(self, cell):
+        return self.lower + self.resolution*(np.array(cell[:2]) + 0.5)
+    def contains(self, cell):
+        return all(0 <= i < n for i, n in safe_zip(cell[:2], self.shape))
+    def is_occupied(self, cell):
+        return not self.contains(cell) or self.occupied[tuple(cell[:2])]
+
+    def add_aabb(self, aabb):
+        lower, upper = aabb
+        (i1, j1), (i2, j2) = self.cell_from_point(lower), self.cell_from_point(upper)
+        i1, j1 = max(i1, 0), max(j1, 0)
+        i2, j2 = min(i2, self.shape[0] - 1), min(j2, self.shape[1] - 1)
+        if (i1 <= i2) and (j1 <= j2):
+            self.occupied[i1:i2+1, j1:j2+1] = True
+    def add_bodies(self, bodies, z_limits=(-INF, INF)):
+        # Conservatively rasterizes the link AABBs that vertically overlap z_limits
+        min_z, max_z = z_limits
+        for body in bodies:
+            for link in get_all_links(body):
+                aabb = get_aabb(body, link)
+                if (min_z < aabb[1][2]) and (aabb[0][2] < max_z):
+                    self.add_aabb(aabb)
+    def add_voxel_grid(self, voxel_grid, voxels=None, z_limits=(-INF, INF)):
+        # Rasterizes the columns returned by VoxelGrid.project2d of the voxels whose centers are within z_limits
+        min_z, max_z = z_limits
+        if voxels is None:
+            voxels = voxel_grid.occupied
+        voxels = [voxel for voxel in voxels
+                  if min_z < voxel_grid.to_world(voxel_grid.center_from_voxel(voxel))[2] < max_z]
+        for voxel in voxel_grid.project2d(voxels=voxels):
+            self.add_aabb(aabb_from_points(voxel_grid.vertices_from_voxel(voxel)))
+
+    def dilate(self, offsets):
+        # A cell is in collision if any of its offset cells is occupied (or out of bounds)
+        offsets = np.array(offsets, dtype=int).reshape(-1, 2)
+        padding = int(np.max(np.abs(offsets))) if len(offsets) else 0
+        padded = np.pad(self.occupied, padding, mode='constant', constant_values=True)
+        width, height = self.shape
+        collisions = np.zeros(self.shape, dtype=bool)
+        for di, dj in offsets:
+            collisions |= padded[padding+di:padding+di+width, padding+dj:padding+dj+height]
+        return collisions
+    def draw(self, z=0., **kwargs):
+        with LockRenderer():
+            handles = []
+            for cell in zip(*np.nonzero(self.occupied)):
+                lower = np.append(self.lower + self.resolution*np.array(cell), [z])
+                handles.extend(draw_aabb(AABB(lower, lower + self.resolution*np.array([1, 1, 0])), **kwargs))
+            return handles
+
+
+def get_footprint(body, padding=0.):
+    # 2D rectangles (in the body frame) covering the link AABBs when the body is at the origin
+    with PoseSaver(body):
+        set_pose(body, Pose(point=Point(z=get_point(body)[2])))
+        rectangles = []
+        for link in get_all_links(body):
+            lower, upper = get_aabb(body, link)
+            rectangles.append(AABB(np.array(lower[:2]) - padding, np.array(upper[:2]) + padding))
+        return rectangles, get_aabb(body)
+
+
+def get_footprint_offsets(rectangles, theta, resolution):
+    # Cell offsets (relative to the body cell) swept by the footprint rotated by theta
+    step = resolution / 2.
+    points = []
+    for lower, upper in rectangles:
+        xs = np.append(np.arange(lower[0], upper[0], step), [upper[0]])
+        ys = np.append(np.arange(lower[1], upper[1], step), [upper[1]])
+        points.append(np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2))
+    points = np.vstack(points)
+    rotation = np.array([[np.cos(theta), -np.sin(theta)],
+                         [np.sin(theta), np.cos(theta)]])
+    rotated = points.dot(rotation.T)
+    return np.unique(np.round(rotated / resolution).astype(int), axis=0)
+
+
+class GridBasePlanner(object):
+    # Precomputes an SE(2) configuration-space obstacle map per discretized yaw and queries it using A*
+    # Holonomic queries search the (cell, yaw) lattice, and non-holonomic queries use hybrid A*,
+    # which expands continuous (x, y, theta) states using precomputed differential-drive motion primitives
+    # and only uses a coarser (cell, yaw) lattice with step_size cells for duplicate detection
+
+    def __init__(self, body, base_limits, obstacles=[], resolution=0.05, num_yaws=16,
+                 padding=None, floor_tolerance=1e-2, voxel_grid=None, weights=1*np.ones(3), step_size=None,
+                 connect_period=10):
+        start_time = time.time()
+        if padding is None:
+            padding = resolution / 2.
+        if step_size is None:
+            step_size = 4*resolution # Primitives leave the duplicate detection cell
+        self.body = body
+        self.num_yaws = num_yaws
+        self.yaws = np.array([wrap_angle(2*PI*k / num_yaws) for k in range(num_yaws)])
+        self.grid = OccupancyGrid2D(base_limits, resolution=resolution)
+        self.weights = np.array(weights, dtype=float)
+        translation_cost = lambda di, dj: resolution*np.sqrt(weights[0]*di**2 + weights[1]*dj**2)
+        self.translations = [((di, dj), translation_cost(di, dj))
+                             for di, dj in product([-1, 0, +1], repeat=2) if (di, dj) != (0, 0)]
+        self.rotation_cost = np.sqrt(weights[2])*2*PI / num_yaws
+        # Arcs of length step_size change the yaw by one discretized yaw
+        self.step_size = step_size
+        self.turning_radius = step_size / (2*PI / num_yaws)
+        self.key_resolution = step_size
+        self.connect_period = connect_period # Expansions between attempts to analytically connect to the goal
+        self.primitives = {reversible: self.compute_primitives(reversible) for reversible in [True, False]}
+        rectangles, robot_aabb = get_footprint(body, padding=padding)
+        z_limits = (robot_aabb[0][2] + floor_tolerance, robot_aabb[1][2])
+        self.grid.add_bodies(obstacles, z_limits=z_limits)
+        if voxel_grid is not None:
+            self.grid.add_voxel_grid(voxel_grid, z_limits=z_limits)
+        self.collisions = np.array([self.grid.dilate(get_footprint_offsets(rectangles, theta, resolution))
+                                    for theta in self.yaws])
+        self.free = (~self.collisions).tolist() # Python lists are faster to index than arrays
+        self.cost_to_go = {}
+        self.build_time = elapsed_time(start_time)
+
+    @property
+    def resolution(self):
+        return self.grid.resolution
+    def yaw_index(self, theta):
+        return int(round(theta * self.num_yaws / (2*PI))) % self.num_yaws
+    def key_from_conf(self, conf):
+        # Coarser lattice state used by hybrid A* for duplicate detection
+        lower_x, lower_y = self.grid.lower
+        return (int(math.floor((conf[0] - lower_x) / self.key_resolution)),
+                int(math.floor((conf[1] - lower_y) / self.key_resolution)), self.yaw_index(conf[2]))
+    def state_from_conf(self, conf):
+        i, j = self.grid.cell_from_point(conf[:2])
+        return (i, j, self.yaw_index(conf[2]))
+    def conf_from_state(self, state):
+        i, j, k = state
+        x, y = self.grid.point_from_cell((i, j))
+        return (float(x), float(y), float(self.yaws[k]))
+    def is_colliding(self, state):
+        i, j, k = state
+        return not self.grid.contains((i, j)) or not self.free[k][i][j]
+    def colliding_from_confs(self, confs):
+        # Vectorized is_colliding over an array of configurations with shape (..., 3)
+        confs = np.array(confs, dtype=float)
+        cells = np.floor((confs[..., :2] - self.grid.lower) / self.resolution).astype(int)
+        yaws = np.round(wrap_angle(confs[..., 2]) * self.num_yaws / (2*PI)).astype(int) % self.num_yaws
+        inside = np.all((0 <= cells) & (cells < self.grid.shape), axis=-1)
+        colliding = ~inside
+        colliding[inside] = self.collisions[yaws[inside], cells[inside][:, 0], cells[inside][:, 1]]
+        return colliding
+    def is_path_colliding(self, confs):
+        return bool(np.any(self.colliding_from_confs(confs)))
+    def get_cost(self, conf1, conf2):
+        dx, dy = conf2[0] - conf1[0], conf2[1] - conf1[1]
+        dtheta = wrap_angle(conf2[2] - conf1[2])
+        return np.sqrt(self.weights[0]*dx**2 + self.weights[1]*dy**2 + self.weights[2]*dtheta**2)
+    def get_path_costs(self, conf, paths):
+        # Vectorized cost of each path with shape (num_paths, num_steps, 3) that starts from conf
+        previous = np.concatenate([np.broadcast_to(conf, (len(paths), 1, 3)), paths[:, :-1]], axis=1)
+        differences = paths - previous
+        differences[..., 2] = wrap_angle(differences[..., 2])
+        return np.sum(np.sqrt(np.dot(np.square(differences), self.weights)), axis=1)
+    def get_connection_cost(self, conf, end_conf, reversible=True):
+        # Cost of the rotate-drive-rotate connection used by connect_goal, which is the Reeds-Shepp distance
+        # (or Dubins distance when not reversible) of a differential drive that can rotate in place
+        dx, dy = end_conf[0] - conf[0], end_conf[1] - conf[1]
+        distance = math.sqrt(self.weights[0]*dx**2 + self.weights[1]*dy**2)
+        rotation_weight = math.sqrt(self.weights[2])
+        if distance == 0.:
+            return rotation_weight*abs(math.remainder(end_conf[2] - conf[2], 2*PI))
+        return distance + rotation_weight*min(get_rotation(conf, end_conf, heading)
+                                              for _, heading in get_headings(conf, end_conf, reversible))
+
+    def get_neighbors(self, state):
+        # Holonomic lattice: rotate in place or translate to an adjacent cell
+        i, j, k = state
+        for dk in [-1, +1]:
+            yield (i, j, (k + dk) % self.num_yaws), self.rotation_cost
+        for (di, dj), cost in self.translations:
+            yield (i + di, j + dj, k), cost
+
+    def sample_primitive(self, conf, distance, curvature=0., rotation=0., num_steps=None):
+        # Integrates the unicycle model along a signed distance with a curvature or rotates in place
+        if num_steps is None:
+            num_steps = max(int(np.ceil(max(abs(distance) / (self.resolution / 2.),
+                                            abs(rotation) / (2*PI / self.num_yaws)))), 1)
+        x, y, theta = conf
+        fractions = np.linspace(0., 1., num=num_steps + 1)[1:]
+        lengths = fractions*distance
+        thetas = theta + fractions*rotation + curvature*lengths
+        if curvature == 0.:
+            xs, ys = x + lengths*np.cos(theta), y + lengths*np.sin(theta)
+        else:
+            xs = x + (np.sin(thetas) - np.sin(theta)) / curvature
+            ys = y - (np.cos(thetas) - np.cos(theta)) / curvature
+        return np.column_stack([xs, ys, wrap_angle(thetas)])
+    def compute_primitives(self, reversible=True):
+        # Differential-drive motion primitives in the body frame: rotate in place, drive straight,
+        # or drive along an arc that changes the yaw by one discretized yaw
+        num_steps = int(np.ceil(self.step_size / (self.resolution / 2.)))
+        primitives = [self.sample_primitive(np.zeros(3), distance=0., rotation=rotation, num_steps=num_steps)
+                      for rotation in [-2*PI / self.num_yaws, +2*PI / self.num_yaws]]
+        for direction in ([+1, -1] if reversible else [+1]):
+            for steering in [-1, 0, +1]:
+                primitives.append(self.sample_primitive(np.zeros(3), distance=direction*self.step_size,
+                                                        curvature=steering / self.turning_radius,
+                                                        num_steps=num_steps))
+        return np.array(primitives)
+    def get_primitives(self, conf, reversible=True):
+        # Transforms the precomputed primitives into the frame of conf
+        primitives = self.primitives[reversible]
+        x, y, theta = conf
+        cos, sin = math.cos(theta), math.sin(theta)
+        paths = np.empty(primitives.shape)
+        paths[..., 0] = x + cos*primitives[..., 0] - sin*primitives[..., 1]
+        paths[..., 1] = y + sin*primitives[..., 0] + cos*primitives[..., 1]
+        paths[..., 2] = wrap_angle(theta + primitives[..., 2])
+        return paths
+    def connect_goal(self, conf, end_conf, reversible=True):
+        # Analytic expansion that rotates to face end_conf, drives straight to it, and rotates to its yaw
+        distance = np.linalg.norm(np.array(end_conf[:2]) - np.array(conf[:2]))
+        if distance == 0.:
+            return self.sample_primitive(conf, distance=0., rotation=wrap_angle(end_conf[2] - conf[2]))
+        direction, heading = min(get_headings(conf, end_conf, reversible),
+                                 key=lambda pair: get_rotation(conf, end_conf, pair[1]))
+        rotation1 = self.sample_primitive(conf, distance=0., rotation=wrap_angle(heading - conf[2]))
+        translation = self.sample_primitive(rotation1[-1], distance=direction*distance)
+        rotation2 = self.sample_primitive(translation[-1], distance=0., rotation=wrap_angle(end_conf[2] - heading))
+        path = np.vstack([rotation1, translation, rotation2])
+        path[-1] = end_conf
+        return path
+
+    def compute_cost_to_go(self, goal_cell):
+        # Cost-to-go of the planar relaxation, which is free wherever any yaw is collision-free
+        if goal_cell in self.cost_to_go:
+            return self.cost_to_go[goal_cell]
+        free = (~np.all(self.collisions, axis=0)).tolist()
+        width, height = self.grid.shape
+        cost_to_go = [[INF]*height for _ in range(width)]
+        i, j = goal_cell
+        cost_to_go[i][j] = 0.
+        queue = [(0., i, j)]
+        while queue:
+            cost, i, j = heappop(queue)
+            if cost > cost_to_go[i][j]:
+                continue
+            for (di, dj), step_cost in self.translations:
+                ni, nj = i + di, j + dj
+                if not ((0 <= ni < width) and (0 <= nj < height) and free[ni][nj]):
+                    continue
+                new_cost = cost + step_cost
+                if new_cost < cost_to_go[ni][nj]:
+                    cost_to_go[ni][nj] = new_cost
+                    heappush(queue, (new_cost, ni, nj))
+        self.cost_to_go[goal_cell] = cost_to_go
+        return cost_to_go
+
+    def compute_heuristic(self, goal_state):
+        cost_to_go = self.compute_cost_to_go(goal_state[:2])
+        def fn(state):
+            i, j, k = state
+            steps = abs(k - goal_state[2]) % self.num_yaws
+            return cost_to_go[i][j] + min(steps, self.num_yaws - steps)*self.rotation_cost
+        return fn
+    def compute_hybrid_heuristic(self, end_conf, reversible=True):
+        # Maximum of the planar cost-to-go, which accounts for obstacles,
+        # and the connection cost, which accounts for the heading
+        cost_to_go = self.compute_cost_to_go(self.state_from_conf(end_conf)[:2])
+        (lower_x, lower_y), resolution = self.grid.lower, self.resolution
+        def fn(conf):
+            i, j = int(math.floor((conf[0] - lower_x) / resolution)), int(math.floor((conf[1] - lower_y) / resolution))
+            return max(cost_to_go[i][j], self.get_connection_cost(conf, end_conf, reversible=reversible))
+        return fn
+
+    def plan(self, start_conf, end_conf, holonomic=True, reversible=True, heuristic_weight=1.5, max_time=INF,
+             verbose=False):
+        start_time = time.time()
+        start_state = self.state_from_conf(start_conf)
+        goal_state = self.state_from_conf(end_conf)
+        if self.is_colliding(start_state) or self.is_colliding(goal_state):
+            if verbose:
+                print('Start or end configuration is in collision')
+            return None
+        if holonomic:
+            heuristic_fn = self.compute_heuristic(goal_state)
+            path, iterations = self.plan_lattice(start_state, goal_state, heuristic_fn, start_time, max_time)
+            if path is not None:
+                path = [tuple(start_conf)] + path[1:-1] + [tuple(end_conf)]
+        else:
+            heuristic_fn = self.compute_hybrid_heuristic(end_conf, reversible=reversible)
+            path, iterations = self.plan_hybrid(tuple(start_conf), tuple(end_conf), heuristic_fn, start_time,
+                                                max_time, reversible=reversible, heuristic_weight=heuristic_weight)
+        if verbose:
+            if path is None:
+                print('Failed | Iterations: {} | Time: {:.3f}'.format(iterations, elapsed_time(start_time)))
+            else:
+                print('Iterations: {} | States: {} | Time: {:.3f}'.format(
+                    iterations, len(path), elapsed_time(start_time)))
+        return path
+
+    def plan_lattice(self, start_state, goal_state, heuristic_fn, start_time, max_time=INF):
+        parents = {start_state: None}
+        costs = {start_state: 0.}
+        queue = [(heuristic_fn(start_state), 0., start_state)]
+        iterations = 0
+        while queue and (elapsed_time(start_time) < max_time):
+            _, cost, state = heappop(queue)
+            if cost > costs[state]:
+                continue
+            iterations += 1
+            if state == goal_state:
+                return [self.conf_from_state(s) for s in retrace_states(parents, state)], iterations
+            for neighbor, step_cost in self.get_neighbors(state):
+                if self.is_colliding(neighbor):
+                    continue
+                new_cost = cost + step_cost
+                if new_cost < costs.get(neighbor, INF):
+                    parents[neighbor] = state
+                    costs[neighbor] = new_cost
+                    heappush(queue, (new_cost + heuristic_fn(neighbor), new_cost, neighbor))
+        return None, iterations
+
+    def plan_hybrid(self, start_conf, end_conf, heuristic_fn, start_time, max_time=INF, reversible=True,
+                    heuristic_weight=1.):
+        # Each lattice state stores the best continuous configuration that reached it
+        # and the primitive configurations from its parent
+        # The goal is connected analytically every connect_period expansions and whenever it is nearby
+        start_state = self.key_from_conf(start_conf)
+        cost_to_go = self.compute_cost_to_go(self.state_from_conf(end_conf)[:2])
+        connect_cost_to_go = 2*self.step_size*np.sqrt(np.max(self.weights[:2]))
+        parents = {start_state: None}
+        costs = {start_state: 0.}
+        confs = {start_state: start_conf}
+        primitives = {start_state: np.array([start_conf], dtype=float)}
+        closed = set()
+        queue = [(heuristic_fn(start_conf), 0., start_state)]
+        iterations = 0
+        while queue and (elapsed_time(start_time) < max_time):
+            _, cost, state = heappop(queue)
+            if (state in closed) or (cost > costs[state]):
+                continue
+            closed.add(state)
+            iterations += 1
+            conf = confs[state]
+            cell = self.state_from_conf(conf)
+            if ((iterations - 1) % self.connect_period == 0) or (cost_to_go[cell[0]][cell[1]] <= connect_cost_to_go):
+                connection = self.connect_goal(conf, end_conf, reversible=reversible)
+                if not self.is_path_colliding(connection):
+                    path = np.vstack([primitives[s] for s in retrace_states(parents, state)] + [connection])
+                    return [tuple(map(float, q)) for q in path], iterations
+            paths = self.get_primitives(conf, reversible=reversible)
+            collisions = np.any(self.colliding_from_confs(paths), axis=1)
+            path_costs = self.get_path_costs(conf, paths).tolist()
+            for path, end, colliding, path_cost in zip(paths, paths[:, -1].tolist(), collisions, path_costs):
+                if colliding:
+                    continue
+                neighbor = self.key_from_conf(end)
+                new_cost = cost + path_cost
+                if (neighbor not in closed) and (new_cost < costs.get(neighbor, INF)):
+                    parents[neighbor] = state
+                    costs[neighbor] = new_cost
+                    confs[neighbor] = end
+                    primitives[neighbor] = path
+                    heappush(queue, (new_cost + heuristic_weight*heuristic_fn(end), new_cost, neighbor))
+        return None, iterations
+
+
+def get_headings(conf, end_conf, reversible=True):
+    # Driving directions and the corresponding headings that face end_conf from conf
+    heading = math.atan2(end_conf[1] - conf[1], end_conf[0] - conf[0])
+    if not reversible:
+        return [(+1, heading)]
+    return [(+1, heading), (-1, wrap_angle(heading + PI))]
+
+
+def get_rotation(conf, end_conf, heading):
+    # Total rotation to turn from conf to heading and then from heading to end_conf
+    return abs(math.remainder(heading - conf[2], 2*PI)) + abs(math.remainder(end_conf[2] - heading, 2*PI))
+
+
+def retrace_states(parents, state):
+    states = []
+    while state is not None:
+        states.append(state)
+        state = parents[state]
+    return states[::-1]
+
+
+def plan_grid_base_motion(body, end_conf, base_limits, obstacles=[], holonomic=True, reversible=True,
+                          max_time=INF, verbose=False, **kwargs):
+    # Construct a GridBasePlanner once and reuse it when querying the same scene repeatedly
+    planner = GridBasePlanner(body, base_limits, obstacles=obstacles, **kwargs)
+    return planner.plan(get_base_values(body), end_conf, holonomic=holonomic, reversible=reversible,
+                        max_time=max_time, verbose=verbose)
+
+
+################################################################################
+
+# Reachability maps
+
+def fibonacci_directions(num_directions):
+    # Approximately uniform unit vectors on the sphere
+    indices = np.arange(num_directions) + 0.5
+    z = 1 - 2*indices/num_directions
+    radii = np.sqrt(1 - z**2)
+    thetas = PI*(1 + np.sqrt(5))*indices
+    return np.column_stack([radii*np.cos(thetas), radii*np.sin(thetas), z])
+
+
+def rotate_vectors(quats, vector):
+    # Applies each [X,Y,Z,W] quaternion to vector
+    quats = np.array(quats, dtype=float).reshape(-1, 4)
+    imaginary, real = quats[:, :3], quats[:, 3:]
+    cross = np.cross(imaginary, vector)
+    return vector + 2*real*cross + 2*np.cross(imaginary, cross)
+
+
+def quats_from_directions(axis, directions, rolls=None):
+    # [X,Y,Z,W] quaternions that map axis onto each direction followed by a roll about that direction
+    axis = np.array(axis, dtype=float)
+    directions = np.array(directions, dtype=float).reshape(-1, 3)
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    if rolls is None:
+        rolls = np.zeros(len(directions))
+    # Half-way quaternion (degenerate when direction = -axis)
+    align_quats = np.column_stack([np.cross(axis, directions), 1 + directions.dot(axis)])
+    opposite = align_quats[:, 3] < 1e-9
+    perpendicular = np.cross(axis, [1., 0., 0.] if abs(axis[0]) < 0.9 else [0., 1., 0.])
+    align_quats[opposite] = np.append(perpendicular / np.linalg.norm(perpendicular), 0.)
+    align_quats /= np.linalg.norm(align_quats, axis=1, keepdims=True)
+    halves = np.array(rolls)[:, None] / 2.
+    roll_quats = np.column_stack([np.sin(halves)*directions, np.cos(halves)])
+    # Hamilton product roll_quats * align_quats
+    v1, w1 = roll_quats[:, :3], roll_quats[:, 3:]
+    v2, w2 = align_quats[:, :3], align_quats[:, 3:]
+    return np.column_stack([w1*v2 + w2*v1 + np.cross(v1, v2), w1*w2 - np.sum(v1*v2, axis=1, keepdims=True)])
+
+
+class ReachabilityMap(VoxelGrid):
+    # Success rates of a kinematic test (e.g. IK) over tool positions and approach directions in the robot base frame
+    # Occupied voxels are those with at least one successful sample
+
+    def __init__(self, lower, upper, resolution=0.1, num_orientations=32, axis=(1, 0, 0),
+                 attempts=None, successes=None, **kwargs):
+        resolutions = resolution*np.ones(3) if np.isscalar(resolution) else np.array(resolution, dtype=float)
+        lower = np.array(lower, dtype=float)
+        super(ReachabilityMap, self).__init__(resolutions, world_from_grid=Pose(Point(*lower)), **kwargs)
+        self.lower = lower
+        extents = np.round((np.array(upper) - lower) / resolutions, decimals=6)
+        self.shape = tuple(int(n) for n in np.maximum(np.ceil(extents), 1))
+        self.axis = np.array(axis, dtype=float) / np.linalg.norm(axis)
+        self.directions = fibonacci_directions(num_orientations)
+        # Half-angle of the spherical cap covered by each orientation bin
+        self.bin_radius = np.arccos(1 - 2./num_orientations)
+        dims = self.shape + (num_orientations,)
+        self.attempts = np.zeros(dims, dtype=np.uint16) if attempts is None else attempts
+        self.successes = np.zeros(dims, dtype=np.uint16) if successes is None else successes
+        assert self.attempts.shape == self.successes.shape == dims
+    @property
+    def upper(self):
+        return self.lower + np.multiply(self.shape, self.resolutions)
+    @property
+    def num_orientations(self):
+        return len(self.directions)
+    @property
+    def voxels(self):
+        return list(map(tuple, np.argwhere(np.ones(self.shape, dtype=bool))))
+    @property
+    def occupied(self):
+        return list(map(tuple, np.argwhere(np.any(self.successes > 0, axis=-1))))
+    def __iter__(self):
+        return iter(self.occupied)
+    def __len__(self):
+        return int(np.sum(np.any(self.successes > 0, axis=-1)))
+    def copy(self):
+        return self.__class__(self.lower, self.upper, self.resolutions, self.num_orientations, self.axis,
+                              attempts=self.attempts.copy(), successes=self.successes.copy(), color=self.color)
+
+    def in_bounds(self, voxel):
+        return all(0 <= i < n for i, n in safe_zip(voxel, self.shape))
+    def contains(self, voxel):
+        return self.in_bounds(voxel) and bool(np.any(self.successes[tuple(voxel)] > 0))
+    is_occupied = contains
+    def get_value(self, voxel):
+        # Success rate per orientation bin
+        assert self.in_bounds(voxel)
+        attempts = self.attempts[tuple(voxel)]
+        return np.divide(self.successes[tuple(voxel)], np.maximum(attempts, 1))
+    def set_value(self, voxel, value, num_attempts=None):
+        """
+        Sets the success rate per orientation bin, the inverse of get_value
+        :param value: an array of rates per orientation bin or a single rate (or bool) for every bin
+        :param num_attempts: the number of attempts that the rates represent (defaults to the current attempts)
+        """
+        assert self.in_bounds(voxel)
+        voxel = tuple(voxel)
+        rates = np.clip(np.broadcast_to(np.array(value, dtype=float), (self.num_orientations,)), 0., 1.)
+        attempts = self.attempts[voxel] if num_attempts is None else num_attempts*np.ones(self.num_orientations)
+        attempts = np.maximum(attempts, 1)
+        self.attempts[voxel] = attempts
+        self.successes[voxel] = np.round(rates*attempts)
+    def update(self, voxels, attempts, successes):
+        indices = tuple(np.array(voxels, dtype=int).T)
+        self.attempts[indices] += attempts.astype(self.attempts.dtype)
+        self.successes[indices] += successes.astype(self.successes.dtype)
+
+    def voxels_from_points(self, points):
+        return np.floor((np.array(points, dtype=float).reshape(-1, 3) - self.lower) / self.resolutions).astype(int)
+    def orientations_from_quats(self, quats):
+        directions = rotate_vectors(quats, self.axis)
+        return np.argmax(directions.dot(self.directions.T), axis=-1)
+    def get_rates(self, base_from_tools, unknown=1.):
+        """
+        Vectorized lookup of success rates for tool poses in the base frame
+        :param unknown: the rate returned for in-bounds bins that were never sampled
+        :return: an array of rates where poses outside the map have rate 0
+        """
+        if not base_from_tools:
+            return np.zeros(0)
+        points, quats = zip(*base_from_tools)
+        voxels = self.voxels_from_points(points)
+        orientations = self.orientations_from_quats(quats)
+        rates = np.zeros(len(voxels))
+        valid = np.all((0 <= voxels) & (voxels < self.shape), axis=1)
+        indices = tuple(voxels[valid].T) + (orientations[valid],)
+        attempts = self.attempts[indices]
+        rates[valid] = np.where(attempts > 0, self.successes[indices] / np.maximum(attempts, 1.), unknown)
+        return rates
+    def get_rate(self, base_from_tool, **kwargs):
+        return self.get_rates([base_from_tool], **kwargs)[0]
+    def is_reachable(self, base_from_tool, min_rate=0., **kwargs):
+        return self.get_rate(base_from_tool, **kwargs) > min_rate
+    def prioritize(self, base_from_tools, min_rate=0., **kwargs):
+        # Indices of the reachable poses ordered from the highest to the lowest success rate
+        rates = self.get_rates(base_from_tools, **kwargs)
+        order = np.argsort(-rates, kind='stable')
+        return [i for i in order if rates[i] > min_rate]
+
+    def sample_poses(self, voxel, orientations):
+        # Uniform positions within the voxel and directions within each orientation bin (up to bin overlap)
+        num = len(orientations)
+        points = self.lower + self.lower_from_voxel(np.array(voxel) + np.random.uniform(size=(num, 3)))
+        directions = self.directions[orientations] + \
+                     np.tan(self.bin_radius)*np.random.normal(size=(num, 3)) / np.sqrt(3)
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        quats = quats_from_directions(self.axis, directions, rolls=np.random.uniform(-PI, PI, size=num))
+        return [(tuple(point), tuple(quat)) for point, quat in zip(points, quats)]
+    def sample_voxel(self, voxel, test_fn, num_samples=1):
+        base_from_tools = self.sample_poses(voxel, np.repeat(np.arange(self.num_orientations), num_samples))
+        orientations = self.orientations_from_quats([quat for _, quat in base_from_tools])
+        results = np.array([bool(test_fn(base_from_tool)) for base_from_tool in base_from_tools], dtype=int)
+        attempts = np.bincount(orientations, minlength=self.num_orientations)
+        successes = np.bincount(orientations, weights=results, minlength=self.num_orientations).astype(int)
+        return attempts, successes
+
+    def save(self, path):
+        np.savez_compressed(path, lower=self.lower, upper=self.upper, resolutions=self.resolutions,
+                            axis=self.axis, attempts=self.attempts, successes=self.successes)
+        return path
+    @classmethod
+    def load(cls, path, **kwargs):
+        data = np.load(path)
+        return cls(data['lower'], data['upper'], data['resolutions'], data['attempts'].shape[-1], data['axis'],
+                   attempts=data['attempts'], successes=data['successes'], **kwargs)
+
+    def draw(self, min_rate=0., **kwargs):
+        rates = np.max(np.divide(self.successes, np.maximum(self.attempts, 1)), axis=-1)
+        voxels = [voxel for voxel in self.occupied if rates[voxel] > min_rate]
+        return self.draw_voxel_centers(voxels, **kwargs)
+    def __repr__(self):
+        return '{}(shape={}, orientations={}, reachable={}/{})'.format(
+            self.__class__.__name__, self.shape, self.num_orientations, len(self), np.prod(self.shape))
+
+
+REACHABILITY_MAP = None
+REACHABILITY_TEST = None
+
+
+def initialize_reachability_worker(create_fn, reachability_map):
+    global REACHABILITY_MAP, REACHABILITY_TEST
+    REACHABILITY_MAP = reachability_map
+    try:
+        REACHABILITY_TEST = create_fn()
+    except Exception as e:
+        # Raising within a Pool initializer respawns the worker indefinitely, so the error is deferred to the tasks
+        REACHABILITY_TEST = e
+
+
+def sample_reachability_worker(args):
+    voxels, num_samples, seed = args
+    if isinstance(REACHABILITY_TEST, Exception):
+        raise REACHABILITY_TEST
+    # Forked workers inherit the same random states, so each chunk reseeds both (e.g. for test functions using random)
+    np.random.seed(seed)
+    random.seed(seed)
+    results = [REACHABILITY_MAP.sample_voxel(voxel, REACHABILITY_TEST, num_samples=num_samples)
+               for voxel in voxels]
+    attempts, successes = map(np.array, zip(*results))
+    return voxels, attempts, successes
+
+
+def build_reachability_map(create_fn, lower, upper, num_samples=1, num_workers=None, chunk_size=16,
+                           verbose=True, **kwargs):
+    """
+    Estimates a ReachabilityMap by sampling every voxel and orientation bin num_samples times
+    :param create_fn: a picklable function that is called once per worker process (e.g. to connect and load the robot)
+        and returns a test function that maps a base_from_tool pose to whether it is reachable
+    :param num_workers: the number of processes (None defaults to the number of CPUs); 1 evaluates serially
+    """
+    import multiprocessing
+    reachability_map = ReachabilityMap(lower, upper, **kwargs)
+    voxels = reachability_map.voxels
+    # Distinct seeds per chunk, so the workers draw independent samples
+    seed = np.random.randint(2**31)
+    tasks = [(voxels[i:i + chunk_size], num_samples, seed + index)
+             for index, i in enumerate(range(0, len(voxels), chunk_size))]
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    start_time = time.time()
+    if num_workers <= 1:
+        initialize_reachability_worker(create_fn, reachability_map)
+        results = map(sample_reachability_worker, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(num_workers, initializer=initialize_reachability_worker,
+                                    initargs=(create_fn, reachability_map))
+        results = pool.imap_unordered(sample_reachability_worker, tasks)
+    try:
+        for i, (chunk_voxels, attempts, successes) in enumerate(results):
+            reachability_map.update(chunk_voxels, attempts, successes)
+            if verbose:
+                print('Chunk: {}/{} | Reachable: {} | Time: {:.3f}'.format(
+                    i + 1, len(tasks), len(reachability_map), elapsed_time(start_time)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return reachability_map
+
+
 ################################################################################
 
 def create_textured_square(size, color=None,